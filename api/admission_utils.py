@@ -0,0 +1,179 @@
+# admission control of the ai model calls: each model gets a limit of requests answered at the same time
+# and a bounded queue, served by priority class then earliest deadline. When the queue is full the request
+# is shed right away with a retry delay estimated from the recent answer times, instead of every request
+# slowing down together until the provider rate limits them all.
+from metrics_utils import admission_wait_seconds, admission_shed, admission_degraded
+import itertools
+import asyncio
+import heapq
+import math
+import time
+import os
+
+# Defaults for every model, in requests
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", "16"))
+ADMISSION_QUEUE_DEPTH = int(os.getenv("ADMISSION_QUEUE_DEPTH", "64"))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "30")) # seconds a request waits in the queue unless it sets its own deadline
+# Per model overrides as model=concurrency:queue_depth, e.g. "gpt-4o=4:16,gpt-4o-mini=32:128"
+ADMISSION_LIMITS = os.getenv("ADMISSION_LIMITS", "")
+# Model a request that allows it is degraded to when its own model sheds it, e.g. "gpt-4o=gpt-4o-mini"
+ADMISSION_FALLBACKS = os.getenv("ADMISSION_FALLBACKS", "gpt-4o=gpt-4o-mini")
+
+# Priority classes, lower is served first
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+
+def parse_limits(value):
+    limits = {}
+    for item in filter(None, (item.strip() for item in value.split(","))):
+        model, limit = item.split("=")
+        concurrency, queue_depth = limit.split(":")
+        limits[model.strip()] = (int(concurrency), int(queue_depth))
+    return limits
+
+
+def parse_fallbacks(value):
+    return dict((model.strip(), fallback.strip()) for model, fallback in
+                (item.split("=") for item in value.split(",") if item.strip()))
+
+
+# A request the model could not take: its queue was full or its deadline passed while queued
+class AdmissionRejected(Exception):
+    def __init__(self, model, reason, retry_after):
+        super().__init__(f"The {model} model is overloaded ({reason}), retry after {retry_after}s.")
+        self.model = model
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+# Slot held by an admitted request, released once when its answer is done
+class Ticket:
+    def __init__(self, scheduler, model):
+        self.scheduler = scheduler
+        self.model = model
+        self.start = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.scheduler.release(time.monotonic() - self.start)
+
+    # Same as release(), for the starlette background tasks, which run plain functions in the threadpool
+    async def arelease(self):
+        self.release()
+
+
+# Concurrency limit and priority queue of one model, used from the event loop only
+class ModelScheduler:
+    def __init__(self, model, concurrency=ADMISSION_CONCURRENCY, queue_depth=ADMISSION_QUEUE_DEPTH):
+        self.model = model
+        self.concurrency = concurrency
+        self.queue_depth = queue_depth
+        self.active = 0
+        self.queue = [] # heap of [priority, deadline, sequence, future]
+        self.sequence = itertools.count()
+        self.service_time = 1.0 # moving average of the seconds a slot is held
+        self.admitted = 0
+        self.shed = 0
+
+    # Seconds until the requests ahead of a new one have drained through the slots
+    def retry_after(self):
+        return max(1, math.ceil(self.service_time * (len(self.queue) + 1) / self.concurrency))
+
+    def reject(self, reason):
+        self.shed += 1
+        admission_shed.inc(model=self.model, reason=reason)
+        raise AdmissionRejected(self.model, reason, self.retry_after())
+
+    def admit(self, priority, start):
+        self.admitted += 1
+        admission_wait_seconds.observe(time.monotonic() - start, model=self.model, priority=priority)
+        return Ticket(self, self.model)
+
+    # Forget the queued requests that went away or are past their deadline
+    def drop_expired(self, now):
+        for entry in self.queue:
+            if not entry[3].done() and entry[1] < now:
+                entry[3].cancel()
+        if any(entry[3].done() for entry in self.queue):
+            self.queue = [entry for entry in self.queue if not entry[3].done()]
+            heapq.heapify(self.queue)
+
+    # Wait for a slot, max_wait seconds at most; raises AdmissionRejected when the queue is full or the wait too long
+    async def acquire(self, priority="normal", max_wait=None):
+        start = time.monotonic()
+        if self.queue:
+            self.drop_expired(start)
+        if self.active < self.concurrency and not self.queue:
+            self.active += 1
+            return self.admit(priority, start)
+
+        deadline = start + (ADMISSION_MAX_WAIT if max_wait is None else max_wait)
+        if len(self.queue) >= self.queue_depth:
+            self.reject("queue_full")
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, [PRIORITIES.get(priority, PRIORITIES["normal"]), deadline, next(self.sequence), future])
+        try:
+            await asyncio.wait([future], timeout=deadline - start)
+        except asyncio.CancelledError:
+            # The slot may have been handed over in the meantime, pass it on
+            if future.done() and not future.cancelled():
+                self.release(None)
+            future.cancel()
+            raise
+        if future.done() and not future.cancelled():
+            return self.admit(priority, start)
+        future.cancel()
+        self.reject("deadline")
+
+    # Hand the slot to the next queued request still waiting, or free it
+    def release(self, seconds):
+        if seconds is not None:
+            self.service_time = 0.8 * self.service_time + 0.2 * seconds
+        now = time.monotonic()
+        while self.queue:
+            entry = heapq.heappop(self.queue)
+            if entry[3].done():
+                continue
+            if entry[1] < now:
+                entry[3].cancel()
+                continue
+            entry[3].set_result(None)
+            return
+        self.active -= 1
+
+    def stats(self):
+        return {"concurrency": self.concurrency, "queue_depth": self.queue_depth, "active": self.active,
+                "queued": sum(1 for entry in self.queue if not entry[3].done()), "admitted": self.admitted,
+                "shed": self.shed, "service_seconds": round(self.service_time, 3)}
+
+
+limits = parse_limits(ADMISSION_LIMITS)
+fallbacks = parse_fallbacks(ADMISSION_FALLBACKS)
+schedulers = {}
+
+
+def get_scheduler(model):
+    scheduler = schedulers.get(model)
+    if scheduler is None:
+        scheduler = schedulers[model] = ModelScheduler(model, *limits.get(model, (ADMISSION_CONCURRENCY, ADMISSION_QUEUE_DEPTH)))
+    return scheduler
+
+
+# Wait for a slot of the model, returns (model used, ticket to release);
+# with allow_fallback a full queue degrades the request to the fallback model instead of shedding it
+async def admit(model, priority="normal", max_wait=None, allow_fallback=False):
+    try:
+        return model, await get_scheduler(model).acquire(priority, max_wait)
+    except AdmissionRejected as e:
+        fallback = fallbacks.get(model)
+        if not allow_fallback or not fallback or e.reason != "queue_full":
+            raise
+    ticket = await get_scheduler(fallback).acquire(priority, max_wait)
+    admission_degraded.inc(model=model, fallback=fallback)
+    return fallback, ticket
+
+
+def admission_stats():
+    return {model: scheduler.stats() for model, scheduler in sorted(schedulers.items())}
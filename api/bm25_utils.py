@@ -0,0 +1,240 @@
+# in-memory BM25 index over the same chunks as the vector store, maintained incrementally,
+# and a retriever fusing lexical and vector results with reciprocal rank fusion
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
+from langchain_core.runnables.config import run_in_executor
+from langchain_core.documents import Document
+from collections import defaultdict, Counter
+from metrics_utils import time_stage
+from rerank_utils import rerank
+from shard_utils import chunk_shard
+import numpy as np
+from typing import Any, List, Optional
+import threading
+import math
+import re
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "do", "does", "for", "from", "how", "in", "is", "it",
+    "of", "on", "or", "that", "the", "this", "to", "was", "what", "which", "who", "why", "with",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+# Okapi BM25 index keyed by the chunk ids of the vector store
+class BM25Index:
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.postings = defaultdict(dict) # term -> {chunk_id: term frequency}
+            self.doc_lengths = {}
+            self.documents = {} # chunk_id -> (text, metadata)
+            self.file_chunks = defaultdict(set) # file_id -> chunk_ids
+            self.total_length = 0
+            self.built = False
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def add(self, chunk_ids, texts, metadatas):
+        with self.lock:
+            for chunk_id, text, metadata in zip(chunk_ids, texts, metadatas):
+                if chunk_id in self.doc_lengths:
+                    self.remove([chunk_id])
+                terms = Counter(tokenize(text))
+                for term, frequency in terms.items():
+                    self.postings[term][chunk_id] = frequency
+                length = sum(terms.values())
+                self.doc_lengths[chunk_id] = length
+                self.total_length += length
+                self.documents[chunk_id] = (text, metadata)
+                self.file_chunks[metadata.get("file_id")].add(chunk_id)
+
+    def remove(self, chunk_ids):
+        with self.lock:
+            for chunk_id in chunk_ids:
+                if chunk_id not in self.doc_lengths:
+                    continue
+                text, metadata = self.documents.pop(chunk_id)
+                for term in set(tokenize(text)):
+                    postings = self.postings.get(term)
+                    if postings is not None:
+                        postings.pop(chunk_id, None)
+                        if not postings:
+                            del self.postings[term]
+                self.total_length -= self.doc_lengths.pop(chunk_id)
+                self.file_chunks[metadata.get("file_id")].discard(chunk_id)
+
+    # Removes every chunk of a file, returns how many there were
+    def remove_file(self, file_id):
+        with self.lock:
+            chunk_ids = list(self.file_chunks.pop(file_id, ()))
+            self.remove(chunk_ids)
+            return len(chunk_ids)
+
+    # (Re)build the whole index from the collections of a vector store, reading their chunks page by page
+    def build(self, collections, page_size: int = 5000):
+        with self.lock:
+            self.clear()
+            for collection in collections:
+                offset = 0
+                while True:
+                    page = collection.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+                    if not page["ids"]:
+                        break
+                    self.add(page["ids"], page["documents"], page["metadatas"])
+                    offset += len(page["ids"])
+            self.built = True
+
+    # Top-k chunks as (chunk_id, score, matched query terms), best first, only from the given shards if any
+    def search(self, query: str, k: int, shards=None):
+        terms = set(tokenize(query))
+        with self.lock:
+            count = len(self.doc_lengths)
+            if not count or not terms:
+                return []
+            average_length = self.total_length / count
+            scores = defaultdict(float)
+            matched = defaultdict(int)
+            for term in terms:
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for chunk_id, frequency in postings.items():
+                    if shards is not None and chunk_shard(self.documents[chunk_id][1]) not in shards:
+                        continue
+                    norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[chunk_id] / average_length)
+                    scores[chunk_id] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+                    matched[chunk_id] += 1
+            best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+            return [(chunk_id, score, matched[chunk_id] / len(terms)) for chunk_id, score in best]
+
+    def document(self, chunk_id) -> Document:
+        text, metadata = self.documents[chunk_id]
+        return Document(page_content=text, metadata=dict(metadata))
+
+
+# Retriever fusing BM25 and vector results by reciprocal rank fusion.
+# When the lexical match is confident (every query term found and a clear lead over the next hit)
+# the lexical results are used directly and the query is never embedded.
+# The fetch_k candidates are re-ranked by MMR over their stored embeddings and overlapping neighbours merged (see rerank_utils),
+# k, fetch_k and mmr_lambda can be overridden per call, e.g. retriever.invoke(query, k=4), and shards restricts
+# the search to some of the sharded collections, which are searched concurrently (see chroma_utils.ShardedCollections).
+class HybridRetriever(BaseRetriever):
+    vectorstore: Any
+    lexical_index: Any
+    collections: Any = None # sharded collections, without them only the collection of the vector store is searched
+    k: int = 2
+    fetch_k: int = 10
+    rrf_k: int = 60
+    mode: str = "hybrid" # hybrid, vector or lexical
+    lexical_margin: float = 2.0 # <= 0 disables the lexical fast path
+    mmr_lambda: float = 0.7 # 1 ranks by relevance only, lower values favour diversity
+    excluded_file_ids: Any = None # file ids deleted but still in the vector store until the compaction runs
+    query_embeddings: Any = None # cache of query embeddings, the vector store's embedding function is called without it
+    executor: Any = None # executor of the async retrieval, the shared vector store pool (chroma_utils) rather than the loop's default one
+
+    def lexical_results(self, query: str, fetch_k: int, shards=None):
+        if not self.lexical_index.built:
+            self.lexical_index.build(self.collections.select() if self.collections else [self.vectorstore])
+            # A rebuild reads the chunks of deleted documents back from the vector store
+            for file_id in list(self.excluded_file_ids or ()):
+                self.lexical_index.remove_file(file_id)
+        return self.lexical_index.search(query, fetch_k, shards)
+
+    # Nearest chunks as (ids, documents, embeddings, cosine similarity to the query)
+    def vector_results(self, query: str, fetch_k: int, shards=None):
+        if self.query_embeddings is not None:
+            query_embedding = self.query_embeddings.embed(query)
+        else:
+            query_embedding = np.asarray(self.vectorstore.embeddings.embed_query(query), dtype=np.float32)
+        # Chunks of deleted documents are filtered out by the vector store itself
+        where = {"file_id": {"$nin": sorted(self.excluded_file_ids)}} if self.excluded_file_ids else None
+        include = ["documents", "metadatas", "embeddings"]
+        if self.collections:
+            result = self.collections.query(query_embedding.tolist(), fetch_k, include, shards, where)
+        else:
+            result = self.vectorstore._collection.query(query_embeddings=[query_embedding.tolist()], n_results=fetch_k, where=where, include=include)
+        if not result["ids"][0]:
+            return [], [], np.zeros((0, len(query_embedding)), dtype=np.float32), np.zeros(0, dtype=np.float32)
+        ids = result["ids"][0]
+        documents = [Document(page_content=text, metadata=metadata or {}) for text, metadata in zip(result["documents"][0], result["metadatas"][0])]
+        embeddings = np.asarray(result["embeddings"][0], dtype=np.float32)
+        norms = np.maximum(np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query_embedding), 1e-12)
+        return ids, documents, embeddings, embeddings @ query_embedding / norms
+
+    # Embeddings stored in the vector store for the chunk ids, in the same order, or None when some are missing
+    def stored_embeddings(self, ids, shards=None):
+        if self.vectorstore is None or not ids:
+            return None
+        if self.collections:
+            result = self.collections.get(ids, ["embeddings"], shards)
+        else:
+            result = self.vectorstore._collection.get(ids=list(ids), include=["embeddings"])
+        by_id = dict(zip(result["ids"], result["embeddings"]))
+        if len(by_id) < len(ids):
+            return None
+        return np.asarray([by_id[chunk_id] for chunk_id in ids], dtype=np.float32)
+
+    def is_confident(self, lexical):
+        if self.lexical_margin <= 0 or not lexical or lexical[0][2] < 1.0:
+            return False
+        return len(lexical) == 1 or lexical[0][1] >= self.lexical_margin * lexical[1][1]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun,
+                                k: Optional[int] = None, fetch_k: Optional[int] = None, mmr_lambda: Optional[float] = None,
+                                shards: Optional[List[str]] = None) -> List[Document]:
+        k = k or self.k
+        fetch_k = max(fetch_k or self.fetch_k, k)
+        mmr_lambda = self.mmr_lambda if mmr_lambda is None else mmr_lambda
+        with time_stage("retrieval"):
+            documents, relevance, embeddings = self.candidates(query, fetch_k, shards)
+            return rerank(documents, relevance, embeddings, k, mmr_lambda)
+
+    # The default async version does not forward the per-call overrides
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun, **kwargs) -> List[Document]:
+        return await run_in_executor(self.executor, self._get_relevant_documents, query, run_manager=run_manager.get_sync(), **kwargs)
+
+    # The fetch_k candidates as (documents, relevance scores, embeddings or None)
+    def candidates(self, query: str, fetch_k: int, shards=None):
+        if self.mode == "vector":
+            _, documents, embeddings, similarity = self.vector_results(query, fetch_k, shards)
+            return documents, similarity, embeddings
+
+        lexical = self.lexical_results(query, fetch_k, shards)
+        if self.mode == "lexical" or self.is_confident(lexical):
+            ids = [chunk_id for chunk_id, _, _ in lexical]
+            return [self.lexical_index.document(chunk_id) for chunk_id in ids], [score for _, score, _ in lexical], self.stored_embeddings(ids, shards)
+
+        vector_ids, vector_documents, vector_embeddings, _ = self.vector_results(query, fetch_k, shards)
+
+        # Both indexes are keyed by the Chroma chunk ids
+        documents = dict(zip(vector_ids, vector_documents))
+        embeddings = dict(zip(vector_ids, vector_embeddings))
+        scores = defaultdict(float)
+        for rank, chunk_id in enumerate(vector_ids):
+            scores[chunk_id] += 1 / (self.rrf_k + rank + 1)
+        for rank, (chunk_id, _, _) in enumerate(lexical):
+            if chunk_id not in documents:
+                documents[chunk_id] = self.lexical_index.document(chunk_id)
+            scores[chunk_id] += 1 / (self.rrf_k + rank + 1)
+
+        ids = sorted(scores, key=scores.get, reverse=True)[:fetch_k]
+        lexical_only = [chunk_id for chunk_id in ids if chunk_id not in embeddings]
+        if lexical_only:
+            stored = self.stored_embeddings(lexical_only, shards)
+            if stored is None:
+                return [documents[chunk_id] for chunk_id in ids], [scores[chunk_id] for chunk_id in ids], None
+            embeddings.update(zip(lexical_only, stored))
+        return [documents[chunk_id] for chunk_id in ids], [scores[chunk_id] for chunk_id in ids], np.asarray([embeddings[chunk_id] for chunk_id in ids])
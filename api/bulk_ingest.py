@@ -0,0 +1,28 @@
+# command line for the bulk ingestion, e.g.
+#   python bulk_ingest.py ../documents corpus.zip --workers 8
+# bulk_utils is only imported inside main() because the spawned parsing workers re-import
+# this script, and they must not open the vector store or database on start
+import argparse
+import json
+import os
+
+
+def main():
+    from bulk_utils import ingest_paths, BULK_PARSE_WORKERS
+    from chroma_utils import EMBEDDING_BATCH_SIZE
+
+    parser = argparse.ArgumentParser(description="Bulk ingest documents, directories and zip/tar archives.")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--workers", type=int, default=BULK_PARSE_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=EMBEDDING_BATCH_SIZE)
+    parser.add_argument("--shard", help="tenant or tag of the documents, when SHARD_KEY routes by tenant or tag")
+    args = parser.parse_args()
+
+    summary = ingest_paths([(os.path.basename(path), path) for path in args.paths], workers=args.workers, batch_size=args.batch_size, shard=args.shard)
+    for result in summary["files"]:
+        print(f"{result['status']:8} {result['filename']} (file_id: {result['file_id']}, chunks: {result['chunks']}){' - ' + result['error'] if result['error'] else ''}")
+    print(json.dumps({key: value for key, value in summary.items() if key != "files"}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+# bulk ingestion of many files or zip/tar archives, parsing runs in a process pool
+# and chunks are embedded and written in large batches
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from document_utils import SUPPORTED_EXTENSIONS, parse_document, hash_text
+from db_utils import insert_ingestion_job, update_ingestion_job, get_unfinished_ingestion_jobs, insert_document_records, delete_document_records, insert_document_chunks, get_document_by_hash, get_document_by_filename, update_document_hash
+from chroma_utils import embed_chunks, add_chunks_to_chroma, delete_doc_from_chroma, answer_cache, EMBEDDING_BATCH_SIZE
+from job_utils import sync_chunks, document_lock, ingestion_executor
+from shard_utils import shard_name
+import multiprocessing
+import tempfile
+import zipfile
+import tarfile
+import shutil
+import time
+import os
+import logging
+from logging_utils import log_time
+
+
+# Number of processes parsing documents, parsing PDF/DOCX is CPU-bound
+BULK_PARSE_WORKERS = int(os.getenv("BULK_PARSE_WORKERS", str(os.cpu_count() or 2)))
+
+# Archive extensions accepted besides the supported document types
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def is_supported(path):
+    return os.path.splitext(path)[-1].lower() in SUPPORTED_EXTENSIONS
+
+
+# Copies the supported documents of an archive into extract_dir, returns (filename, path) pairs.
+# Members are written under a generated name so archive paths can never escape extract_dir.
+def extract_archive(archive_path, extract_dir):
+    extracted = []
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            for index, member in enumerate(archive.infolist()):
+                filename = os.path.basename(member.filename)
+                if member.is_dir() or not is_supported(filename):
+                    continue
+                path = os.path.join(extract_dir, f"{index}_{filename}")
+                with archive.open(member) as source, open(path, "wb") as target:
+                    shutil.copyfileobj(source, target)
+                extracted.append((filename, path))
+    else:
+        with tarfile.open(archive_path) as archive:
+            for index, member in enumerate(archive.getmembers()):
+                filename = os.path.basename(member.name)
+                if not member.isfile() or not is_supported(filename):
+                    continue
+                path = os.path.join(extract_dir, f"{index}_{filename}")
+                with archive.extractfile(member) as source, open(path, "wb") as target:
+                    shutil.copyfileobj(source, target)
+                extracted.append((filename, path))
+    return extracted
+
+
+# Expands the inputs (files, directories and archives) into (filename, path) pairs of documents to ingest
+def expand_inputs(inputs, extract_dir):
+    files = []
+    for filename, path in inputs:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(expand_inputs([(name, os.path.join(root, name)) for name in sorted(names)], extract_dir))
+        elif is_archive(filename):
+            files.extend(extract_archive(path, extract_dir))
+        elif is_supported(filename):
+            files.append((filename, path))
+    return files
+
+
+# Indexes one batch of parsed files holding the locks of their filenames (see job_utils.document_lock),
+# a filename indexed by an upload in the meantime is re-indexed rather than given a second record
+def index_batch(batch, results, shard=None):
+    with ExitStack() as locks:
+        for filename in sorted({filename for filename, _, _ in batch}):
+            locks.enter_context(document_lock(filename, shard))
+
+        new_files = []
+        for filename, content_hash, chunks in batch:
+            previous = get_document_by_filename(filename, shard)
+            if previous:
+                reindex_document(previous, filename, content_hash, chunks, results)
+            else:
+                new_files.append((filename, content_hash, chunks))
+        if new_files:
+            index_new_files(new_files, results, shard)
+
+
+# Embeds and writes new parsed files, one document_store transaction and one Chroma write per batch and shard
+def index_new_files(batch, results, shard=None):
+    file_ids = insert_document_records([filename for filename, _, _ in batch], [content_hash for _, content_hash, _ in batch], shard)
+    if len(file_ids) != len(batch):
+        for filename, _, _ in batch:
+            results.append({"filename": filename, "status": "failed", "file_id": None, "chunks": 0, "error": "Failed to insert document record."})
+        return
+
+    chunks = []
+    for file_id, (_, _, file_chunks) in zip(file_ids, batch):
+        for chunk in file_chunks:
+            chunk.metadata['file_id'] = file_id
+            chunk.metadata['shard'] = shard_name(file_id, shard)
+        chunks.extend(file_chunks)
+
+    try:
+        if chunks:
+            chroma_ids = add_chunks_to_chroma(chunks, embed_chunks(chunks))
+            insert_document_chunks([(chroma_id, chunk.metadata['file_id'], hash_text(chunk.page_content)) for chroma_id, chunk in zip(chroma_ids, chunks)])
+        for file_id, (filename, content_hash, file_chunks) in zip(file_ids, batch):
+            results.append({"filename": filename, "status": "indexed", "file_id": file_id, "chunks": len(file_chunks), "error": None, "content_hash": content_hash})
+
+    except Exception as e:
+        logging.error(f"Error indexing bulk batch of {len(batch)} files: {str(e)} [{log_time()}]")
+        # Some shards may have been written before the failure, or all of them before the chunk records failed
+        for file_id in file_ids:
+            delete_doc_from_chroma(file_id)
+        delete_document_records(file_ids)
+        for filename, _, _ in batch:
+            results.append({"filename": filename, "status": "failed", "file_id": None, "chunks": 0, "error": str(e)})
+
+
+# Re-indexes a new version of an already indexed filename, only the changed chunks are embedded.
+# Holds the filename's lock like an ingestion job does, so an upload of the same filename waits for it.
+def reindex_document(document, filename, content_hash, chunks, results):
+    file_id = document['id']
+    try:
+        with document_lock(filename, document['shard']):
+            chunks_indexed, _, _ = sync_chunks(file_id, chunks, {}, shard=document['shard'])
+            update_document_hash(file_id, content_hash)
+        results.append({"filename": filename, "status": "updated", "file_id": file_id, "chunks": chunks_indexed, "error": None, "content_hash": content_hash})
+
+    except Exception as e:
+        logging.error(f"Error re-indexing {filename} with file_id {file_id} during bulk ingestion: {str(e)} [{log_time()}]")
+        results.append({"filename": filename, "status": "failed", "file_id": file_id, "chunks": 0, "error": str(e)})
+
+
+# Parses the files in a process pool and indexes them in batches of about batch_size chunks,
+# all of them for the given shard (tenant or tag). Returns the per-file results and the overall throughput.
+def ingest_files(files, workers=BULK_PARSE_WORKERS, batch_size=EMBEDDING_BATCH_SIZE, shard=None):
+    start = time.perf_counter()
+    results = []
+    batch = []
+    batch_chunk_count = 0
+    seen_hashes = {}
+
+    # spawn keeps the workers from inheriting the threads and open connections of the server
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {executor.submit(parse_document, path): (filename, path) for filename, path in files}
+        for future in as_completed(futures):
+            filename, path = futures[future]
+            try:
+                chunks, content_hash, error = future.result()
+            except Exception as e:
+                chunks, content_hash, error = [], None, str(e)
+
+            if error:
+                logging.error(f"Error parsing {filename} during bulk ingestion: {error} [{log_time()}]")
+                results.append({"filename": filename, "status": "failed", "file_id": None, "chunks": 0, "error": error})
+                continue
+
+            # Identical content is indexed once, whether it is already stored or appears twice in this request
+            if content_hash in seen_hashes:
+                results.append({"filename": filename, "status": "duplicate", "file_id": None, "chunks": 0, "error": None, "duplicate_of": content_hash})
+                continue
+            seen_hashes[content_hash] = filename
+            existing = get_document_by_hash(content_hash, shard)
+            if existing:
+                results.append({"filename": filename, "status": "duplicate", "file_id": existing['id'], "chunks": 0, "error": None, "content_hash": content_hash})
+                continue
+
+            # Another version of a filename still waiting in the batch is indexed first, this one then updates it
+            if any(filename == pending for pending, _, _ in batch):
+                index_batch(batch, results, shard)
+                batch, batch_chunk_count = [], 0
+
+            batch.append((filename, content_hash, chunks))
+            batch_chunk_count += len(chunks)
+            if batch_chunk_count >= batch_size:
+                index_batch(batch, results, shard)
+                batch, batch_chunk_count = [], 0
+
+    if batch:
+        index_batch(batch, results, shard)
+
+    # Duplicates within the request get the file_id their content is stored under, by content hash:
+    # a filename can be updated later in the request and a first copy can fail
+    file_hashes = {result["file_id"]: result["content_hash"] for result in results if "content_hash" in result}
+    file_ids = {content_hash: file_id for file_id, content_hash in file_hashes.items()}
+    for result in results:
+        result.pop("content_hash", None)
+        if "duplicate_of" in result:
+            result["file_id"] = file_ids.get(result["duplicate_of"])
+            if result["file_id"] is None:
+                result.update(status="failed", error=f"Same content as {seen_hashes[result['duplicate_of']]}, which was not indexed or was replaced later in this request.")
+            del result["duplicate_of"]
+
+    indexed = [result for result in results if result["status"] in ("indexed", "updated")]
+    if indexed:
+        answer_cache.invalidate()
+
+    seconds = time.perf_counter() - start
+    chunk_count = sum(result["chunks"] for result in indexed)
+    summary = {"files": results,
+               "documents": len(indexed),
+               "duplicates": sum(result["status"] == "duplicate" for result in results),
+               "failed": sum(result["status"] == "failed" for result in results),
+               "chunks": chunk_count,
+               "seconds": seconds,
+               "documents_per_second": len(indexed) / seconds if seconds else 0.0,
+               "chunks_per_second": chunk_count / seconds if seconds else 0.0}
+    logging.info(f"Bulk ingestion indexed {len(indexed)} documents ({chunk_count} chunks) in {seconds:.2f}s, {summary['failed']} failed [{log_time()}]")
+    return summary
+
+
+# Expands the inputs into a temporary directory and ingests every document found
+def ingest_paths(inputs, workers=BULK_PARSE_WORKERS, batch_size=EMBEDDING_BATCH_SIZE, shard=None):
+    extract_dir = tempfile.mkdtemp(prefix="bulk_")
+    try:
+        files = expand_inputs(inputs, extract_dir)
+        return ingest_files(files, workers=workers, batch_size=batch_size, shard=shard)
+    finally:
+        shutil.rmtree(extract_dir, ignore_errors=True)
+
+
+
+# Files of a bulk job staged in staged_dir as "{index}_{filename}", returns (filename, path) pairs in upload order
+def staged_files(staged_dir):
+    names = sorted(os.listdir(staged_dir), key=lambda name: int(name.split("_", 1)[0]))
+    return [(name.split("_", 1)[1], os.path.join(staged_dir, name)) for name in names]
+
+
+# Runs a queued bulk job, the summary of ingest_files is stored as the job's result
+def run_bulk_job(job_id, staged_dir, shard=None):
+    start = time.perf_counter()
+    try:
+        update_ingestion_job(job_id, status='running', stage='index')
+        summary = ingest_paths(staged_files(staged_dir), shard=shard)
+        update_ingestion_job(job_id, status='completed', stage='done', chunk_count=summary['chunks'], chunks_indexed=summary['chunks'],
+                             timings={'index': summary['seconds']}, result=summary)
+        logging.info(f"Bulk job {job_id} indexed {summary['documents']} documents, {summary['failed']} failed [{log_time()}]")
+
+    except Exception as e:
+        logging.error(f"Bulk job {job_id} failed: {e} [{log_time()}]")
+        update_ingestion_job(job_id, status='failed', error=str(e), timings={'index': time.perf_counter() - start})
+
+    finally:
+        shutil.rmtree(staged_dir, ignore_errors=True)
+
+
+# Queues the files staged in staged_dir as one bulk job, the caller follows it with GET /jobs/{job_id}
+def submit_bulk_job(job_id, staged_dir, shard=None):
+    insert_ingestion_job(job_id, f"{len(os.listdir(staged_dir))} files", staged_dir, shard=shard, kind='bulk')
+    ingestion_executor.submit(run_bulk_job, job_id, staged_dir, shard)
+    logging.info(f"Queued bulk job {job_id} [{log_time()}]")
+    return job_id
+
+
+# Requeues the bulk jobs that were queued or running when the server stopped, ingest_files
+# skips the documents a first run already indexed as duplicates of their stored content
+def resume_bulk_jobs():
+    jobs = get_unfinished_ingestion_jobs(kind='bulk')
+    for job in jobs:
+        if not os.path.isdir(job['staged_path']):
+            update_ingestion_job(job['id'], status='failed', error='Staged files are missing after restart.')
+            continue
+        ingestion_executor.submit(run_bulk_job, job['id'], job['staged_path'], job['shard'])
+    if jobs:
+        logging.info(f"Resumed {len(jobs)} bulk jobs [{log_time()}]")
@@ -0,0 +1,238 @@
+# caches placed in front of expensive model calls
+from langchain_core.embeddings import Embeddings
+from collections import OrderedDict
+from array import array
+from typing import List
+from metrics_utils import time_stage, embedded_texts
+import numpy as np
+import hashlib
+import sqlite3
+import threading
+import itertools
+import time
+
+# Set embedding cache database name, kept next to our main database
+EMBEDDING_CACHE_DB_NAME = "embedding_cache.db"
+
+
+# Content-addressed embedding cache, an in-memory LRU tier in front of an on-disk sqlite tier.
+# Entries are keyed by (model, sha256 of the text) so the same chunk is only ever embedded once per model.
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings: Embeddings, model_name: str, db_name: str = EMBEDDING_CACHE_DB_NAME, max_memory_items: int = 10000):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.max_memory_items = max_memory_items
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS embedding_cache
+                             (model TEXT,
+                              text_hash TEXT,
+                              embedding BLOB,
+                              PRIMARY KEY (model, text_hash))''')
+        self.conn.commit()
+
+    # Hash of the text used as cache key
+    @staticmethod
+    def hash_text(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    # Look up embeddings for the hashes, first in memory then on disk, missing ones are left out
+    def lookup(self, text_hashes):
+        found = {}
+        with self.lock:
+            for text_hash in text_hashes:
+                if text_hash in self.memory:
+                    self.memory.move_to_end(text_hash)
+                    found[text_hash] = self.memory[text_hash]
+            self.memory_hits += len(found)
+
+            on_disk = [text_hash for text_hash in text_hashes if text_hash not in found]
+            # sqlite limits the number of bound parameters, so query in slices
+            for start in range(0, len(on_disk), 500):
+                batch = on_disk[start:start + 500]
+                rows = self.conn.execute(
+                    f'SELECT text_hash, embedding FROM embedding_cache WHERE model = ? AND text_hash IN ({",".join("?" * len(batch))})',
+                    (self.model_name, *batch)).fetchall()
+                for text_hash, blob in rows:
+                    embedding = array('f', blob).tolist()
+                    found[text_hash] = embedding
+                    self.remember(text_hash, embedding)
+                    self.disk_hits += 1
+        return found
+
+    # Add an embedding to the in-memory LRU tier, evicting the least recently used ones
+    def remember(self, text_hash, embedding):
+        self.memory[text_hash] = embedding
+        self.memory.move_to_end(text_hash)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    # Write new embeddings to both tiers
+    def store(self, new_embeddings):
+        with self.lock:
+            self.conn.executemany('INSERT OR REPLACE INTO embedding_cache (model, text_hash, embedding) VALUES (?, ?, ?)',
+                                  [(self.model_name, text_hash, array('f', embedding).tobytes()) for text_hash, embedding in new_embeddings.items()])
+            self.conn.commit()
+            for text_hash, embedding in new_embeddings.items():
+                self.remember(text_hash, embedding)
+            self.misses += len(new_embeddings)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        text_hashes = [self.hash_text(text) for text in texts]
+        found = self.lookup(list(dict.fromkeys(text_hashes)))
+
+        # Embed each missing text only once even if it appears several times in the batch
+        missing = {}
+        for text, text_hash in zip(texts, text_hashes):
+            if text_hash not in found and text_hash not in missing:
+                missing[text_hash] = text
+        if missing:
+            with time_stage("embed"):
+                embeddings = self.embeddings.embed_documents(list(missing.values()))
+            embedded_texts.inc(len(missing))
+            new_embeddings = dict(zip(missing.keys(), embeddings))
+            self.store(new_embeddings)
+            found.update(new_embeddings)
+
+        return [found[text_hash] for text_hash in text_hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        text_hash = self.hash_text(text)
+        found = self.lookup([text_hash])
+        if text_hash in found:
+            return found[text_hash]
+
+        with time_stage("embed"):
+            embedding = self.embeddings.embed_query(text)
+        embedded_texts.inc()
+        self.store({text_hash: embedding})
+        return embedding
+
+    # Hit and miss counts of the cache
+    def stats(self):
+        with self.lock:
+            hits = self.memory_hits + self.disk_hits
+            total = hits + self.misses
+            return {"model": self.model_name,
+                    "memory_hits": self.memory_hits,
+                    "disk_hits": self.disk_hits,
+                    "misses": self.misses,
+                    "hit_rate": hits / total if total else 0.0,
+                    "memory_items": len(self.memory)}
+
+
+# LRU of query embeddings keyed by the query text, kept as float32 arrays in front of the embedding function,
+# so a repeated query skips hashing, the cache tiers of CachedEmbeddings and the conversion of the embedding
+class QueryEmbeddingCache:
+    def __init__(self, embeddings: Embeddings, max_items: int = 1024):
+        self.embeddings = embeddings
+        self.max_items = max_items
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def embed(self, query: str) -> np.ndarray:
+        with self.lock:
+            embedding = self.memory.get(query)
+            if embedding is not None:
+                self.memory.move_to_end(query)
+                self.hits += 1
+                return embedding
+
+        embedding = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        embedding.setflags(write=False)
+        with self.lock:
+            self.memory[query] = embedding
+            self.memory.move_to_end(query)
+            while len(self.memory) > self.max_items:
+                self.memory.popitem(last=False)
+            self.misses += 1
+        return embedding
+
+    # Hit and miss counts of the cache
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / total if total else 0.0,
+                    "items": len(self.memory)}
+
+
+# Semantic cache of final answers, keyed by the embedding of the standalone question and the model.
+# A lookup is a hit when a cached question of the same model is at least `threshold` cosine similar,
+# entries expire after `ttl` seconds and the least recently used ones are evicted above `max_entries`.
+class SemanticAnswerCache:
+    def __init__(self, threshold: float = 0.95, ttl: float = 3600, max_entries: int = 1000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.entry_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    # Unit length vector so the dot product is the cosine similarity
+    @staticmethod
+    def normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    # Find the cached answer closest to the question embedding, or None
+    def lookup(self, model: str, embedding):
+        query = self.normalize(embedding)
+        now = time.monotonic()
+        with self.lock:
+            for entry_id in [entry_id for entry_id, entry in self.entries.items() if now - entry["created_at"] > self.ttl]:
+                del self.entries[entry_id]
+
+            candidates = [(entry_id, entry) for entry_id, entry in self.entries.items() if entry["model"] == model]
+            if candidates:
+                similarities = np.stack([entry["vector"] for _, entry in candidates]) @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    entry_id, entry = candidates[best]
+                    self.entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return {"answer": entry["answer"], "sources": entry["sources"], "similarity": float(similarities[best])}
+
+            self.misses += 1
+            return None
+
+    # Cache an answer, it is dropped when the corpus changed since `version` was read
+    def add(self, model: str, embedding, answer: str, sources=None, version=None):
+        with self.lock:
+            if version is not None and version != self.version:
+                return
+            self.entries[next(self.entry_ids)] = {"model": model,
+                                                  "vector": self.normalize(embedding),
+                                                  "answer": answer,
+                                                  "sources": sources or [],
+                                                  "created_at": time.monotonic()}
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # Drop every cached answer, called whenever the corpus changes
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.version += 1
+
+    # Hit and miss counts of the cache
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / total if total else 0.0,
+                    "entries": len(self.entries),
+                    "version": self.version}
@@ -0,0 +1,60 @@
+# command line running a list of questions through /chat/batch of a running api server, e.g.
+#   python chat_batch.py ../documents/testquestions/question.txt --model gpt-4o-mini --concurrency 8
+# A .jsonl file gives one {"question": ..., "session_id": ...} item per line, any other file one question per line
+# ending with "?" (headings and blank lines are skipped). Answers are printed as they complete, then the summary.
+import argparse
+import json
+import sys
+
+import httpx
+
+
+def load_items(path):
+    with open(path, encoding="utf-8") as file:
+        lines = [line.strip() for line in file if line.strip()]
+    if path.endswith(".jsonl"):
+        return [json.loads(line) for line in lines]
+    return [{"question": line} for line in lines if line.endswith("?")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a list of questions with /chat/batch.")
+    parser.add_argument("questions")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--concurrency", type=int)
+    parser.add_argument("--k", type=int)
+    parser.add_argument("--shards", nargs="+")
+    parser.add_argument("--output", help="also write every event to this jsonl file")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    args = parser.parse_args()
+
+    items = load_items(args.questions)
+    if not items:
+        sys.exit(f"No questions found in {args.questions}")
+    request = {"items": items, "model": args.model, "concurrency": args.concurrency, "k": args.k, "shards": args.shards}
+    request = {name: value for name, value in request.items() if value is not None}
+
+    output = open(args.output, "w", encoding="utf-8") if args.output else None
+    try:
+        with httpx.stream("POST", f"{args.url}/chat/batch", json=request, timeout=args.timeout) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                if output:
+                    output.write(line + "\n")
+                event = json.loads(line)
+                if event["type"] == "result":
+                    print(f"[{event['index']}] {event['question']}{' (cached)' if event['cached'] else ''} {event['seconds']:.2f}s\n    {event['answer']}")
+                elif event["type"] == "error":
+                    print(f"[{event['index']}] {event['question']} failed: {event['detail']}")
+                else:
+                    print(json.dumps({key: value for key, value in event.items() if key != "type"}, indent=2))
+    finally:
+        if output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
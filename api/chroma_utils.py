@@ -1,103 +1,177 @@
-from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, UnstructuredHTMLLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings
-from langchain_chroma import Chroma
 from typing import List
 from langchain_core.documents import Document
-from dotenv import load_dotenv
+from cache_utils import CachedEmbeddings, SemanticAnswerCache, QueryEmbeddingCache
+from bm25_utils import BM25Index
+from model_utils import create_embeddings
+from metrics_utils import time_stage, chunks_processed
+from resource_utils import LazyResource
+from shard_utils import DEFAULT_COLLECTION
+from collections import defaultdict
+import threading
+import heapq
 import os
 import logging
-from datetime import datetime
+import asyncio
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from logging_utils import log_time
+
+
+# Embedding function for document and query (OpenAI or the fake one, see model_utils),
+# every call goes through the embedding cache first
+def create_embedding_function():
+    base_embeddings = create_embeddings()
+    return CachedEmbeddings(base_embeddings, model_name=base_embeddings.model)
+
+
+# Vector store backend: "chroma" (persistent Chroma) or "flat" (memory-mapped matrix, see flat_index_utils)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+FLAT_INDEX_DIR = os.getenv("FLAT_INDEX_DIR", "./flat_index")
+FLAT_INDEX_DTYPE = os.getenv("FLAT_INDEX_DTYPE", "float32") # float16 halves the size of the matrix for a small loss of precision
+
+
+# Initialize the vector store, chromadb is only imported here as importing it takes a while
+def create_vectorstore():
+    if VECTOR_BACKEND == "flat":
+        from flat_index_utils import FlatVectorStore
+        return FlatVectorStore(FLAT_INDEX_DIR, embedding_function.resolve(), collection_name=DEFAULT_COLLECTION, dtype=FLAT_INDEX_DTYPE)
 
-# set api key enviroment
-def load_openai_api_key():
-    load_dotenv()
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise ValueError("OPENAI_API_KEY is missing from environment variables")
-    return api_key
-
-# Initialize the OpenAI API key once to avoid multiple calls
-api_key = load_openai_api_key()
-os.environ["OPENAI_API_KEY"] = api_key
-
-# Setting up for logging our app's info
-logging.basicConfig(filename='app.log', level=logging.INFO)
-
-# Get log time
-def log_time():
-    return datetime.now().strftime("%d:%m:%Y %H:%M:%S")
-
-
-# Initialize text splitter to split documents into manageable chunks 
-text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200, length_function=len)
-
-# Embedding function for document
-embedding_function = OpenAIEmbeddings()
-
-# Initialize Chroma vector store
-vectorstore = Chroma(persist_directory="./chroma_db", embedding_function=embedding_function)
-
-# Supported file extensions
-SUPPORTED_EXTENSIONS = {
-    '.pdf': PyPDFLoader,
-    '.docx': Docx2txtLoader,
-    '.html': UnstructuredHTMLLoader,
-    '.htm': UnstructuredHTMLLoader
-}
-
-# Handles loading different document types and splitting them into chunks.
-def load_and_split_document(file_path: str) -> List[Document]:
-    file_extension = os.path.splitext(file_path)[-1].lower()
-    loader_class = SUPPORTED_EXTENSIONS.get(file_extension)
-    
-    if loader_class is None:
-        raise ValueError(f"Unsupported file type: {file_extension}")
-    
-    # bad code
-    # if file_path.endswith('.pdf'):
-    #     loader = PyPDFLoader(file_path)
-    # elif file_path.endswith('.docx'):
-    #     loader = Docx2txtLoader(file_path)
-    # elif file_path.endswith('.html') or file_path.endswith('.htm'):
-    #     loader = UnstructuredHTMLLoader(file_path)
-    # else:
-    #     raise ValueError(f"Unsupported file type: {file_path}")
-    
-    loader = loader_class(file_path)
-    
-    documents = loader.load()
-    return text_splitter.split_documents(documents)
-
-#  Takes a file path and a file ID to loads and splits the document, then adds metadata of file_id to each split to link vector store entries back to our database records, then adds these document chunks to our Chroma vector store.
-def index_document_to_chroma(file_path: str, file_id: int) -> bool:
-    try:
-        splits = load_and_split_document(file_path)
-
-        # Add metadata of file_id to each split
-        for split in splits:
-            split.metadata['file_id'] = file_id
-
-        # adds these document chunks to our Chroma vector store.
-        logging.info(f"Successfully indexed {len(splits)} document chunks from {file_path} with file_id {file_id} [{log_time()}]")
-        vectorstore.add_documents(splits)
-        return True
-    
-    except Exception as e:
-        # print(f"Error indexing document: {e}")
-        logging.error(f"Error indexing document {file_path} with file_id {file_id}: {str(e)} [{log_time()}]")
-        return False
-    
+    from langchain_chroma import Chroma
+    return Chroma(collection_name=DEFAULT_COLLECTION, persist_directory="./chroma_db", embedding_function=embedding_function.resolve())
+
+
+# Both are created on first use, the api warms them up in its lifespan hook
+embedding_function = LazyResource("embedding_function", create_embedding_function)
+vectorstore = LazyResource("vectorstore", create_vectorstore)
+
+# Embeddings of the latest queries, shared by the retriever and /search
+query_embeddings = QueryEmbeddingCache(embedding_function, max_items=int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "1024")))
+
+# Cache of final answers, it is invalidated whenever documents are indexed or deleted
+answer_cache = SemanticAnswerCache(threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95")),
+                                   ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+                                   max_entries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000")))
+
+# Lexical index over the same chunks, kept in sync by every write and delete below
+bm25_index = BM25Index()
+
+# Documents deleted but not yet purged from Chroma by the compaction, filtered out of every retrieval
+deleted_file_ids = set()
+
+# Bounded pool for the blocking parsing and vector store calls made from async handlers
+VECTORSTORE_WORKERS = int(os.getenv("VECTORSTORE_WORKERS", "8"))
+vectorstore_executor = ThreadPoolExecutor(max_workers=VECTORSTORE_WORKERS, thread_name_prefix="vectorstore")
+
+# Pool querying the shards of one search concurrently
+SHARD_SEARCH_WORKERS = int(os.getenv("SHARD_SEARCH_WORKERS", "8"))
+shard_executor = ThreadPoolExecutor(max_workers=SHARD_SEARCH_WORKERS, thread_name_prefix="shard")
+
+
+# The collections of the shards (see shard_utils), all in the client of the default vector store, Chroma or flat.
+# Searches fan out to the shards concurrently and the results are merged by distance.
+class ShardedCollections:
+    def __init__(self, vectorstore):
+        self.vectorstore = vectorstore
+        self.lock = threading.Lock()
+        self.collections = {}
+
+    # Collection of a shard, created on first use
+    def collection(self, name=None):
+        name = name or DEFAULT_COLLECTION
+        if name == DEFAULT_COLLECTION:
+            return self.vectorstore._collection
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = self.vectorstore._client.get_or_create_collection(name=name, embedding_function=None)
+            return self.collections[name]
+
+    # Names of the existing shards, only these are searched when no shard is given
+    def names(self):
+        names = {getattr(collection, "name", collection) for collection in self.vectorstore._client.list_collections()}
+        return sorted(names | {DEFAULT_COLLECTION})
+
+    # Collections to search: the given shards that exist, or all of them
+    def select(self, names=None):
+        existing = self.names()
+        return [self.collection(name) for name in existing if names is None or name in names]
+
+    # Runs the call on every collection, concurrently when there are several
+    def fan_out(self, collections, call):
+        if len(collections) == 1:
+            return [call(collections[0])]
+        return list(shard_executor.map(call, collections))
+
+    # Nearest chunks over the shards, in the format of Collection.query for a single query embedding
+    def query(self, query_embedding, n_results, include, names=None, where=None):
+        collections = self.select(names)
+        results = self.fan_out(collections, lambda collection: collection.query(query_embeddings=[query_embedding], n_results=n_results, where=where,
+                                                                                include=include + ["distances"]))
+        if len(results) == 1:
+            return results[0]
+
+        hits = [(distance, shard, index) for shard, result in enumerate(results) for index, distance in enumerate(result["distances"][0])]
+        best = heapq.nsmallest(n_results, hits)
+        return {field: [[results[shard][field][0][index] for _, shard, index in best]] for field in ["ids", "distances"] + include}
+
+    # Chunks by id over the shards, in the format of Collection.get
+    def get(self, ids, include, names=None):
+        merged = {field: [] for field in ["ids"] + include}
+        for result in self.fan_out(self.select(names), lambda collection: collection.get(ids=list(ids), include=include)):
+            for field in merged:
+                merged[field].extend(result[field])
+        return merged
+
+    # Deletes matching chunks in every shard
+    def delete(self, **kwargs):
+        self.fan_out(self.select(), lambda collection: collection.delete(**kwargs))
+
+
+shards = ShardedCollections(vectorstore)
+
+# Number of chunks embedded and written to Chroma at once
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "256"))
+
+# Embeds a batch of chunks through the embedding cache
+def embed_chunks(chunks: List[Document]) -> List[List[float]]:
+    return embedding_function.embed_documents([chunk.page_content for chunk in chunks])
+
+
+# Writes a batch of already embedded chunks to our Chroma vector store, returns their ids.
+# Every chunk goes to the shard named by its "shard" metadata, one write per shard.
+def add_chunks_to_chroma(chunks: List[Document], embeddings: List[List[float]]) -> List[str]:
+    ids = [str(uuid.uuid4()) for _ in chunks]
+    by_shard = defaultdict(list)
+    for index, chunk in enumerate(chunks):
+        by_shard[chunk.metadata.get("shard")].append(index)
+    with time_stage("chroma_write"):
+        for shard, indexes in by_shard.items():
+            shards.collection(shard).add(
+                ids=[ids[index] for index in indexes],
+                embeddings=[embeddings[index] for index in indexes],
+                metadatas=[chunks[index].metadata for index in indexes],
+                documents=[chunks[index].page_content for index in indexes],
+            )
+    bm25_index.add(ids, [chunk.page_content for chunk in chunks], [chunk.metadata for chunk in chunks])
+    chunks_processed.inc(len(ids), operation="indexed")
+    return ids
+
+
+# Deletes chunks by their Chroma ids from the shard they were written to
+def delete_chunks_from_chroma(ids: List[str], shard: str = None):
+    if ids:
+        with time_stage("chroma_delete"):
+            shards.collection(shard).delete(ids=ids)
+        bm25_index.remove(ids)
+        chunks_processed.inc(len(ids), operation="removed")
 
 # Deletes all document chunks by file_id from the Chroma vector store
 def delete_doc_from_chroma(file_id: int):
     try:
-        docs = vectorstore.get(where={"file_id": file_id})
-        # print(f"Found {len(docs['ids'])} document chunks for file_id {file_id}")
-        logging.info(f"Found {len(docs['ids'])} document chunks for file_id {file_id} [{log_time()}]")
-
-        vectorstore._collection.delete(where={"file_id": file_id})
-        print(f"Deleted all documents with file_id {file_id}")
+        with time_stage("chroma_delete"):
+            shards.delete(where={"file_id": file_id})
+        removed = bm25_index.remove_file(file_id)
+        chunks_processed.inc(removed, operation="removed")
+        answer_cache.invalidate()
         logging.info(f"Deleted all documents with file_id {file_id} [{log_time()}]")
 
         return True
@@ -105,4 +179,46 @@ def delete_doc_from_chroma(file_id: int):
     except Exception as e:
         # print(f"Error deleting document with file_id {file_id} from Chroma: {str(e)}")
         logging.error(f"Error deleting document chunks with file_id {file_id} from Chroma: {str(e)} [{log_time()}]")
-        return False
\ No newline at end of file
+        return False
+
+
+# Hide deleted documents from retrieval right away: they leave the lexical index and are filtered out
+# of vector search results until the compaction removes their chunks from Chroma
+def tombstone_files(file_ids: List[int]):
+    deleted_file_ids.update(file_ids)
+    removed = sum(bm25_index.remove_file(file_id) for file_id in file_ids)
+    chunks_processed.inc(removed, operation="removed")
+    answer_cache.invalidate()
+
+
+# Deletes the chunks of many files from Chroma with a single call per shard
+def delete_files_from_chroma(file_ids: List[int]):
+    if file_ids:
+        with time_stage("chroma_delete"):
+            shards.delete(where={"file_id": {"$in": list(file_ids)}})
+
+
+# Nearest chunks to the query without any ai model call, as (chunk id, document, score) from rank offset to offset + k.
+# The score is the cosine similarity, derived from Chroma's squared l2 distance as the embeddings are unit length.
+def search_chunks(query: str, k: int = 10, offset: int = 0, file_ids: List[int] = None, shard_names: List[str] = None):
+    with time_stage("search"):
+        # Chunks of deleted documents are filtered out by the vector store itself
+        deleted = set(deleted_file_ids)
+        if file_ids:
+            file_ids = sorted(set(file_ids) - deleted)
+            if not file_ids:
+                return []
+            where = {"file_id": {"$in": file_ids}}
+        else:
+            where = {"file_id": {"$nin": sorted(deleted)}} if deleted else None
+        query_embedding = query_embeddings.embed(query)
+        result = shards.query(query_embedding.tolist(), offset + k, ["documents", "metadatas"], shard_names, where)
+        hits = [(chunk_id, Document(page_content=text, metadata=metadata or {}), 1.0 - distance / 2)
+                for chunk_id, text, metadata, distance in zip(result["ids"][0], result["documents"][0], result["metadatas"][0], result["distances"][0])]
+        return hits[offset:offset + k]
+
+
+# Async version of search_chunks, runs on the bounded vector store pool
+async def asearch_chunks(query: str, k: int = 10, offset: int = 0, file_ids: List[int] = None, shard_names: List[str] = None):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(vectorstore_executor, search_chunks, query, k, offset, file_ids, shard_names)
@@ -0,0 +1,80 @@
+# batch document deletion: documents are tombstoned in sqlite and hidden from retrieval right away,
+# a background compaction then removes their chunks from Chroma and purges their rows in large batches
+from concurrent.futures import ThreadPoolExecutor
+from db_utils import tombstone_document_records, get_tombstoned_document_ids, purge_document_records
+from chroma_utils import tombstone_files, delete_files_from_chroma, deleted_file_ids
+import threading
+import time
+import os
+import logging
+from logging_utils import log_time
+
+
+# Documents purged per compaction batch, one Chroma delete and one sqlite transaction each
+COMPACTION_BATCH_SIZE = int(os.getenv("COMPACTION_BATCH_SIZE", "500"))
+
+# Seconds the compaction waits after a deletion, so a burst of deletions is compacted together
+COMPACTION_DELAY = float(os.getenv("COMPACTION_DELAY", "1.0"))
+
+# A single compaction runs at a time
+compaction_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="compaction")
+compaction_lock = threading.Lock()
+compaction_scheduled = False
+
+
+# Delete documents by file_id, returns the ids that existed. Their chunks stop being retrieved immediately
+# and are removed from Chroma by the background compaction.
+def delete_documents(file_ids):
+    deleted = tombstone_document_records(file_ids)
+    if deleted:
+        tombstone_files(deleted)
+        schedule_compaction()
+        logging.info(f"Tombstoned {len(deleted)} documents [{log_time()}]")
+    return deleted
+
+
+# Queue a compaction unless one is already waiting to start
+def schedule_compaction():
+    global compaction_scheduled
+    with compaction_lock:
+        if compaction_scheduled:
+            return
+        compaction_scheduled = True
+    compaction_executor.submit(run_compaction)
+
+
+# Remove the chunks of tombstoned documents from Chroma, then purge their rows, batch by batch.
+# A document stays tombstoned until both succeed, so an interrupted compaction is resumed on the next start.
+def run_compaction():
+    global compaction_scheduled
+    time.sleep(COMPACTION_DELAY)
+    with compaction_lock:
+        compaction_scheduled = False
+
+    start = time.perf_counter()
+    purged = 0
+    try:
+        while True:
+            file_ids = get_tombstoned_document_ids(COMPACTION_BATCH_SIZE)
+            if not file_ids:
+                break
+            delete_files_from_chroma(file_ids)
+            if purge_document_records(file_ids) is None:
+                break
+            deleted_file_ids.difference_update(file_ids)
+            purged += len(file_ids)
+
+        if purged:
+            logging.info(f"Compaction purged {purged} documents in {time.perf_counter() - start:.2f}s [{log_time()}]")
+
+    except Exception as e:
+        logging.error(f"Error compacting deleted documents: {str(e)} [{log_time()}]")
+
+
+# Hide the documents tombstoned by a previous run again and finish their compaction
+def resume_compaction():
+    file_ids = get_tombstoned_document_ids()
+    if file_ids:
+        tombstone_files(file_ids)
+        schedule_compaction()
+        logging.info(f"Resuming compaction of {len(file_ids)} deleted documents [{log_time()}]")
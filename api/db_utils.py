@@ -2,26 +2,156 @@
 import sqlite3
 from sqlite3 import Error
 import logging
+from metrics_utils import timed
+import aiosqlite
+import asyncio
+import threading
+import queue
+import json
+import os
 
 # Set database name
-DB_NAME = "langchainchatbot.db"
+DB_NAME = os.getenv("DB_NAME", "langchainchatbot.db")
 
-# Setting up for logging our app's info
-logging.basicConfig(filename='app.log', level=logging.INFO)
+# Number of connections kept open in each pool
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
 
-# Connection to database
+# Pragmas applied to every new connection, WAL lets readers run alongside the writer
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+)
+
+
+# sqlite connection that goes back to the pool on close() instead of closing,
+# so callers keep the usual connect / close pattern
+class PooledConnection(sqlite3.Connection):
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+        release_db_connection(self)
+
+    def really_close(self):
+        super().close()
+
+
+db_pool = queue.LifoQueue()
+db_pool_lock = threading.Lock()
+db_pool_created = 0
+
+
+# Open a new connection with our pragmas
+def open_db_connection():
+    conn = sqlite3.connect(DB_NAME, factory=PooledConnection, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+# Give a connection back to the pool
+def release_db_connection(conn):
+    db_pool.put(conn)
+
+
+# Close every pooled connection, e.g. on shutdown
+def close_db_pool():
+    global db_pool_created
+    while True:
+        try:
+            db_pool.get_nowait().really_close()
+        except queue.Empty:
+            break
+    with db_pool_lock:
+        db_pool_created = 0
+
+
+# Connection to database, taken from the pool (or opened while the pool is not full)
 def get_db_connection():
+    global db_pool_created
+    init_db()
     try:
-        conn = sqlite3.connect(DB_NAME)
-        conn.row_factory = sqlite3.Row
-        return conn
+        try:
+            return db_pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        with db_pool_lock:
+            can_open = db_pool_created < DB_POOL_SIZE
+            if can_open:
+                db_pool_created += 1
+        if can_open:
+            try:
+                return open_db_connection()
+            except Error:
+                with db_pool_lock:
+                    db_pool_created -= 1
+                raise
+        return db_pool.get(timeout=30)
     
-    except Error as e:
+    except (Error, queue.Empty) as e:
         # print(f"Error connecting to database: {e}")
         logging.error(f"Error connecting to database: {e}")
         return None
 
 
+# Pool of async connections, used by the request handlers so they don't block the event loop
+async_db_pool = []
+async_db_pool_available = None
+
+
+# Async connection to database, taken from the async pool, give it back with release_async_db_connection
+async def get_async_db_connection():
+    global async_db_pool_available
+    init_db()
+    try:
+        if async_db_pool_available is None:
+            async_db_pool_available = asyncio.Semaphore(DB_POOL_SIZE)
+        await async_db_pool_available.acquire()
+        if async_db_pool:
+            return async_db_pool.pop()
+
+        try:
+            conn = await aiosqlite.connect(DB_NAME)
+            conn.row_factory = sqlite3.Row
+            for pragma in DB_PRAGMAS:
+                await conn.execute(pragma)
+            return conn
+        except Exception:
+            async_db_pool_available.release()
+            raise
+
+    except Error as e:
+        logging.error(f"Error connecting to database: {e}")
+        return None
+
+
+# Give an async connection back to the pool
+async def release_async_db_connection(conn):
+    if conn.in_transaction:
+        await conn.rollback()
+    async_db_pool.append(conn)
+    async_db_pool_available.release()
+
+
+# Close every pooled async connection, e.g. on shutdown
+async def close_async_db_pool():
+    while async_db_pool:
+        await async_db_pool.pop().close()
+
+
+# Add the columns missing from a table created by an older version of the app
+def add_missing_columns(conn, table, columns):
+    existing = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+    for column, definition in columns.items():
+        if column not in existing:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
 # Create table to stores chat history and model responses into database
 def create_application_logs():
     conn = None
@@ -46,6 +176,55 @@ def create_application_logs():
             conn.close()
 
 
+# Create table to stores the rolling summary of the older turns of each chat session
+def create_session_summaries():
+    conn = None
+    try:
+        conn = get_db_connection()
+        if conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS session_summaries
+                            (session_id TEXT PRIMARY KEY,
+                             summary TEXT,
+                             summarized_until INTEGER DEFAULT 0,
+                             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+            conn.commit()
+
+    except Error as e:
+        logging.error(f"Error creating session_summaries table: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+
+# Create table to stores where the turns of archived chat sessions went: one gzip member of an archive file per session and run
+def create_archived_sessions():
+    conn = None
+    try:
+        conn = get_db_connection()
+        if conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS archived_sessions
+                            (session_id TEXT,
+                             path TEXT,
+                             offset INTEGER,
+                             length INTEGER,
+                             turns INTEGER,
+                             first_id INTEGER,
+                             last_id INTEGER,
+                             first_at TIMESTAMP,
+                             last_at TIMESTAMP,
+                             archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_archived_sessions_session ON archived_sessions (session_id, first_id)')
+            conn.commit()
+
+    except Error as e:
+        logging.error(f"Error creating archived_sessions table: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+
 # Create table to stores records of uploaded documents.
 def create_document_store():
     conn = None
@@ -55,7 +234,13 @@ def create_document_store():
             conn.execute('''CREATE TABLE IF NOT EXISTS document_store
                             (id INTEGER PRIMARY KEY AUTOINCREMENT,
                              filename TEXT,
+                             content_hash TEXT,
                              upload_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+            # shard is the tenant or tag the document was uploaded for, it decides its vector collection (see shard_utils)
+            add_missing_columns(conn, 'document_store', {'content_hash': 'TEXT', 'deleted_at': 'TIMESTAMP', 'shard': 'TEXT'})
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_document_store_content_hash ON document_store (content_hash)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_document_store_filename ON document_store (filename)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_document_store_deleted_at ON document_store (deleted_at) WHERE deleted_at IS NOT NULL')
             conn.commit()
             
     except Error as e:
@@ -65,9 +250,75 @@ def create_document_store():
     finally:
         if conn:
             conn.close()
-    
+
+
+# Create table to stores the hash and Chroma id of every chunk of a document, used to re-index only changed chunks
+def create_document_chunks():
+    conn = None
+    try:
+        conn = get_db_connection()
+        if conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS document_chunks
+                            (chroma_id TEXT PRIMARY KEY,
+                             file_id INTEGER,
+                             chunk_hash TEXT)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_document_chunks_file_id ON document_chunks (file_id)')
+            conn.commit()
+
+    except Error as e:
+        logging.error(f"Error creating document_chunks table: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+
+# Create table to stores background ingestion jobs, so they survive a server restart
+def create_ingestion_jobs():
+    conn = None
+    try:
+        conn = get_db_connection()
+        if conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS ingestion_jobs
+                            (id TEXT PRIMARY KEY,
+                             filename TEXT,
+                             staged_path TEXT,
+                             status TEXT,
+                             stage TEXT,
+                             file_id INTEGER,
+                             content_hash TEXT,
+                             chunk_count INTEGER DEFAULT 0,
+                             chunks_indexed INTEGER DEFAULT 0,
+                             chunks_reused INTEGER DEFAULT 0,
+                             chunks_removed INTEGER DEFAULT 0,
+                             timings TEXT DEFAULT '{}',
+                             pages_loaded INTEGER DEFAULT 0,
+                             total_pages INTEGER,
+                             kind TEXT DEFAULT 'document',
+                             result TEXT,
+                             error TEXT,
+                             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+            add_missing_columns(conn, 'ingestion_jobs', {'content_hash': 'TEXT',
+                                                         'chunks_reused': 'INTEGER DEFAULT 0',
+                                                         'chunks_removed': 'INTEGER DEFAULT 0',
+                                                         'shard': 'TEXT',
+                                                         'pages_loaded': 'INTEGER DEFAULT 0',
+                                                         'total_pages': 'INTEGER',
+                                                         'kind': "TEXT DEFAULT 'document'",
+                                                         'result': 'TEXT'})
+            conn.commit()
+
+    except Error as e:
+        logging.error(f"Error creating ingestion_jobs table: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
     
 # Insert chat logs into application_logs table
+@timed("sqlite_write")
 def insert_application_logs(session_id, user_query, gpt_response, model):
     conn = None
     try:
@@ -87,6 +338,7 @@ def insert_application_logs(session_id, user_query, gpt_response, model):
 
 
 # Get chat history from application_logs table
+@timed("sqlite_read")
 def get_chat_history(session_id):
     conn = None
     messages = []
@@ -113,15 +365,113 @@ def get_chat_history(session_id):
     return messages
 
 
+# Get the sessions whose last turn is older than cutoff (a UTC "YYYY-MM-DD HH:MM:SS" timestamp), at most `limit` of them
+@timed("sqlite_read")
+def get_expired_sessions(cutoff, limit):
+    conn = None
+    session_ids = []
+    try:
+        conn = get_db_connection()
+        if conn:
+            rows = conn.execute('SELECT session_id FROM application_logs GROUP BY session_id HAVING MAX(created_at) < ? LIMIT ?', (cutoff, limit))
+            session_ids = [row['session_id'] for row in rows.fetchall()]
+
+    except Error as e:
+        logging.error(f"Error retrieving expired chat sessions: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+    return session_ids
+
+
+# Get every turn of the given sessions as dicts, grouped by session and oldest first
+@timed("sqlite_read")
+def get_session_logs(session_ids):
+    conn = None
+    rows = []
+    try:
+        conn = get_db_connection()
+        if conn:
+            for start in range(0, len(session_ids), SQL_BATCH_SIZE):
+                batch = session_ids[start:start + SQL_BATCH_SIZE]
+                cursor = conn.execute(f'''SELECT id, session_id, user_query, gpt_response, model, created_at FROM application_logs
+                                         WHERE session_id IN ({",".join("?" * len(batch))}) ORDER BY session_id, id''', batch)
+                rows.extend(dict(row) for row in cursor.fetchall())
+
+    except Error as e:
+        rows = []
+        logging.error(f"Error retrieving chat sessions: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+    return rows
+
+
+# Record where archived sessions went and remove their turns from application_logs in a single transaction.
+# Only the archived turns (id <= last_id) are removed, a turn added meanwhile stays. Returns False on error.
+@timed("sqlite_write")
+def archive_session_logs(entries):
+    conn = None
+    archived = False
+    try:
+        conn = get_db_connection()
+        if conn:
+            with conn:
+                conn.executemany('''INSERT INTO archived_sessions (session_id, path, offset, length, turns, first_id, last_id, first_at, last_at)
+                                    VALUES (:session_id, :path, :offset, :length, :turns, :first_id, :last_id, :first_at, :last_at)''', entries)
+                conn.executemany('DELETE FROM application_logs WHERE session_id = :session_id AND id <= :last_id', entries)
+            archived = True
+
+    except Error as e:
+        logging.error(f"Error archiving chat sessions: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+    return archived
+
+
+# Rebuild the database file when at least min_free_ratio of its pages are free, then truncate the WAL.
+# Returns True when it was rebuilt.
+@timed("sqlite_write")
+def vacuum_db(min_free_ratio):
+    conn = None
+    vacuumed = False
+    try:
+        conn = get_db_connection()
+        if conn:
+            page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+            freelist_count = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if page_count and freelist_count / page_count >= min_free_ratio:
+                conn.execute('VACUUM')
+                vacuumed = True
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    except Error as e:
+        logging.error(f"Error vacuuming database: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+    return vacuumed
+
+
 # Inserting new document records into document_store table
-def insert_document_record(filename):
+@timed("sqlite_write")
+def insert_document_record(filename, content_hash=None, shard=None):
     conn = None
     file_id = None
     try:
         conn = get_db_connection()
         if conn:
             cursor = conn.cursor()
-            cursor.execute('INSERT INTO document_store (filename) VALUES (?)', (filename,))
+            cursor.execute('INSERT INTO document_store (filename, content_hash, shard) VALUES (?, ?, ?)', (filename, content_hash, shard))
             file_id = cursor.lastrowid
             conn.commit()
             
@@ -135,14 +485,61 @@ def insert_document_record(filename):
     return file_id
 
 
+# Inserting many document records in a single transaction, returns their ids in the same order
+@timed("sqlite_write")
+def insert_document_records(filenames, content_hashes=None, shard=None):
+    conn = None
+    file_ids = []
+    content_hashes = content_hashes or [None] * len(filenames)
+    try:
+        conn = get_db_connection()
+        if conn:
+            with conn:
+                cursor = conn.cursor()
+                for filename, content_hash in zip(filenames, content_hashes):
+                    cursor.execute('INSERT INTO document_store (filename, content_hash, shard) VALUES (?, ?, ?)', (filename, content_hash, shard))
+                    file_ids.append(cursor.lastrowid)
+
+    except Error as e:
+        file_ids = []
+        logging.error(f"Error inserting document records: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+    return file_ids
+
+
+# Deleting many document records from document_store table in a single transaction
+@timed("sqlite_write")
+def delete_document_records(file_ids):
+    conn = None
+    try:
+        conn = get_db_connection()
+        if conn:
+            with conn:
+                conn.executemany('DELETE FROM document_store WHERE id = ?', [(file_id,) for file_id in file_ids])
+                conn.executemany('DELETE FROM document_chunks WHERE file_id = ?', [(file_id,) for file_id in file_ids])
+
+    except Error as e:
+        logging.error(f"Error deleting document records: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+    return True
+
 
 # Deleting document records from document_store table
+@timed("sqlite_write")
 def delete_document_record(file_id):
     conn = None
     try:
         conn = get_db_connection()
         if conn:
             conn.execute('DELETE FROM document_store WHERE id = ?', (file_id,))
+            conn.execute('DELETE FROM document_chunks WHERE file_id = ?', (file_id,))
             conn.commit()
             
     except Error as e:
@@ -156,7 +553,212 @@ def delete_document_record(file_id):
     return True
 
 
+# Largest number of ids bound in one IN (...) query
+SQL_BATCH_SIZE = 500
+
+
+# Mark documents as deleted in a single transaction, returns the ids that existed and were not deleted yet.
+# Their rows and chunks stay until the compaction purges them.
+@timed("sqlite_write")
+def tombstone_document_records(file_ids):
+    conn = None
+    tombstoned = []
+    file_ids = list(dict.fromkeys(file_ids))
+    try:
+        conn = get_db_connection()
+        if conn:
+            with conn:
+                for start in range(0, len(file_ids), SQL_BATCH_SIZE):
+                    batch = file_ids[start:start + SQL_BATCH_SIZE]
+                    placeholders = ",".join("?" * len(batch))
+                    rows = conn.execute(f'SELECT id FROM document_store WHERE deleted_at IS NULL AND id IN ({placeholders})', batch).fetchall()
+                    conn.execute(f'UPDATE document_store SET deleted_at = CURRENT_TIMESTAMP WHERE deleted_at IS NULL AND id IN ({placeholders})', batch)
+                    tombstoned.extend(row['id'] for row in rows)
+
+    except Error as e:
+        tombstoned = []
+        logging.error(f"Error tombstoning document records: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+    return tombstoned
+
+
+# Get the ids of deleted documents that are not purged yet, oldest first
+@timed("sqlite_read")
+def get_tombstoned_document_ids(limit=None):
+    conn = None
+    file_ids = []
+    try:
+        conn = get_db_connection()
+        if conn:
+            query = 'SELECT id FROM document_store WHERE deleted_at IS NOT NULL ORDER BY deleted_at, id'
+            rows = conn.execute(query + ' LIMIT ?', (limit,)) if limit else conn.execute(query)
+            file_ids = [row['id'] for row in rows.fetchall()]
+
+    except Error as e:
+        logging.error(f"Error retrieving tombstoned documents: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+    return file_ids
+
+
+# Remove the rows and chunk rows of deleted documents in a single transaction, returns the number of chunk rows removed or None on error
+@timed("sqlite_write")
+def purge_document_records(file_ids):
+    conn = None
+    removed = None
+    try:
+        conn = get_db_connection()
+        if conn:
+            with conn:
+                removed = 0
+                for start in range(0, len(file_ids), SQL_BATCH_SIZE):
+                    batch = file_ids[start:start + SQL_BATCH_SIZE]
+                    placeholders = ",".join("?" * len(batch))
+                    removed += conn.execute(f'DELETE FROM document_chunks WHERE file_id IN ({placeholders})', batch).rowcount
+                    conn.execute(f'DELETE FROM document_store WHERE deleted_at IS NOT NULL AND id IN ({placeholders})', batch)
+
+    except Error as e:
+        removed = None
+        logging.error(f"Error purging document records: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+    return removed
+
+
+# Find a document record by the hash of its content in the same shard (tenant or tag), used to skip identical uploads
+@timed("sqlite_read")
+def get_document_by_hash(content_hash, shard=None):
+    conn = None
+    document = None
+    try:
+        conn = get_db_connection()
+        if conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT id, filename, content_hash, shard, upload_timestamp FROM document_store WHERE content_hash = ? AND shard IS ? AND deleted_at IS NULL ORDER BY id LIMIT 1', (content_hash, shard))
+            row = cursor.fetchone()
+            document = dict(row) if row else None
+
+    except Error as e:
+        logging.error(f"Error retrieving document by hash: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+    return document
+
+
+# Find the latest document record with the given filename in the same shard (tenant or tag), used to re-index a changed upload
+@timed("sqlite_read")
+def get_document_by_filename(filename, shard=None):
+    conn = None
+    document = None
+    try:
+        conn = get_db_connection()
+        if conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT id, filename, content_hash, shard, upload_timestamp FROM document_store WHERE filename = ? AND shard IS ? AND deleted_at IS NULL ORDER BY id DESC LIMIT 1', (filename, shard))
+            row = cursor.fetchone()
+            document = dict(row) if row else None
+
+    except Error as e:
+        logging.error(f"Error retrieving document by filename: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+    return document
+
+
+# Set the content hash of a document once all its chunks are indexed
+@timed("sqlite_write")
+def update_document_hash(file_id, content_hash):
+    conn = None
+    try:
+        conn = get_db_connection()
+        if conn:
+            conn.execute('UPDATE document_store SET content_hash = ?, upload_timestamp = CURRENT_TIMESTAMP WHERE id = ?', (content_hash, file_id))
+            conn.commit()
+
+    except Error as e:
+        logging.error(f"Error updating document hash: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+
+# Get the (chroma_id, chunk_hash) of every indexed chunk of a document
+@timed("sqlite_read")
+def get_document_chunks(file_id):
+    conn = None
+    chunks = []
+    try:
+        conn = get_db_connection()
+        if conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT chroma_id, chunk_hash FROM document_chunks WHERE file_id = ?', (file_id,))
+            chunks = [(row['chroma_id'], row['chunk_hash']) for row in cursor.fetchall()]
+
+    except Error as e:
+        logging.error(f"Error retrieving document chunks: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+    return chunks
+
+
+# Record indexed chunks as (chroma_id, file_id, chunk_hash) rows in a single transaction
+@timed("sqlite_write")
+def insert_document_chunks(rows):
+    conn = None
+    try:
+        conn = get_db_connection()
+        if conn:
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO document_chunks (chroma_id, file_id, chunk_hash) VALUES (?, ?, ?)', rows)
+
+    except Error as e:
+        logging.error(f"Error inserting document chunks: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+
+# Forget chunks that were removed from Chroma
+@timed("sqlite_write")
+def delete_document_chunks(chroma_ids):
+    conn = None
+    try:
+        conn = get_db_connection()
+        if conn:
+            with conn:
+                conn.executemany('DELETE FROM document_chunks WHERE chroma_id = ?', [(chroma_id,) for chroma_id in chroma_ids])
+
+    except Error as e:
+        logging.error(f"Error deleting document chunks: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+
 # Get all document records from document_store table for listing
+@timed("sqlite_read")
 def get_all_documents():
     conn = None
     documents = []
@@ -164,7 +766,7 @@ def get_all_documents():
         conn = get_db_connection()
         if conn:
             cursor = conn.cursor()
-            cursor.execute('SELECT id, filename, upload_timestamp FROM document_store ORDER BY upload_timestamp DESC')
+            cursor.execute('SELECT id, filename, upload_timestamp FROM document_store WHERE deleted_at IS NULL ORDER BY upload_timestamp DESC')
             documents = cursor.fetchall()
             
     except Error as e:
@@ -178,6 +780,395 @@ def get_all_documents():
     return [dict(doc) for doc in documents]
 
 
-# Initialize the database tables
-create_application_logs()
-create_document_store()
\ No newline at end of file
+# Async version of insert_application_logs
+@timed("sqlite_write")
+async def ainsert_application_logs(session_id, user_query, gpt_response, model):
+    conn = None
+    try:
+        conn = await get_async_db_connection()
+        if conn:
+            await conn.execute('INSERT INTO application_logs (session_id, user_query, gpt_response, model) VALUES (?, ?, ?, ?)',
+                               (session_id, user_query, gpt_response, model))
+            await conn.commit()
+
+    except Error as e:
+        logging.error(f"Error inserting application logs: {e}")
+
+    finally:
+        if conn:
+            await release_async_db_connection(conn)
+
+
+# Get the latest `limit` turns of a session as rows (id, user_query, gpt_response), oldest first
+@timed("sqlite_read")
+async def aget_recent_chat_rows(session_id, limit):
+    conn = None
+    rows = []
+    try:
+        conn = await get_async_db_connection()
+        if conn:
+            async with conn.execute('SELECT id, user_query, gpt_response FROM application_logs WHERE session_id = ? ORDER BY created_at DESC, id DESC LIMIT ?', (session_id, limit)) as cursor:
+                rows = [dict(row) for row in await cursor.fetchall()]
+
+    except Error as e:
+        logging.error(f"Error retrieving recent chat history: {e}")
+
+    finally:
+        if conn:
+            await release_async_db_connection(conn)
+
+    return rows[::-1]
+
+
+# Get the turns of a session with after_id < id < before_id, oldest first, at most `limit` of them
+@timed("sqlite_read")
+async def aget_chat_rows_between(session_id, after_id, before_id, limit):
+    conn = None
+    rows = []
+    try:
+        conn = await get_async_db_connection()
+        if conn:
+            async with conn.execute('SELECT id, user_query, gpt_response FROM application_logs WHERE session_id = ? AND id > ? AND id < ? ORDER BY id LIMIT ?',
+                                    (session_id, after_id, before_id, limit)) as cursor:
+                rows = [dict(row) for row in await cursor.fetchall()]
+
+    except Error as e:
+        logging.error(f"Error retrieving chat history: {e}")
+
+    finally:
+        if conn:
+            await release_async_db_connection(conn)
+
+    return rows
+
+
+# Get the turns of a session still in application_logs with id > after_id, oldest first, at most `limit` of them
+@timed("sqlite_read")
+async def aget_chat_log_page(session_id, after_id, limit):
+    conn = None
+    rows = []
+    try:
+        conn = await get_async_db_connection()
+        if conn:
+            async with conn.execute('''SELECT id, user_query, gpt_response, model, created_at FROM application_logs
+                                      WHERE session_id = ? AND id > ? ORDER BY id LIMIT ?''', (session_id, after_id, limit)) as cursor:
+                rows = [dict(row) for row in await cursor.fetchall()]
+
+    except Error as e:
+        logging.error(f"Error retrieving chat history page: {e}")
+
+    finally:
+        if conn:
+            await release_async_db_connection(conn)
+
+    return rows
+
+
+# Get the archive members of a session with turns after after_id, oldest first
+@timed("sqlite_read")
+async def aget_archived_sessions(session_id, after_id=0):
+    conn = None
+    entries = []
+    try:
+        conn = await get_async_db_connection()
+        if conn:
+            async with conn.execute('''SELECT path, offset, length, turns, first_id, last_id FROM archived_sessions
+                                      WHERE session_id = ? AND last_id > ? ORDER BY first_id''', (session_id, after_id)) as cursor:
+                entries = [dict(row) for row in await cursor.fetchall()]
+
+    except Error as e:
+        logging.error(f"Error retrieving archived chat sessions: {e}")
+
+    finally:
+        if conn:
+            await release_async_db_connection(conn)
+
+    return entries
+
+
+# Get the rolling summary of a session as (summary, id of the last summarized turn)
+@timed("sqlite_read")
+async def aget_session_summary(session_id):
+    conn = None
+    summary = ("", 0)
+    try:
+        conn = await get_async_db_connection()
+        if conn:
+            async with conn.execute('SELECT summary, summarized_until FROM session_summaries WHERE session_id = ?', (session_id,)) as cursor:
+                row = await cursor.fetchone()
+                if row:
+                    summary = (row['summary'], row['summarized_until'])
+
+    except Error as e:
+        logging.error(f"Error retrieving session summary: {e}")
+
+    finally:
+        if conn:
+            await release_async_db_connection(conn)
+
+    return summary
+
+
+# Store the rolling summary of a session
+@timed("sqlite_write")
+async def aupsert_session_summary(session_id, summary, summarized_until):
+    conn = None
+    try:
+        conn = await get_async_db_connection()
+        if conn:
+            await conn.execute('''INSERT INTO session_summaries (session_id, summary, summarized_until) VALUES (?, ?, ?)
+                                  ON CONFLICT(session_id) DO UPDATE SET summary = excluded.summary,
+                                  summarized_until = excluded.summarized_until, updated_at = CURRENT_TIMESTAMP''',
+                               (session_id, summary, summarized_until))
+            await conn.commit()
+
+    except Error as e:
+        logging.error(f"Error storing session summary: {e}")
+
+    finally:
+        if conn:
+            await release_async_db_connection(conn)
+
+
+# Async version of get_document_by_hash
+@timed("sqlite_read")
+async def aget_document_by_hash(content_hash, shard=None):
+    conn = None
+    document = None
+    try:
+        conn = await get_async_db_connection()
+        if conn:
+            async with conn.execute('SELECT id, filename, content_hash, shard, upload_timestamp FROM document_store WHERE content_hash = ? AND shard IS ? AND deleted_at IS NULL ORDER BY id LIMIT 1',
+                                    (content_hash, shard)) as cursor:
+                row = await cursor.fetchone()
+                document = dict(row) if row else None
+
+    except Error as e:
+        logging.error(f"Error retrieving document by hash: {e}")
+
+    finally:
+        if conn:
+            await release_async_db_connection(conn)
+
+    return document
+
+
+# Async version of get_all_documents
+@timed("sqlite_read")
+async def aget_all_documents():
+    conn = None
+    documents = []
+    try:
+        conn = await get_async_db_connection()
+        if conn:
+            async with conn.execute('SELECT id, filename, upload_timestamp FROM document_store WHERE deleted_at IS NULL ORDER BY upload_timestamp DESC') as cursor:
+                documents = await cursor.fetchall()
+
+    except Error as e:
+        logging.error(f"Error retrieving documents: {e}")
+
+    finally:
+        if conn:
+            await release_async_db_connection(conn)
+
+    return [dict(doc) for doc in documents]
+
+
+# Filenames of the given documents as {file_id: filename}, used to label search results
+@timed("sqlite_read")
+async def aget_document_filenames(file_ids):
+    conn = None
+    filenames = {}
+    file_ids = list(dict.fromkeys(file_ids))
+    try:
+        conn = await get_async_db_connection()
+        if conn:
+            for start in range(0, len(file_ids), SQL_BATCH_SIZE):
+                batch = file_ids[start:start + SQL_BATCH_SIZE]
+                async with conn.execute(f'SELECT id, filename FROM document_store WHERE id IN ({",".join("?" * len(batch))})', batch) as cursor:
+                    filenames.update((row['id'], row['filename']) for row in await cursor.fetchall())
+
+    except Error as e:
+        logging.error(f"Error retrieving document filenames: {e}")
+
+    finally:
+        if conn:
+            await release_async_db_connection(conn)
+
+    return filenames
+
+
+# Turn an ingestion_jobs row into a dict with its timings decoded
+def ingestion_job_to_dict(row):
+    job = dict(row)
+    job['timings'] = json.loads(job['timings'] or '{}')
+    job['result'] = json.loads(job['result']) if job.get('result') else None
+    return job
+
+
+# Inserting a new queued job into ingestion_jobs table, kind is document or bulk (many files staged in a directory)
+@timed("sqlite_write")
+def insert_ingestion_job(job_id, filename, staged_path, content_hash=None, shard=None, kind='document'):
+    conn = None
+    try:
+        conn = get_db_connection()
+        if conn:
+            conn.execute("INSERT INTO ingestion_jobs (id, filename, staged_path, content_hash, shard, kind, status, stage) VALUES (?, ?, ?, ?, ?, ?, 'queued', 'queued')",
+                         (job_id, filename, staged_path, content_hash, shard, kind))
+            conn.commit()
+
+    except Error as e:
+        logging.error(f"Error inserting ingestion job: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+    return job_id
+
+
+# Update the given columns of an ingestion job, timings and result are stored as json
+@timed("sqlite_write")
+def update_ingestion_job(job_id, **fields):
+    conn = None
+    for column in ('timings', 'result'):
+        if column in fields:
+            fields[column] = json.dumps(fields[column])
+    try:
+        conn = get_db_connection()
+        if conn:
+            assignments = ", ".join(f"{column} = ?" for column in fields)
+            conn.execute(f'UPDATE ingestion_jobs SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+                         (*fields.values(), job_id))
+            conn.commit()
+
+    except Error as e:
+        logging.error(f"Error updating ingestion job {job_id}: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+
+# Get one ingestion job from ingestion_jobs table
+@timed("sqlite_read")
+def get_ingestion_job(job_id):
+    conn = None
+    job = None
+    try:
+        conn = get_db_connection()
+        if conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM ingestion_jobs WHERE id = ?', (job_id,))
+            row = cursor.fetchone()
+            if row:
+                job = ingestion_job_to_dict(row)
+
+    except Error as e:
+        logging.error(f"Error retrieving ingestion job {job_id}: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+    return job
+
+
+# Async version of get_ingestion_job
+@timed("sqlite_read")
+async def aget_ingestion_job(job_id):
+    conn = None
+    job = None
+    try:
+        conn = await get_async_db_connection()
+        if conn:
+            async with conn.execute('SELECT * FROM ingestion_jobs WHERE id = ?', (job_id,)) as cursor:
+                row = await cursor.fetchone()
+                if row:
+                    job = ingestion_job_to_dict(row)
+
+    except Error as e:
+        logging.error(f"Error retrieving ingestion job {job_id}: {e}")
+
+    finally:
+        if conn:
+            await release_async_db_connection(conn)
+
+    return job
+
+
+# Get the jobs that were queued or running, used to resume them after a restart
+def get_unfinished_ingestion_jobs(kind='document'):
+    conn = None
+    jobs = []
+    try:
+        conn = get_db_connection()
+        if conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM ingestion_jobs WHERE status IN ('queued', 'running') AND kind = ? ORDER BY created_at", (kind,))
+            jobs = [ingestion_job_to_dict(row) for row in cursor.fetchall()]
+
+    except Error as e:
+        logging.error(f"Error retrieving unfinished ingestion jobs: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+    return jobs
+
+
+# Schema migrations applied in order on existing databases, PRAGMA user_version stores how many already ran
+MIGRATIONS = [
+    # 1: chat history is looked up by session and sorted by time on every chat request
+    'CREATE INDEX IF NOT EXISTS idx_application_logs_session_created ON application_logs (session_id, created_at)',
+]
+
+
+# Apply the migrations the database has not seen yet
+def run_migrations():
+    conn = None
+    try:
+        conn = get_db_connection()
+        if conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+                with conn:
+                    conn.execute(migration)
+                conn.execute(f'PRAGMA user_version = {number}')
+                logging.info(f"Applied database migration {number}")
+
+    except Error as e:
+        logging.error(f"Error applying database migrations: {e}")
+
+    finally:
+        if conn:
+            conn.close()
+
+
+db_init_lock = threading.RLock()
+db_initialized = False
+db_initializing = False
+
+
+# Initialize the database tables and apply the migrations, once per process.
+# The api runs it in its lifespan hook, any other caller gets it with its first connection.
+def init_db():
+    global db_initialized, db_initializing
+    if db_initialized:
+        return
+    with db_init_lock:
+        # the create functions take connections themselves, which must not start the setup again
+        if db_initialized or db_initializing:
+            return
+        db_initializing = True
+        try:
+            create_application_logs()
+            create_session_summaries()
+            create_archived_sessions()
+            create_document_store()
+            create_document_chunks()
+            create_ingestion_jobs()
+            run_migrations()
+            db_initialized = True
+        finally:
+            db_initializing = False
\ No newline at end of file
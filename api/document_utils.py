@@ -0,0 +1,134 @@
+# loading, splitting and parsing of documents, kept free of vector store and api key setup
+# so it can be imported cheaply, e.g. by the worker processes of the bulk ingestion
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from typing import Iterator, List
+from langchain_core.documents import Document
+from metrics_utils import timed, stage_seconds
+import importlib
+import hashlib
+import time
+import os
+
+
+# Initialize text splitter to split documents into manageable chunks 
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, length_function=len)
+
+# Supported file extensions and the name of their loader in langchain_community.document_loaders,
+# the loaders are imported on first use so importing this module stays cheap
+SUPPORTED_EXTENSIONS = {
+    '.pdf': 'PyPDFLoader',
+    '.docx': 'Docx2txtLoader',
+    '.html': 'UnstructuredHTMLLoader',
+    '.htm': 'UnstructuredHTMLLoader'
+}
+
+# Loader for the file type of the path
+def get_loader(file_path: str):
+    file_extension = os.path.splitext(file_path)[-1].lower()
+    loader_name = SUPPORTED_EXTENSIONS.get(file_extension)
+    
+    if loader_name is None:
+        raise ValueError(f"Unsupported file type: {file_extension}")
+    
+    # bad code
+    # if file_path.endswith('.pdf'):
+    #     loader = PyPDFLoader(file_path)
+    # elif file_path.endswith('.docx'):
+    #     loader = Docx2txtLoader(file_path)
+    # elif file_path.endswith('.html') or file_path.endswith('.htm'):
+    #     loader = UnstructuredHTMLLoader(file_path)
+    # else:
+    #     raise ValueError(f"Unsupported file type: {file_path}")
+    
+    loader_class = getattr(importlib.import_module("langchain_community.document_loaders"), loader_name)
+    return loader_class(file_path)
+
+
+# Handles loading different document types.
+@timed("parse")
+def load_document(file_path: str) -> List[Document]:
+    return get_loader(file_path).load()
+
+
+# Splits loaded documents into chunks.
+@timed("split")
+def split_documents(documents: List[Document]) -> List[Document]:
+    return text_splitter.split_documents(documents)
+
+
+# Handles loading different document types and splitting them into chunks.
+def load_and_split_document(file_path: str) -> List[Document]:
+    return list(iter_document_chunks(file_path))
+
+
+# The pages of a PDF one at a time, with the text and metadata PyPDFLoader gives them (source, page, page_label, total_pages).
+# pypdf keeps every object it parsed until the reader is closed, about the size of the file by the last page,
+# they are dropped after each page here so only the page being read is held.
+def iter_pdf_pages(file_path: str) -> Iterator[Document]:
+    from pypdf import PdfReader
+    with open(file_path, "rb") as pdf:
+        reader = PdfReader(pdf)
+        page_labels = reader.page_labels
+        for number, page in enumerate(reader.pages):
+            text = page.extract_text().strip()
+            reader.resolved_objects.clear()
+            yield Document(page_content=text, metadata={"source": file_path, "total_pages": len(page_labels),
+                                                        "page": number, "page_label": page_labels[number]})
+
+
+# Streams the chunks of a document: pages are loaded lazily (one per PDF page) and split as they come,
+# so the document's pages and chunks are never held at once whatever the file size.
+# Seconds spent loading and splitting are added to timings['load'] and timings['split'] when given.
+# The pages loaded so far and the page count (PDFs only) are kept in progress['pages_loaded'] and progress['total_pages'].
+def iter_document_chunks(file_path: str, timings=None, progress=None) -> Iterator[Document]:
+    timings = timings if timings is not None else {}
+    progress = progress if progress is not None else {}
+    load_seconds = split_seconds = 0.0
+    if os.path.splitext(file_path)[-1].lower() == '.pdf':
+        pages = iter_pdf_pages(file_path)
+    else:
+        pages = get_loader(file_path).lazy_load()
+    while True:
+        start = time.perf_counter()
+        page = next(pages, None)
+        elapsed = time.perf_counter() - start
+        load_seconds += elapsed
+        timings['load'] = timings.get('load', 0.0) + elapsed
+        if page is None:
+            break
+        progress['pages_loaded'] = progress.get('pages_loaded', 0) + 1
+        progress['total_pages'] = page.metadata.get('total_pages')
+
+        start = time.perf_counter()
+        chunks = text_splitter.split_documents([page])
+        elapsed = time.perf_counter() - start
+        split_seconds += elapsed
+        timings['split'] = timings.get('split', 0.0) + elapsed
+        yield from chunks
+
+    stage_seconds.observe(load_seconds, stage="parse")
+    stage_seconds.observe(split_seconds, stage="split")
+
+
+# Hash of a chunk's text, used to find the chunks that changed between two versions of a document
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# Hash of a whole file's content, used to detect identical uploads
+def hash_file(file_path: str) -> str:
+    content_hash = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+# Loads, splits and hashes one file, returns (chunks, content_hash, error) so a bad file never raises inside a worker process
+def parse_document(file_path: str):
+    try:
+        return load_and_split_document(file_path), hash_file(file_path), None
+    except Exception as e:
+        return [], None, str(e)
@@ -0,0 +1,355 @@
+# in-process flat vector index, an alternative to Chroma for corpora up to a few hundred thousand chunks:
+# embeddings live in a memory-mapped float32 (or float16) matrix and a search is one vectorized pass of
+# dot products over it, opening a collection only reads its metadata sidecar.
+#   flat_index/<collection>/settings.json        dimension, dtype and generation of the files below
+#   flat_index/<collection>/vectors-<gen>.bin    row-major matrix, grown by doubling, only the first `count` rows are used
+#   flat_index/<collection>/documents-<gen>.bin  chunk texts, utf-8, back to back
+#   flat_index/<collection>/rows-<gen>.jsonl     one line per added row (id, text offset and length, norm, metadata)
+#                                                and one line per delete (row numbers), replayed on open
+# Deleted rows stay in the matrix until they outnumber the live ones, then the collection is rewritten
+# as the next generation. Collections answer the subset of the Chroma collection api the app uses
+# (add, get, query, delete), so ShardedCollections, the BM25 build and the HybridRetriever work on either backend.
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+from typing import List
+import numpy as np
+import threading
+import json
+import uuid
+import os
+
+# Rows scored per matrix product, a float16 matrix is converted block by block into a float32 buffer of this many rows
+FLAT_SCAN_BLOCK = int(os.getenv("FLAT_SCAN_BLOCK", "4096"))
+
+# Deleted rows a collection keeps before it is rewritten, when they also outnumber the live rows
+FLAT_COMPACT_MIN_DELETED = int(os.getenv("FLAT_COMPACT_MIN_DELETED", "1000"))
+
+# Rows the matrix file is first sized for
+FLAT_INITIAL_CAPACITY = 1024
+
+
+# Metadata filter of a where clause: {"key": value}, {"key": {"$in": [...]}} or {"key": {"$nin": [...]}},
+# as a list of (key, values, excluded), excluded when the values are the ones the key must not have
+def parse_where(where):
+    conditions = []
+    for key, condition in (where or {}).items():
+        if isinstance(condition, dict):
+            if len(condition) != 1 or not set(condition) <= {"$in", "$nin"}:
+                raise ValueError(f"Unsupported where operator in {condition}")
+            operator, values = next(iter(condition.items()))
+            conditions.append((key, list(values), operator == "$nin"))
+        else:
+            conditions.append((key, [condition], False))
+    return conditions
+
+
+def file_id_of(metadata):
+    file_id = (metadata or {}).get("file_id")
+    return file_id if isinstance(file_id, int) else -1
+
+
+class FlatCollection:
+    def __init__(self, directory, name, dtype="float32"):
+        self.name = name
+        self.directory = os.path.join(directory, name)
+        self.lock = threading.RLock()
+        os.makedirs(self.directory, exist_ok=True)
+        self.settings = {"dim": None, "dtype": np.dtype(dtype).name, "generation": 0}
+        if os.path.exists(self.path("settings.json")):
+            with open(self.path("settings.json")) as settings_file:
+                self.settings = json.load(settings_file)
+        self.dtype = np.dtype(self.settings["dtype"])
+        self.load()
+
+    @property
+    def dim(self):
+        return self.settings["dim"]
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def file(self, kind, generation=None):
+        extension = "jsonl" if kind == "rows" else "bin"
+        return self.path(f"{kind}-{self.settings['generation'] if generation is None else generation}.{extension}")
+
+    # Written to a temporary file then renamed, so a crash leaves the old or the new settings
+    def save_settings(self, **changes):
+        settings = dict(self.settings, **changes)
+        with open(self.path("settings.json.tmp"), "w") as settings_file:
+            json.dump(settings, settings_file)
+        os.replace(self.path("settings.json.tmp"), self.path("settings.json"))
+        self.settings = settings
+
+    # Replay the sidecar and map the matrix
+    def load(self):
+        self.ids, self.offsets, self.lengths, norms, self.metadatas, deleted = [], [], [], [], [], []
+        if os.path.exists(self.file("rows")):
+            with open(self.file("rows"), "r+b") as rows:
+                complete = 0
+                for line in rows:
+                    if not line.endswith(b"\n"):
+                        # Torn write of the last rows, their vectors and texts are ignored too. The partial line is
+                        # cut off, the next rows appended after it would otherwise be read as part of it
+                        rows.truncate(complete)
+                        break
+                    complete += len(line)
+                    row = json.loads(line)
+                    if "d" in row:
+                        deleted.extend(row["d"])
+                        continue
+                    self.ids.append(row["i"])
+                    self.offsets.append(row["o"])
+                    self.lengths.append(row["l"])
+                    norms.append(row["n"])
+                    self.metadatas.append(row["m"])
+        self.count = len(self.ids)
+        self.norms = np.asarray(norms, dtype=np.float32)
+        self.file_ids = np.fromiter((file_id_of(metadata) for metadata in self.metadatas), dtype=np.int64, count=self.count)
+        self.live = np.ones(self.count, dtype=bool)
+        self.live[deleted] = False
+        self.rows = {chunk_id: index for index, chunk_id in enumerate(self.ids) if self.live[index]}
+        self.documents_size = self.offsets[-1] + self.lengths[-1] if self.count else 0
+
+        self.vectors = None
+        self.capacity = 0
+        if self.dim and os.path.exists(self.file("vectors")):
+            self.capacity = os.path.getsize(self.file("vectors")) // (self.dim * self.dtype.itemsize)
+            self.vectors = np.memmap(self.file("vectors"), dtype=self.dtype, mode="r+", shape=(self.capacity, self.dim))
+        self.documents_fd = os.open(self.file("documents"), os.O_RDWR | os.O_CREAT)
+
+    def count_live(self):
+        return len(self.rows)
+
+    # Double the matrix file until `needed` rows fit, readers keep the mapping they already hold
+    def reserve(self, needed):
+        if needed <= self.capacity:
+            return
+        capacity = max(FLAT_INITIAL_CAPACITY, self.capacity)
+        while capacity < needed:
+            capacity *= 2
+        with open(self.file("vectors"), "ab") as vectors:
+            vectors.truncate(capacity * self.dim * self.dtype.itemsize)
+        self.vectors = np.memmap(self.file("vectors"), dtype=self.dtype, mode="r+", shape=(capacity, self.dim))
+        self.capacity = capacity
+
+    def add(self, ids, embeddings, metadatas=None, documents=None):
+        if not len(ids):
+            return
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        metadatas = [metadata or {} for metadata in (metadatas or [{}] * len(ids))]
+        encoded = [document.encode("utf-8") for document in (documents or [""] * len(ids))]
+        norms = np.linalg.norm(embeddings, axis=1).astype(np.float32)
+        with self.lock:
+            if self.dim is None:
+                self.save_settings(dim=int(embeddings.shape[1]))
+            # Adding an existing id replaces it
+            self.delete(ids=[chunk_id for chunk_id in ids if chunk_id in self.rows])
+            start = self.count
+            self.reserve(start + len(ids))
+            self.vectors[start:start + len(ids)] = embeddings
+            self.vectors.flush()
+            os.pwrite(self.documents_fd, b"".join(encoded), self.documents_size)
+
+            lines = []
+            offset = self.documents_size
+            for chunk_id, text, norm, metadata in zip(ids, encoded, norms, metadatas):
+                lines.append(json.dumps({"i": chunk_id, "o": offset, "l": len(text), "n": float(norm), "m": metadata}) + "\n")
+                self.ids.append(chunk_id)
+                self.offsets.append(offset)
+                self.lengths.append(len(text))
+                self.metadatas.append(metadata)
+                offset += len(text)
+            # The sidecar line is what makes a row exist, so it is written last
+            with open(self.file("rows"), "a", encoding="utf-8") as rows:
+                rows.write("".join(lines))
+
+            self.documents_size = offset
+            self.norms = np.concatenate([self.norms, norms])
+            self.file_ids = np.concatenate([self.file_ids, np.fromiter((file_id_of(metadata) for metadata in metadatas), dtype=np.int64, count=len(ids))])
+            self.live = np.concatenate([self.live, np.ones(len(ids), dtype=bool)])
+            self.rows.update((chunk_id, start + index) for index, chunk_id in enumerate(ids))
+            self.count = start + len(ids)
+
+    # Live rows matching the where filter as a boolean mask, file_id is matched on its own array
+    def mask(self, where=None):
+        allowed = self.live[:self.count].copy()
+        for key, values, excluded in parse_where(where):
+            if key == "file_id":
+                allowed &= np.isin(self.file_ids[:self.count], values, invert=excluded)
+            else:
+                values = set(values)
+                allowed &= np.fromiter(((metadata.get(key) in values) != excluded for metadata in self.metadatas[:self.count]), dtype=bool, count=self.count)
+        return allowed
+
+    # Rows matching the ids and/or the where filter
+    def select(self, ids=None, where=None):
+        if ids is None:
+            return np.flatnonzero(self.mask(where)).tolist()
+        indexes = [self.rows[chunk_id] for chunk_id in ids if chunk_id in self.rows]
+        if where:
+            allowed = self.mask(where)
+            indexes = [index for index in indexes if allowed[index]]
+        return indexes
+
+    def delete(self, ids=None, where=None):
+        if ids is None and where is None:
+            return
+        with self.lock:
+            indexes = self.select(ids, where)
+            if not indexes:
+                return
+            with open(self.file("rows"), "a", encoding="utf-8") as rows:
+                rows.write(json.dumps({"d": indexes}) + "\n")
+            self.live[indexes] = False
+            for index in indexes:
+                self.rows.pop(self.ids[index], None)
+            deleted = self.count - len(self.rows)
+            if deleted >= FLAT_COMPACT_MIN_DELETED and deleted > len(self.rows):
+                self.compact()
+
+    # Rewrite the live rows as the next generation of files, then switch to it
+    def compact(self):
+        with self.lock:
+            generation = self.settings["generation"] + 1
+            indexes = np.flatnonzero(self.live[:self.count])
+            texts = [self.document(index).encode("utf-8") for index in indexes]
+            matrix = np.memmap(self.file("vectors", generation), dtype=self.dtype, mode="w+", shape=(max(len(indexes), 1), self.dim))
+            matrix[:len(indexes)] = self.vectors[indexes]
+            matrix.flush()
+            del matrix
+            with open(self.file("documents", generation), "wb") as documents:
+                documents.write(b"".join(texts))
+            with open(self.file("rows", generation), "w", encoding="utf-8") as rows:
+                offset = 0
+                for index, text in zip(indexes, texts):
+                    rows.write(json.dumps({"i": self.ids[index], "o": offset, "l": len(text), "n": float(self.norms[index]), "m": self.metadatas[index]}) + "\n")
+                    offset += len(text)
+
+            previous = self.settings["generation"]
+            self.save_settings(generation=generation)
+            os.close(self.documents_fd)
+            self.load()
+            for kind in ("vectors", "documents", "rows"):
+                os.remove(self.file(kind, previous))
+
+    def document(self, index):
+        if not self.lengths[index]:
+            return ""
+        return os.pread(self.documents_fd, self.lengths[index], self.offsets[index]).decode("utf-8")
+
+    def fields(self, indexes, include, vectors):
+        result = {"ids": [self.ids[index] for index in indexes]}
+        if "documents" in include:
+            result["documents"] = [self.document(index) for index in indexes]
+        if "metadatas" in include:
+            result["metadatas"] = [self.metadatas[index] for index in indexes]
+        if "embeddings" in include:
+            result["embeddings"] = np.asarray(vectors[indexes], dtype=np.float32) if len(indexes) else np.zeros((0, self.dim or 0), dtype=np.float32)
+        return result
+
+    # Chunks by id or filter, in the format of Collection.get
+    def get(self, ids=None, where=None, include=("documents", "metadatas"), limit=None, offset=None):
+        with self.lock:
+            indexes = self.select(ids, where)
+            start = offset or 0
+            indexes = indexes[start:start + limit] if limit else indexes[start:]
+            return self.fields(indexes, include, self.vectors)
+
+    # Nearest chunks by squared l2 distance (Chroma's default space), in the format of Collection.query.
+    # The scan runs outside the lock on the rows present when it started, it is redone if a compaction renumbered them.
+    def query(self, query_embeddings, n_results=10, where=None, include=("documents", "metadatas", "distances")):
+        with self.lock:
+            generation, count, vectors, norms = self.settings["generation"], self.count, self.vectors, self.norms
+            allowed = self.mask(where)
+        k = min(n_results, int(allowed.sum()))
+        nearest = []
+        for query_embedding in query_embeddings:
+            query_embedding = np.asarray(query_embedding, dtype=np.float32)
+            dots = np.empty(count, dtype=np.float32)
+            buffer = None if self.dtype == np.float32 else np.empty((FLAT_SCAN_BLOCK, self.dim), dtype=np.float32)
+            for start in range(0, count, FLAT_SCAN_BLOCK):
+                block = vectors[start:min(start + FLAT_SCAN_BLOCK, count)]
+                if buffer is not None:
+                    block = buffer[:len(block)]
+                    np.copyto(block, vectors[start:start + len(block)])
+                dots[start:start + len(block)] = block @ query_embedding
+            distances = norms[:count] ** 2 + float(query_embedding @ query_embedding) - 2 * dots
+            distances[~allowed] = np.inf
+            best = np.argpartition(distances, k - 1)[:k] if k else np.zeros(0, dtype=np.int64)
+            best = best[np.argsort(distances[best], kind="stable")]
+            nearest.append((best.tolist(), np.maximum(distances[best], 0.0).tolist()))
+
+        results = {field: [] for field in ["ids", "distances"] + [field for field in include if field != "distances"]}
+        with self.lock:
+            if self.settings["generation"] != generation:
+                return self.query(query_embeddings, n_results, where, include)
+            for best, distances in nearest:
+                found = self.fields(best, include, vectors)
+                found["distances"] = distances
+                for field in results:
+                    results[field].append(found[field])
+        return results
+
+
+# Vector store of flat collections, one directory each. It mirrors what the app reads from langchain's Chroma:
+# _collection is the default collection and _client creates and lists the others (the shards).
+class FlatVectorStore(VectorStore):
+    def __init__(self, directory, embedding_function, collection_name="langchain", dtype="float32"):
+        self.directory = directory
+        self.embedding_function = embedding_function
+        self.dtype = dtype
+        self.lock = threading.Lock()
+        self.collections = {}
+        os.makedirs(directory, exist_ok=True)
+        self._client = self
+        self._collection = self.get_or_create_collection(collection_name)
+
+    @property
+    def embeddings(self):
+        return self.embedding_function
+
+    def get_or_create_collection(self, name, embedding_function=None):
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = FlatCollection(self.directory, name, self.dtype)
+            return self.collections[name]
+
+    def list_collections(self):
+        names = {entry.name for entry in os.scandir(self.directory) if entry.is_dir()}
+        return sorted(names | set(self.collections))
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs) -> List[str]:
+        texts = list(texts)
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        self._collection.add(ids=ids, embeddings=self.embedding_function.embed_documents(texts), metadatas=metadatas, documents=texts)
+        return ids
+
+    def delete(self, ids=None, **kwargs):
+        self._collection.delete(ids=ids, where=kwargs.get("where"))
+
+    def get(self, ids=None, where=None, include=("documents", "metadatas"), limit=None, offset=None):
+        return self._collection.get(ids=ids, where=where, include=include, limit=limit, offset=offset)
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4, filter=None):
+        result = self._collection.query(query_embeddings=[embedding], n_results=k, where=filter)
+        return [(Document(page_content=text, metadata=metadata, id=chunk_id), distance) for chunk_id, text, metadata, distance in
+                zip(result["ids"][0], result["documents"][0], result["metadatas"][0], result["distances"][0])]
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_by_vector_with_score(self.embedding_function.embed_query(query), k, filter)
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [document for document, _ in self.similarity_search_by_vector_with_score(embedding, k, filter)]
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return [document for document, _ in self.similarity_search_with_score(query, k, filter)]
+
+    # Unit-length embeddings: a squared l2 distance d is a cosine similarity of 1 - d / 2, the score search_chunks reports
+    def _select_relevance_score_fn(self):
+        return lambda distance: 1.0 - distance / 2
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, directory="./flat_index", collection_name="langchain", **kwargs):
+        store = cls(directory, embedding, collection_name, **kwargs)
+        store.add_texts(texts, metadatas, ids)
+        return store
@@ -0,0 +1,140 @@
+# token-budgeted chat history: the prompt gets the most recent turns that fit the budget,
+# older turns are folded into a rolling summary stored per session
+from db_utils import aget_recent_chat_rows, aget_chat_rows_between, aget_session_summary, aupsert_session_summary
+from langchain_utils import get_chain
+from admission_utils import AdmissionRejected, admit
+import asyncio
+import logging
+import os
+from logging_utils import log_time
+
+
+# Tokens of chat history (summary included) passed to the prompts
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2000"))
+
+# Most turns ever read from the database for one request
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "20"))
+
+# Model maintaining the summaries and the most turns folded into a summary at once
+HISTORY_SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_MODEL", "gpt-3.5-turbo")
+HISTORY_SUMMARY_BATCH = int(os.getenv("HISTORY_SUMMARY_BATCH", "20"))
+
+# Share of HISTORY_TOKEN_BUDGET a summary may take, the rest is left to the recent turns
+HISTORY_SUMMARY_SHARE = float(os.getenv("HISTORY_SUMMARY_SHARE", "0.5"))
+HISTORY_SUMMARY_MAX_TOKENS = int(HISTORY_TOKEN_BUDGET * HISTORY_SUMMARY_SHARE)
+
+# tiktoken comes with langchain-openai, without it tokens are estimated from the length
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+token_encoding = None
+
+# Sessions whose summary is being updated, and the running background tasks
+summarizing_sessions = set()
+summary_tasks = set()
+
+
+def get_token_encoding():
+    global token_encoding
+    if tiktoken is not None and token_encoding is None:
+        try:
+            token_encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            token_encoding = False
+    return token_encoding
+
+
+def count_tokens(text):
+    if get_token_encoding():
+        return len(token_encoding.encode(text))
+    return len(text) // 4 + 1
+
+
+# The start of text within max_tokens, in case the model writes a longer summary than asked
+def truncate_tokens(text, max_tokens):
+    if count_tokens(text) <= max_tokens:
+        return text
+    if get_token_encoding():
+        return token_encoding.decode(token_encoding.encode(text)[:max_tokens])
+    return text[:max(max_tokens - 1, 0) * 4]
+
+
+def turn_tokens(row):
+    return count_tokens(row['user_query']) + count_tokens(row['gpt_response'])
+
+
+# Formatted chat history for our RAG chain: the session summary, then the most recent turns within the token budget.
+# Turns that no longer fit are folded into the summary in the background.
+async def aget_history_window(session_id):
+    (summary, summarized_until), rows = await asyncio.gather(aget_session_summary(session_id),
+                                                             aget_recent_chat_rows(session_id, HISTORY_MAX_TURNS))
+
+    budget = HISTORY_TOKEN_BUDGET - (count_tokens(summary) if summary else 0)
+    start = len(rows)
+    for row in reversed(rows):
+        tokens = turn_tokens(row)
+        if tokens > budget:
+            break
+        budget -= tokens
+        start -= 1
+
+    # Only turns that are neither in the window nor in the summary yet need folding
+    window = rows[start:]
+    window_start_id = window[0]['id'] if window else (rows[-1]['id'] + 1 if rows else 0)
+    dropped_turn = start > 0 and rows[start - 1]['id'] > summarized_until
+    maybe_older_turns = start == 0 and len(rows) == HISTORY_MAX_TURNS and window_start_id > summarized_until + 1
+    if dropped_turn or maybe_older_turns:
+        schedule_summary_update(session_id, window_start_id)
+
+    messages = []
+    if summary:
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+    for row in window:
+        messages.extend([
+            {"role": "human", "content": row['user_query']},
+            {"role": "ai", "content": row['gpt_response']}
+        ])
+    return messages
+
+
+# Start folding the turns older than before_id into the session summary, at most one update per session at a time
+def schedule_summary_update(session_id, before_id):
+    if session_id in summarizing_sessions:
+        return
+    summarizing_sessions.add(session_id)
+    task = asyncio.create_task(aupdate_session_summary(session_id, before_id))
+    summary_tasks.add(task)
+    task.add_done_callback(summary_tasks.discard)
+
+
+# Fold the not yet summarized turns older than before_id into the session summary
+async def aupdate_session_summary(session_id, before_id):
+    try:
+        summary, summarized_until = await aget_session_summary(session_id)
+        while True:
+            rows = await aget_chat_rows_between(session_id, summarized_until, before_id, HISTORY_SUMMARY_BATCH)
+            if not rows:
+                break
+            new_lines = "\n".join(f"Human: {row['user_query']}\nAI: {row['gpt_response']}" for row in rows)
+            # Summaries queue behind the chat requests, a shed update is tried again on a later request of the session
+            _, ticket = await admit(HISTORY_SUMMARY_MODEL, "low")
+            try:
+                summary = await get_chain("summary", HISTORY_SUMMARY_MODEL).ainvoke({"summary": summary or "(empty)", "new_lines": new_lines,
+                                                                                     "max_tokens": HISTORY_SUMMARY_MAX_TOKENS})
+            finally:
+                ticket.release()
+            summary = truncate_tokens(summary, HISTORY_SUMMARY_MAX_TOKENS)
+            summarized_until = rows[-1]['id']
+            await aupsert_session_summary(session_id, summary, summarized_until)
+        logging.info(f"Updated history summary of session {session_id} up to turn {summarized_until} [{log_time()}]")
+
+    except AdmissionRejected as e:
+        logging.info(f"Postponed history summary update of session {session_id}: {str(e)} [{log_time()}]")
+
+    except Exception as e:
+        logging.error(f"Error updating history summary of session {session_id}: {str(e)} [{log_time()}]")
+
+    finally:
+        summarizing_sessions.discard(session_id)
@@ -0,0 +1,216 @@
+# background ingestion jobs, /upload stages the file and a worker pool indexes it
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from contextlib import contextmanager
+from db_utils import (insert_document_record, delete_document_record, insert_ingestion_job, update_ingestion_job, get_unfinished_ingestion_jobs,
+                      get_document_by_filename, update_document_hash, get_document_chunks, insert_document_chunks, delete_document_chunks)
+from chroma_utils import embed_chunks, add_chunks_to_chroma, delete_chunks_from_chroma, delete_doc_from_chroma, answer_cache, EMBEDDING_BATCH_SIZE
+from document_utils import iter_document_chunks, hash_text, hash_file
+from shard_utils import shard_name
+from metrics_utils import chunks_processed, coalesced_requests
+import threading
+import os
+import time
+import logging
+from logging_utils import log_time
+
+
+# Directory where uploaded files wait for their ingestion job
+STAGING_DIR = os.getenv("STAGING_DIR", "uploads")
+
+# Number of documents ingested at the same time
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "2"))
+ingestion_executor = ThreadPoolExecutor(max_workers=INGESTION_WORKERS, thread_name_prefix="ingestion")
+
+
+# Unique path in the staging directory for an uploaded file
+def staging_path(job_id, filename):
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    return os.path.join(STAGING_DIR, f"{job_id}_{os.path.basename(filename)}")
+
+
+# Jobs queued or running by (content hash, shard), an upload of the same bytes joins the job already indexing them
+inflight_jobs = {}
+inflight_jobs_lock = threading.Lock()
+
+
+# Register a job as indexing its content, returns the job already doing it if any
+def claim_content(job_id, content_hash, shard):
+    if content_hash is None:
+        return job_id
+    with inflight_jobs_lock:
+        return inflight_jobs.setdefault((content_hash, shard), job_id)
+
+
+def release_content(job_id, content_hash, shard):
+    with inflight_jobs_lock:
+        if inflight_jobs.get((content_hash, shard)) == job_id:
+            del inflight_jobs[(content_hash, shard)]
+
+
+# Locks by (filename, shard) with the number of their holders and waiters. Two versions of one filename are indexed
+# one after the other: both would diff against the same indexed chunks, each removing the ones the other reused.
+document_locks = {}
+document_locks_lock = threading.Lock()
+
+
+# Hold the lock of a filename in a shard while its document record and chunks are read and rewritten,
+# a thread already holding it can take it again
+@contextmanager
+def document_lock(filename, shard):
+    key = (filename, shard)
+    with document_locks_lock:
+        entry = document_locks.setdefault(key, [threading.RLock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with document_locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del document_locks[key]
+
+
+# Record a new job for an already staged file and queue it on the worker pool, shard is the tenant or tag of the file.
+# Returns the job id, or the id of the job already indexing the same content, in which case nothing is queued.
+def submit_ingestion_job(job_id, filename, staged_path, content_hash=None, shard=None):
+    inflight_job_id = claim_content(job_id, content_hash, shard)
+    if inflight_job_id != job_id:
+        coalesced_requests.inc(kind="upload")
+        logging.info(f"Upload of {filename} joined ingestion job {inflight_job_id} indexing the same content [{log_time()}]")
+        return inflight_job_id
+
+    insert_ingestion_job(job_id, filename, staged_path, content_hash, shard)
+    ingestion_executor.submit(run_ingestion_job, job_id, filename, staged_path, None, content_hash, shard)
+    logging.info(f"Queued ingestion job {job_id} for {filename} [{log_time()}]")
+    return job_id
+
+
+# Embed and write one batch of (chunk, chunk_hash) pairs, recording them in document_chunks
+def write_chunk_batch(file_id, batch, timings):
+    chunks = [chunk for chunk, _ in batch]
+
+    start = time.perf_counter()
+    embeddings = embed_chunks(chunks)
+    timings['embed'] = timings.get('embed', 0.0) + time.perf_counter() - start
+
+    start = time.perf_counter()
+    chroma_ids = add_chunks_to_chroma(chunks, embeddings)
+    insert_document_chunks([(chroma_id, file_id, chunk_hash) for chroma_id, (_, chunk_hash) in zip(chroma_ids, batch)])
+    timings['write'] = timings.get('write', 0.0) + time.perf_counter() - start
+
+
+# Sync the indexed chunks of a document with its new chunks, compared by chunk hash.
+# The chunks can be any iterable and are consumed as a stream: unchanged ones are reused, new ones are
+# embedded and written in batches of batch_size, and the indexed chunks left over at the end are removed.
+# The chunks are written to the collection of the document's shard (see shard_utils).
+# Returns (chunks indexed, chunks reused, chunks removed).
+def sync_chunks(file_id, chunks, timings, on_batch=None, batch_size=EMBEDDING_BATCH_SIZE, shard=None):
+    collection = shard_name(file_id, shard)
+    indexed = defaultdict(list)
+    for chroma_id, chunk_hash in get_document_chunks(file_id):
+        indexed[chunk_hash].append(chroma_id)
+
+    batch = []
+    chunks_indexed = 0
+    reused = 0
+    for chunk in chunks:
+        chunk.metadata['file_id'] = file_id
+        chunk.metadata['shard'] = collection
+        chunk_hash = hash_text(chunk.page_content)
+        if indexed[chunk_hash]:
+            indexed[chunk_hash].pop()
+            reused += 1
+            continue
+
+        batch.append((chunk, chunk_hash))
+        if len(batch) >= batch_size:
+            write_chunk_batch(file_id, batch, timings)
+            chunks_indexed += len(batch)
+            batch = []
+            if on_batch:
+                on_batch(chunks_indexed)
+
+    if batch:
+        write_chunk_batch(file_id, batch, timings)
+        chunks_indexed += len(batch)
+        if on_batch:
+            on_batch(chunks_indexed)
+
+    start = time.perf_counter()
+    stale_ids = [chroma_id for chroma_ids in indexed.values() for chroma_id in chroma_ids]
+    delete_chunks_from_chroma(stale_ids, collection)
+    delete_document_chunks(stale_ids)
+    timings['delete'] = timings.get('delete', 0.0) + time.perf_counter() - start
+
+    chunks_processed.inc(reused, operation="reused")
+    return chunks_indexed, reused, len(stale_ids)
+
+
+# Runs the whole pipeline of a job as a stream: pages are loaded one at a time, split, and the new chunks
+# embedded and written to Chroma in fixed-size batches, so the job never holds the whole document or its embeddings.
+# The in-memory BM25 index still grows with the text it indexes (see bm25_utils).
+# A new version of an already indexed filename only embeds the chunks that changed and deletes the stale ones,
+# jobs of the same filename and shard wait for each other (see document_lock).
+def run_ingestion_job(job_id, filename, staged_path, file_id=None, content_hash=None, shard=None):
+    timings = {}
+    progress = {}
+    created = False
+    with document_lock(filename, shard):
+        try:
+            update_ingestion_job(job_id, status='running', stage='load')
+            if content_hash is None:
+                content_hash = hash_file(staged_path)
+
+            # A job resumed after a restart already knows its file_id and picks up from the chunks it recorded
+            if file_id is None:
+                existing = get_document_by_filename(filename, shard)
+                if existing:
+                    file_id = existing['id']
+                else:
+                    file_id = insert_document_record(filename, shard=shard)
+                    created = True
+                update_ingestion_job(job_id, file_id=file_id, content_hash=content_hash)
+
+            # The total number of chunks is only known at the end, progress is reported as the pages loaded
+            # out of total_pages (known for PDFs) and the chunks indexed so far
+            update_ingestion_job(job_id, stage='index', timings=timings)
+            chunks_indexed, reused, removed = sync_chunks(file_id, iter_document_chunks(staged_path, timings, progress), timings,
+                                                          on_batch=lambda chunks_indexed: update_ingestion_job(job_id, chunks_indexed=chunks_indexed, timings=timings, **progress),
+                                                          shard=shard)
+
+            # The hash is only recorded once every chunk is indexed, so an interrupted job is never taken for a duplicate
+            update_document_hash(file_id, content_hash)
+            if chunks_indexed or removed:
+                answer_cache.invalidate()
+            update_ingestion_job(job_id, status='completed', stage='done', chunk_count=chunks_indexed, chunks_indexed=chunks_indexed,
+                                 chunks_reused=reused, chunks_removed=removed, timings=timings, **progress)
+            logging.info(f"Ingestion job {job_id} indexed {chunks_indexed} new document chunks, reused {reused} and removed {removed} from {filename} with file_id {file_id} in {sum(timings.values()):.2f}s [{log_time()}]")
+
+        except Exception as e:
+            logging.error(f"Error in ingestion job {job_id} for {filename}: {str(e)} [{log_time()}]")
+            update_ingestion_job(job_id, status='failed', error=str(e), timings=timings)
+
+            # Remove what was indexed so far for a new document, like a failed upload did before
+            if created:
+                delete_doc_from_chroma(file_id)
+                delete_document_record(file_id)
+
+        finally:
+            release_content(job_id, content_hash, shard)
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
+
+
+# Queue again the jobs that were still queued or running when the server stopped
+def resume_ingestion_jobs():
+    jobs = get_unfinished_ingestion_jobs()
+    for job in jobs:
+        if not os.path.exists(job['staged_path']):
+            update_ingestion_job(job['id'], status='failed', error='Staged file is missing after restart.')
+            continue
+        claim_content(job['id'], job['content_hash'], job['shard'])
+        ingestion_executor.submit(run_ingestion_job, job['id'], job['filename'], job['staged_path'], job['file_id'], job['content_hash'], job['shard'])
+    if jobs:
+        logging.info(f"Resumed {len(jobs)} ingestion jobs [{log_time()}]")
@@ -1,30 +1,50 @@
-from langchain_openai import ChatOpenAI
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
+from langchain_core.runnables import RunnableBranch, RunnablePassthrough, RunnableLambda
 from typing import List
 from langchain_core.documents import Document
-from chroma_utils import vectorstore
-from dotenv import load_dotenv
+from chroma_utils import vectorstore, shards, bm25_index, deleted_file_ids, query_embeddings, vectorstore_executor
+from bm25_utils import HybridRetriever
+from model_utils import create_chat_model
+from metrics_utils import LLMMetricsHandler
+from admission_utils import admit
+from operator import itemgetter
 import os
+import threading
+import logging
+import httpx
 
-# set api key enviroment
-def load_openai_api_key():
-    load_dotenv()
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise ValueError("OPENAI_API_KEY is missing from environment variables")
-    return api_key
+# Search settings used by the retriever, changing them rebuilds the cached chains
+retriever_search_kwargs = {
+    "k": int(os.getenv("RETRIEVAL_K", "2")), # return the top 2 most relevant documents
+    "fetch_k": int(os.getenv("RETRIEVAL_FETCH_K", "10")), # candidates taken from each index and re-ranked
+    "mmr_lambda": float(os.getenv("RETRIEVAL_MMR_LAMBDA", "0.7")), # relevance/diversity trade-off of the re-ranking
+    "mode": os.getenv("RETRIEVAL_MODE", "hybrid"), # hybrid, vector or lexical
+    "lexical_margin": float(os.getenv("RETRIEVAL_LEXICAL_MARGIN", "2.0")), # lead of the top BM25 hit needed to skip the vector search
+}
 
-# Initialize the OpenAI API key once to avoid multiple calls
-api_key = load_openai_api_key()
-os.environ["OPENAI_API_KEY"] = api_key
+# Pooled http clients shared by every ChatOpenAI instance so connections are reused across requests
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "200"))
+HTTP_POOL_LIMITS = httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS // 4)
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+http_client = httpx.Client(limits=HTTP_POOL_LIMITS, timeout=HTTP_TIMEOUT)
+http_async_client = httpx.AsyncClient(limits=HTTP_POOL_LIMITS, timeout=HTTP_TIMEOUT)
 
+# Process-wide registry of built chains keyed by (kind, model name)
+rag_chains = {}
+rag_chains_lock = threading.Lock()
 
-# Fetch relevant document chunks based on the user's query.     
+
+# Fetch relevant document chunks based on the user's query, fusing lexical and vector search.
 def initialize_retriever():
-    return vectorstore.as_retriever(search_kwargs={"k": 2}) # return the top 2 most similar documents
+    return HybridRetriever(vectorstore=vectorstore, collections=shards, lexical_index=bm25_index, excluded_file_ids=deleted_file_ids,
+                           query_embeddings=query_embeddings, executor=vectorstore_executor, **retriever_search_kwargs)
+
+
+# Initialize our ai model (OpenAI on top of the shared http clients, or the fake one, see model_utils),
+# every completion is timed and its tokens counted for /metrics
+def initialize_llm(model):
+    return create_chat_model(model, callbacks=[LLMMetricsHandler(model)], http_client=http_client, http_async_client=http_async_client)
 
 
 # Set up output parser to handle model's output
@@ -57,22 +77,151 @@ def setup_qa_prompt():
     ])
 
 
-# Create main rag chain
-def get_rag_chain(model="gpt-3.5-turbo"):
+# Setup the prompt folding older turns of a conversation into its running summary
+def setup_summary_prompt():
+    return ChatPromptTemplate.from_messages([
+        ("system", "Progressively summarize the conversation between a user and an AI assistant. "
+                   "Extend the current summary with the new lines and return only the new summary, "
+                   "keeping facts, names and open questions that later turns may refer to. "
+                   "Keep the summary under {max_tokens} tokens, dropping the least useful details first."),
+        ("human", "Current summary:\n{summary}\n\nNew lines of conversation:\n{new_lines}"),
+    ])
+
+
+# Build the chain updating the rolling summary of a chat session
+def build_summary_chain(model="gpt-3.5-turbo"):
+    return setup_summary_prompt() | initialize_llm(model) | initialize_output_parser()
+
+
+# Build the chain that rewrites the latest question into a standalone one using the chat history
+def build_contextualize_chain(model="gpt-3.5-turbo"):
+    llm = initialize_llm(model)
+    contextualize_q_prompt = setup_contextualize_prompt()
+    contextualize_chain = contextualize_q_prompt | llm | initialize_output_parser()
+
+    # Same behaviour as create_history_aware_retriever, without history the question is already standalone
+    return RunnableBranch(
+        (lambda x: not x.get("chat_history"), itemgetter("input")),
+        contextualize_chain,
+    )
+
+
+# Build a new main rag chain, use get_rag_chain to reuse an already built one
+def build_rag_chain(model="gpt-3.5-turbo"):
     # Initialize out ai model
-    llm = ChatOpenAI(model=model)
+    llm = initialize_llm(model)
     
     # Initialize the retriever and prompt templates
     retriever = initialize_retriever()
-    contextualize_q_prompt = setup_contextualize_prompt()
     qa_prompt = setup_qa_prompt()
     
-    # Creates a retriever that can understand context from previous chats.
-    history_aware_retriever = create_history_aware_retriever(llm, retriever, contextualize_q_prompt)
+    # Rewrites the question from previous chats, skipped when the caller already passes a standalone_question
+    contextualize_chain = build_contextualize_chain(model)
+    standalone_question = RunnableBranch(
+        (lambda x: bool(x.get("standalone_question")), itemgetter("standalone_question")),
+        contextualize_chain,
+    )
     
-    # Create the chain for answering questions from the list of documents
+    # Retrieves the context of the standalone question, the optional "retrieval" input overrides k, fetch_k, mmr_lambda and shards.
+    # A "context" input retrieved beforehand (see aretrieve_contexts) is used as it is.
+    def retrieve(inputs, config):
+        if inputs.get("context") is not None:
+            return inputs["context"]
+        return retriever.invoke(inputs["standalone_question"], config, **(inputs.get("retrieval") or {}))
+
+    async def aretrieve(inputs, config):
+        if inputs.get("context") is not None:
+            return inputs["context"]
+        return await retriever.ainvoke(inputs["standalone_question"], config, **(inputs.get("retrieval") or {}))
+
+    # Create the chain for answering questions from the list of documents,
+    # the langchain package is only imported here as importing it slows down the api start
+    from langchain.chains.combine_documents import create_stuff_documents_chain
     question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
     
-    # Create and return our main rag chain 
-    rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)    
-    return rag_chain
\ No newline at end of file
+    # Create and return our main rag chain, outputs the same keys as create_retrieval_chain plus standalone_question
+    rag_chain = (
+        RunnablePassthrough.assign(standalone_question=standalone_question)
+        .assign(context=RunnableLambda(retrieve, afunc=aretrieve))
+        .assign(answer=question_answer_chain)
+    )
+    return rag_chain
+
+
+# Builders of the chains kept in the registry
+chain_builders = {
+    "rag": build_rag_chain,
+    "contextualize": build_contextualize_chain,
+    "summary": build_summary_chain,
+}
+
+
+# Get a chain for a model, it is built once and then shared by every request
+def get_chain(kind, model="gpt-3.5-turbo"):
+    model = getattr(model, "value", model)
+    chain = rag_chains.get((kind, model))
+    if chain is None:
+        with rag_chains_lock:
+            chain = rag_chains.get((kind, model))
+            if chain is None:
+                chain = chain_builders[kind](model)
+                rag_chains[(kind, model)] = chain
+    return chain
+
+
+# Get the main rag chain for a model
+def get_rag_chain(model="gpt-3.5-turbo"):
+    return get_chain("rag", model)
+
+
+# Get the chain rewriting questions into standalone ones for a model
+def get_contextualize_chain(model="gpt-3.5-turbo"):
+    return get_chain("contextualize", model)
+
+
+# Retrieve the context of many standalone questions at once, at most max_concurrency at the same time.
+# Returns the documents of every question in the same order, or the exception its retrieval raised.
+async def aretrieve_contexts(questions, retrieval=None, max_concurrency=8):
+    return await initialize_retriever().abatch(questions, {"max_concurrency": max_concurrency}, return_exceptions=True, **(retrieval or {}))
+
+
+# Rewrite the question into a standalone one, only calls the model when there is chat history.
+# The call takes a slot of the model (see admission_utils) unless the caller already holds its ticket,
+# raises AdmissionRejected when the model is overloaded
+async def arephrase_question(model, question, chat_history, ticket=None, priority="normal", max_wait=None):
+    if not chat_history:
+        return question
+    if ticket is not None:
+        return await get_contextualize_chain(model).ainvoke({"input": question, "chat_history": chat_history})
+    _, ticket = await admit(model, priority, max_wait)
+    try:
+        return await get_contextualize_chain(model).ainvoke({"input": question, "chat_history": chat_history})
+    finally:
+        ticket.release()
+
+
+# Build the chains for the given models ahead of the first request
+def warm_up_rag_chains(models):
+    for model in models:
+        for kind in chain_builders:
+            get_chain(kind, model)
+    logging.info(f"Warmed up rag chains for models: {', '.join(getattr(m, 'value', m) for m in models)}")
+
+
+# Drop every cached chain so the next request builds a fresh one
+def invalidate_rag_chains():
+    with rag_chains_lock:
+        rag_chains.clear()
+
+
+# Change some retriever settings (e.g. k) keeping the others, the chains already in use
+# are rebuilt only when a value actually changes
+def set_retriever_search_kwargs(**search_kwargs):
+    with rag_chains_lock:
+        changed = {key: value for key, value in search_kwargs.items() if retriever_search_kwargs.get(key) != value}
+        if not changed:
+            return
+        retriever_search_kwargs.update(changed)
+        models = list(dict.fromkeys(model for _, model in rag_chains))
+        rag_chains.clear()
+    warm_up_rag_chains(models)
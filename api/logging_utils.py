@@ -0,0 +1,47 @@
+# logging shared by every module: records go through a queue to a background thread writing app.log,
+# so request handlers never wait on the file
+import logging
+import logging.handlers
+import atexit
+import queue
+import os
+from datetime import datetime
+
+LOG_FILE = os.getenv("LOG_FILE", "app.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
+# Longest question or answer text written to the log, 0 keeps the whole text
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "200"))
+
+log_queue = queue.SimpleQueue()
+log_listener = None
+
+
+# Send the records of the root logger to the queue, the listener thread writes them to the log file
+def setup_logging():
+    global log_listener
+    if log_listener is not None:
+        return
+    file_handler = logging.FileHandler(LOG_FILE, delay=True)
+    file_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+
+# Get log time
+def log_time():
+    return datetime.now().strftime("%d:%m:%Y %H:%M:%S")
+
+
+# Shorten a user question or ai answer before logging it
+def truncate(text, max_chars=LOG_PAYLOAD_MAX_CHARS):
+    if not max_chars or text is None or len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}... ({len(text)} chars)"
+
+
+setup_logging()
@@ -1,93 +1,575 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from pydantic_models import QueryInput, QueryResponse, DocumentInfo, DeleteFileRequest
-from langchain_utils import get_rag_chain
-from db_utils import insert_application_logs, get_chat_history, get_all_documents, insert_document_record, delete_document_record
-from chroma_utils import index_document_to_chroma, delete_doc_from_chroma
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Request, Response, Query
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
+from pydantic_models import QueryInput, QueryResponse, BatchQueryInput, SearchInput, SearchResponse, HistoryPage, DocumentInfo, DeleteFileRequest, DeleteFilesRequest, ModelName, IngestionJob
+from langchain_utils import get_rag_chain, warm_up_rag_chains, arephrase_question, aretrieve_contexts
+from db_utils import ainsert_application_logs, aget_all_documents, aget_document_filenames, aget_ingestion_job, aget_document_by_hash, close_db_pool, close_async_db_pool, init_db
+from chroma_utils import embedding_function, answer_cache, bm25_index, vectorstore, shards, query_embeddings, asearch_chunks
+from history_utils import aget_history_window
+from job_utils import staging_path, submit_ingestion_job, resume_ingestion_jobs
+from bulk_utils import submit_bulk_job, resume_bulk_jobs, is_archive, is_supported
+from compaction_utils import delete_documents, resume_compaction
+from retention_utils import start_retention, stop_retention, aget_history_page
+from shard_utils import query_shards
+from metrics_utils import StageTimer, http_request_seconds, render_metrics
+from singleflight_utils import SingleFlight, normalize_question
+from admission_utils import AdmissionRejected, admit, admission_stats
+from typing import List, Optional
+from contextlib import asynccontextmanager
+import asyncio
 import os
 import uuid
 import logging
+import hashlib
 import shutil
-import os
-from datetime import datetime
+import json
+import time
+from logging_utils import log_time, truncate
+
+
+# Resources warmed up after startup, /health/ready answers 200 once all of them are.
+# Errors of the background work started after them (job resume, retention) are kept apart in background_errors.
+readiness = {"database": False, "vectorstore": False, "lexical_index": False, "chains": False}
+warm_up_state = {"task": None, "error": None, "seconds": None, "background_errors": {}}
+
 
-# Setting up for logging our app's info
-logging.basicConfig(filename='app.log', level=logging.INFO)
+# Queue again the ingestion jobs left unfinished by the previous run and start archiving the old chat sessions,
+# a failure is logged and reported on /health/ready without making the server unready
+def start_background_work():
+    for name, start in (("ingestion_jobs", resume_ingestion_jobs), ("bulk_jobs", resume_bulk_jobs), ("retention", start_retention)):
+        try:
+            start()
+        except Exception as e:
+            warm_up_state["background_errors"][name] = str(e)
+            logging.error(f"Error starting {name}: {str(e)} [{log_time()}]")
 
-# Get log time
-def log_time():
-    return datetime.now().strftime("%d:%m:%Y %H:%M:%S")
+
+# Open the database and Chroma, build the lexical index (resuming an unfinished compaction) and the rag chain
+# of every available model instead of doing it on the first requests, then start the background work
+def warm_up():
+    start = time.perf_counter()
+    try:
+        init_db()
+        readiness["database"] = True
+        embedding_function.resolve()
+        vectorstore.resolve()
+        readiness["vectorstore"] = True
+        bm25_index.build(shards.select())
+        resume_compaction()
+        readiness["lexical_index"] = True
+        warm_up_rag_chains(list(ModelName))
+        warm_up_state["seconds"] = time.perf_counter() - start
+        readiness["chains"] = True
+        logging.info(f"Warm-up finished in {warm_up_state['seconds']:.2f}s [{log_time()}]")
+
+    except Exception as e:
+        warm_up_state["error"] = str(e)
+        logging.error(f"Error warming up: {str(e)} [{log_time()}]")
+        return
+
+    start_background_work()
+
+
+# The warm-up runs in the background so the port is bound and liveness checks pass right away,
+# on shutdown the log retention stops and the pooled database connections are closed
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warm_up_state["task"] = asyncio.create_task(run_in_threadpool(warm_up))
+    yield
+    stop_retention()
+    close_db_pool()
+    await close_async_db_pool()
 
 
 # Initialize FastAPI 
-fapi = FastAPI()
+fapi = FastAPI(lifespan=lifespan)
+
+
+# api endpoint for liveness checks, answers as soon as the process serves requests
+@fapi.get("/health/live")
+def health_live():
+    return {"status": "alive"}
+
+
+# api endpoint for readiness checks, 503 until the database, Chroma, the lexical index and the chains are warmed up
+@fapi.get("/health/ready")
+def health_ready():
+    ready = all(readiness.values())
+    status = "ready" if ready else ("failed" if warm_up_state["error"] else "warming_up")
+    content = {"status": status, "components": readiness,
+               "error": warm_up_state["error"], "warm_up_seconds": warm_up_state["seconds"],
+               "background_errors": warm_up_state["background_errors"]}
+    return JSONResponse(content, status_code=200 if ready else 503)
+
+
+# Record the latency of every request by route and status code
+@fapi.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        http_request_seconds.observe(time.perf_counter() - start, method=request.method,
+                                     route=getattr(route, "path", "unmatched"), status=str(status_code))
+
+
+# api endpoint for the latency histograms and counters, in the Prometheus text format
+@fapi.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+# Identical questions asked at the same time share one answer: same model and retrieval settings,
+# same standalone question and same corpus version. Each request still logs its own chat history.
+chat_flights = SingleFlight("chat")
+chat_stream_flights = SingleFlight("chat_stream")
+
+
+def chat_flight_key(cache_key, standalone_question, cache_version):
+    return cache_key, normalize_question(standalone_question), cache_version
+
+
+# Wait for a slot of the requested model (or of its fallback), answer 429 with Retry-After when it is overloaded
+async def admit_query(query_input):
+    try:
+        return await admit(query_input.model.value, query_input.priority, query_input.max_wait, query_input.allow_fallback)
+    except AdmissionRejected as e:
+        logging.info(f"Shed request for {e.model}: {e.reason} [{log_time()}]")
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
 
 
 # api endpoint for chatting
 @fapi.post("/chat", response_model=QueryResponse)
-def chat(query_input: QueryInput):
+async def chat(query_input: QueryInput, response: Response):
+    timer = StageTimer()
+    model, ticket = await admit_query(query_input)
+    timer.lap("admission")
+    try:
+        return await answer_chat(query_input, model, ticket, response, timer)
+    finally:
+        ticket.release()
+
+
+async def answer_chat(query_input, model, ticket, response, timer):
     # Create a new session_id with uuid if it is not provided 
     session_id = query_input.session_id or str(uuid.uuid4())
-    logging.info(f"Session ID: {session_id}, User Query: {query_input.question}, Model: {query_input.model.value} [{log_time()}]")
+    logging.info(f"Session ID: {session_id}, User Query: {truncate(query_input.question)}, Model: {model} [{log_time()}]")
 
-    # Get all chats history from our database
-    chat_history = get_chat_history(session_id)
-    
-    # Invokes the RAG chain to generate a response
-    rag_chain = get_rag_chain(query_input.model.value)
-    answer = rag_chain.invoke({
-        "input": query_input.question,
-        "chat_history": chat_history
-    })['answer']
+    # Get the recent chat history within the token budget, older turns come as a summary
+    chat_history = await aget_history_window(session_id)
+    timer.lap("history")
+
+    # Rephrase the question and look for an already generated answer to a similar one
+    standalone_question = await arephrase_question(model, query_input.question, chat_history, ticket)
+    timer.lap("rephrase")
+    retrieval = retrieval_overrides(query_input)
+    cache_key = answer_cache_key(model, retrieval)
+    query_embedding, cache_version, cached = await lookup_cached_answer(cache_key, standalone_question)
+    timer.lap("cache")
+
+    if cached:
+        answer = cached["answer"]
+    else:
+        # Invokes the RAG chain to generate a response, or waits for the identical one already running
+        rag_chain = get_rag_chain(model)
+
+        async def generate_answer():
+            result = await rag_chain.ainvoke({
+                "input": query_input.question,
+                "chat_history": chat_history,
+                "standalone_question": standalone_question,
+                "retrieval": retrieval
+            })
+            answer_cache.add(cache_key, query_embedding, result['answer'], format_sources(result['context']), version=cache_version)
+            return result
+
+        result = await chat_flights.run(chat_flight_key(cache_key, standalone_question, cache_version), generate_answer)
+        answer = result['answer']
+        timer.lap("answer")
 
     # Store logs of this chat in our database
-    insert_application_logs(session_id, query_input.question, answer, query_input.model.value)
-    logging.info(f"Session ID: {session_id}, AI Response: {answer} [{log_time()}]")
-    return QueryResponse(answer=answer, session_id=session_id, model=query_input.model)
+    await ainsert_application_logs(session_id, query_input.question, answer, model)
+    timer.lap("log")
+    response.headers["Server-Timing"] = timer.header()
+    logging.info(f"Session ID: {session_id}, AI Response: {truncate(answer)}, Cached: {cached is not None} [{log_time()}]")
+    return QueryResponse(answer=answer, session_id=session_id, model=model, cached=cached is not None, degraded=model != query_input.model.value)
+
+
+# Retrieval settings overridden by the request (a QueryInput or BatchQueryInput), passed to the retriever
+def retrieval_overrides(query_input):
+    overrides = {"k": query_input.k, "fetch_k": query_input.fetch_k, "mmr_lambda": query_input.mmr_lambda, "shards": query_shards(query_input.shards)}
+    return {name: value for name, value in overrides.items() if value is not None}
+
+
+# Answers are cached per model and retrieval settings, requests with other settings get other contexts
+def answer_cache_key(model, retrieval):
+    if not retrieval:
+        return model
+    return model + "|" + ",".join(f"{name}={value}" for name, value in sorted(retrieval.items()))
+
+
+# Embed the standalone question and look it up in the answer cache, through the query embedding cache
+# the retriever reads too, so a miss that goes on to vector retrieval costs one embedding call and not two.
+# The corpus version is read first so an answer generated while the corpus changes is not cached
+async def lookup_cached_answer(model, standalone_question):
+    cache_version = answer_cache.version
+    query_embedding = await run_in_threadpool(query_embeddings.embed, standalone_question)
+    return query_embedding, cache_version, answer_cache.lookup(model, query_embedding)
+
+
+# Turn retrieved documents into a light list of sources for the client
+def format_sources(documents):
+    return [{"file_id": doc.metadata.get("file_id"),
+             "source": os.path.basename(doc.metadata.get("source", "")),
+             "page": doc.metadata.get("page")} for doc in documents]
+
+
+# api endpoint for chatting with the answer streamed back as newline-delimited json events
+# events: {"type": "sources", ...} first, then {"type": "token", ...} per chunk and {"type": "done", ...} at the end
+# the model slot is held until the stream ends
+@fapi.post("/chat/stream")
+async def chat_stream(query_input: QueryInput):
+    timer = StageTimer()
+    model, ticket = await admit_query(query_input)
+    timer.lap("admission")
+    try:
+        return await start_chat_stream(query_input, model, ticket, timer)
+    except BaseException:
+        ticket.release()
+        raise
+
+
+async def start_chat_stream(query_input, model, ticket, timer):
+    session_id = query_input.session_id or str(uuid.uuid4())
+    logging.info(f"Session ID: {session_id}, User Query (stream): {truncate(query_input.question)}, Model: {model} [{log_time()}]")
+
+    chat_history = await aget_history_window(session_id)
+    timer.lap("history")
+    standalone_question = await arephrase_question(model, query_input.question, chat_history, ticket)
+    timer.lap("rephrase")
+    retrieval = retrieval_overrides(query_input)
+    cache_key = answer_cache_key(model, retrieval)
+    query_embedding, cache_version, cached = await lookup_cached_answer(cache_key, standalone_question)
+    timer.lap("cache")
+    rag_chain = get_rag_chain(model)
+
+    # Streams the rag chain output and caches the answer at the end, shared by the identical requests that join it
+    async def generate_chunks():
+        answer_parts = []
+        sources = []
+        async for chunk in rag_chain.astream({
+            "input": query_input.question,
+            "chat_history": chat_history,
+            "standalone_question": standalone_question,
+            "retrieval": retrieval
+        }):
+            if "context" in chunk:
+                sources = format_sources(chunk["context"])
+            if "answer" in chunk and chunk["answer"]:
+                answer_parts.append(chunk["answer"])
+            yield chunk
+        answer_cache.add(cache_key, query_embedding, "".join(answer_parts), sources, version=cache_version)
+
+    async def generate_events():
+        answer_parts = []
+        sources = []
+        try:
+            if cached:
+                # Cache hits skip the ai model and send the whole answer as one token
+                sources = cached["sources"]
+                answer_parts.append(cached["answer"])
+                yield json.dumps({"type": "sources", "session_id": session_id, "sources": sources}) + "\n"
+                yield json.dumps({"type": "token", "content": cached["answer"]}) + "\n"
+
+            else:
+                # The retrieval chain streams its output keys one by one, context comes before any answer chunk
+                async for chunk in chat_stream_flights.stream(chat_flight_key(cache_key, standalone_question, cache_version), generate_chunks):
+                    if "context" in chunk:
+                        sources = format_sources(chunk["context"])
+                        yield json.dumps({"type": "sources", "session_id": session_id, "sources": sources}) + "\n"
+                    if "answer" in chunk and chunk["answer"]:
+                        answer_parts.append(chunk["answer"])
+                        yield json.dumps({"type": "token", "content": chunk["answer"]}) + "\n"
+
+        except Exception as e:
+            logging.error(f"Error streaming answer for session {session_id}: {str(e)} [{log_time()}]")
+            yield json.dumps({"type": "error", "detail": "An error occurred while generating the answer."}) + "\n"
+            return
+        finally:
+            ticket.release()
+
+        # Store logs of this chat once the whole answer is known
+        answer = "".join(answer_parts)
+        if not cached:
+            timer.lap("answer")
+        await ainsert_application_logs(session_id, query_input.question, answer, model)
+        timer.lap("log")
+        logging.info(f"Session ID: {session_id}, AI Response: {truncate(answer)}, Cached: {cached is not None} [{log_time()}]")
+        yield json.dumps({"type": "done", "session_id": session_id, "model": model, "cached": cached is not None,
+                          "degraded": model != query_input.model.value}) + "\n"
+
+    # Only the stages before the stream starts fit in the header, the rest goes to /metrics
+    # the background task frees the slot when the client goes away before the stream started
+    return StreamingResponse(generate_events(), media_type="application/x-ndjson", headers={"Server-Timing": timer.header()},
+                             background=BackgroundTask(ticket.arelease))
+
 
+# Questions of a /chat/batch request answered at the same time, unless the request asks for fewer or more
+BATCH_CHAT_CONCURRENCY = int(os.getenv("BATCH_CHAT_CONCURRENCY", "8"))
 
-# Api endpoint for uploading document
+
+# Throughput and latency percentiles of the items of a batch, latencies in seconds since the batch started
+def batch_summary(latencies, errors, cached, retrievals, seconds):
+    ordered = sorted(latencies)
+
+    def percentile(fraction):
+        return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))] if ordered else None
+
+    return {"type": "summary", "answered": len(ordered), "errors": errors, "cached": cached, "retrievals": retrievals,
+            "seconds": seconds, "questions_per_second": len(ordered) / seconds if seconds else 0.0,
+            "latency_p50": percentile(0.50), "latency_p95": percentile(0.95), "latency_max": percentile(1.0)}
+
+
+# api endpoint answering many questions concurrently, e.g. to check the answers after a corpus update.
+# Every distinct standalone question is looked up in the answer cache and retrieved once, every model call waits for
+# a slot of the model at the batch's priority (low by default), and the results are streamed back as newline-delimited json events as they complete:
+# {"type": "result", ...} or {"type": "error", ...} per item, then {"type": "summary", ...} with the throughput and latencies
+@fapi.post("/chat/batch")
+async def chat_batch(batch_input: BatchQueryInput):
+    model = batch_input.model.value
+    items = batch_input.items
+    concurrency = batch_input.concurrency or BATCH_CHAT_CONCURRENCY
+    retrieval = retrieval_overrides(batch_input)
+    cache_key = answer_cache_key(model, retrieval)
+    semaphore = asyncio.Semaphore(concurrency)
+    logging.info(f"Batch of {len(items)} questions, Model: {model}, Concurrency: {concurrency} [{log_time()}]")
+
+    # Chat history and standalone question of an item
+    async def prepare(item):
+        async with semaphore:
+            session_id = item.session_id or str(uuid.uuid4())
+            chat_history = await aget_history_window(session_id)
+            return session_id, chat_history, await arephrase_question(model, item.question, chat_history,
+                                                                      priority=batch_input.priority, max_wait=batch_input.max_wait)
+
+    async def lookup(standalone_question):
+        async with semaphore:
+            return await lookup_cached_answer(cache_key, standalone_question)
+
+    async def generate_events():
+        start = time.perf_counter()
+        latencies = []
+        errors = 0
+
+        async def result_event(index, session_id, answer, sources, cached):
+            await ainsert_application_logs(session_id, items[index].question, answer, model)
+            latencies.append(time.perf_counter() - start)
+            return json.dumps({"type": "result", "index": index, "question": items[index].question, "session_id": session_id, "answer": answer,
+                               "sources": sources, "cached": cached, "seconds": latencies[-1]}) + "\n"
+
+        def error_event(index, error):
+            if isinstance(error, AdmissionRejected):
+                logging.info(f"Shed batch item {index} for {error.model}: {error.reason} [{log_time()}]")
+                return json.dumps({"type": "error", "index": index, "question": items[index].question, "detail": str(error),
+                                   "retry_after": error.retry_after}) + "\n"
+            logging.error(f"Error answering batch item {index}: {str(error)} [{log_time()}]")
+            return json.dumps({"type": "error", "index": index, "question": items[index].question, "detail": "An error occurred while generating the answer."}) + "\n"
+
+        prepared = await asyncio.gather(*(prepare(item) for item in items), return_exceptions=True)
+        pending = []
+        for index, result in enumerate(prepared):
+            if isinstance(result, Exception):
+                errors += 1
+                yield error_event(index, result)
+            else:
+                pending.append(index)
+
+        # One cache lookup and one retrieval per distinct standalone question
+        questions = list(dict.fromkeys(prepared[index][2] for index in pending))
+        lookups = dict(zip(questions, await asyncio.gather(*(lookup(question) for question in questions), return_exceptions=True)))
+        cached_count = 0
+        uncached = []
+        for index in pending:
+            session_id, _, standalone_question = prepared[index]
+            found = lookups[standalone_question]
+            if isinstance(found, Exception):
+                errors += 1
+                yield error_event(index, found)
+            elif found[2]:
+                cached_count += 1
+                yield await result_event(index, session_id, found[2]["answer"], found[2]["sources"], True)
+            else:
+                uncached.append(index)
+
+        to_retrieve = list(dict.fromkeys(prepared[index][2] for index in uncached))
+        contexts = dict(zip(to_retrieve, await aretrieve_contexts(to_retrieve, retrieval, concurrency)))
+        answerable = []
+        for index in uncached:
+            context = contexts[prepared[index][2]]
+            if isinstance(context, Exception):
+                errors += 1
+                yield error_event(index, context)
+            else:
+                answerable.append(index)
+
+        inputs = [{"input": items[index].question, "chat_history": prepared[index][1], "standalone_question": prepared[index][2],
+                   "context": contexts[prepared[index][2]]} for index in answerable]
+        rag_chain = get_rag_chain(model)
+
+        # Every answer takes its own slot of the model, so a batch queues behind the chat requests of a higher priority
+        async def answer(position):
+            async with semaphore:
+                try:
+                    _, ticket = await admit(model, batch_input.priority, batch_input.max_wait)
+                    try:
+                        return position, await rag_chain.ainvoke(inputs[position])
+                    finally:
+                        ticket.release()
+                except Exception as e:
+                    return position, e
+
+        cached_questions = set()
+        for answered in asyncio.as_completed([answer(position) for position in range(len(inputs))]):
+            position, output = await answered
+            index = answerable[position]
+            if isinstance(output, Exception):
+                errors += 1
+                yield error_event(index, output)
+                continue
+            session_id, _, standalone_question = prepared[index]
+            sources = format_sources(output["context"])
+            if standalone_question not in cached_questions:
+                cached_questions.add(standalone_question)
+                query_embedding, cache_version, _ = lookups[standalone_question]
+                answer_cache.add(cache_key, query_embedding, output["answer"], sources, version=cache_version)
+            yield await result_event(index, session_id, output["answer"], sources, False)
+
+        summary = batch_summary(latencies, errors, cached_count, len(to_retrieve), time.perf_counter() - start)
+        logging.info(f"Batch of {len(items)} questions answered in {summary['seconds']:.2f}s, {errors} errors, {cached_count} cached [{log_time()}]")
+        yield json.dumps(summary) + "\n"
+
+    return StreamingResponse(generate_events(), media_type="application/x-ndjson")
+
+
+# api endpoint returning the chunks nearest to a query, ranked by similarity, without calling any ai model.
+# Repeated queries reuse their cached embedding, so a warm search is a vector store lookup and a sqlite read.
+@fapi.post("/search", response_model=SearchResponse)
+async def search(search_input: SearchInput, response: Response):
+    timer = StageTimer()
+    try:
+        hits = await asearch_chunks(search_input.query, search_input.k, search_input.offset, search_input.file_ids, query_shards(search_input.shards))
+        timer.lap("search")
+        filenames = await aget_document_filenames([document.metadata.get("file_id") for _, document, _ in hits])
+        timer.lap("filenames")
+
+    except Exception as e:
+        logging.error(f"Error searching for {truncate(search_input.query)}: {str(e)} [{log_time()}]")
+        raise HTTPException(status_code=500, detail="An error occurred during the search.")
+
+    response.headers["Server-Timing"] = timer.header()
+    results = [{"chunk_id": chunk_id,
+                "file_id": document.metadata.get("file_id"),
+                "filename": filenames.get(document.metadata.get("file_id")),
+                "page": document.metadata.get("page"),
+                "score": score,
+                "text": document.page_content} for chunk_id, document, score in hits]
+    return {"query": search_input.query, "k": search_input.k, "offset": search_input.offset, "results": results}
+
+
+# Copy the uploaded file to disk while hashing its content, blocking so it runs in the threadpool
+def save_upload_file(file: UploadFile, path: str):
+    content_hash = hashlib.sha256()
+    with open(path, "wb") as buffer:
+        for block in iter(lambda: file.file.read(1024 * 1024), b""):
+            content_hash.update(block)
+            buffer.write(block)
+    return content_hash.hexdigest()
+
+
+# Api endpoint for uploading document, the file is staged and indexed by a background ingestion job
+# into the shard of the optional tenant or tag (see shard_utils)
 @fapi.post("/upload")
-def upload_document(file: UploadFile = File(...)):
+async def upload_document(file: UploadFile = File(...), shard: Optional[str] = Form(None)):
     allowed_extensions = ['.pdf', '.docx', '.html', '.htm']
     file_extension = os.path.splitext(file.filename)[1].lower()
 
     if file_extension not in allowed_extensions:
         raise HTTPException(status_code=400, detail=f"Unsupported file type. Allowed types are: {', '.join(allowed_extensions)}")
 
-    # Save the uploaded file to a temporary file
-    temp_file_path = f"temp_{file.filename}"
+    # Save the uploaded file to a unique path in the staging directory
+    job_id = str(uuid.uuid4())
+    staged_path = staging_path(job_id, file.filename)
     
     try:
-        with open(temp_file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-            
-        # Insert file record into database
-        file_id = insert_document_record(file.filename)
-        
-        # Index the documents in Chroma 
-        success = index_document_to_chroma(temp_file_path, file_id)
+        content_hash = await run_in_threadpool(save_upload_file, file, staged_path)
 
-        if success:
-            logging.info(f"File {file.filename} uploaded and indexed successfully. File ID: {file_id} [{log_time()}]")
-            return {"message": f"File {file.filename} has been successfully uploaded and indexed.", "file_id": file_id}
-        else:
-            delete_document_record(file_id)
-            raise HTTPException(status_code=500, detail=f"Failed to index {file.filename}.")
+        # An identical file is already indexed, nothing to do
+        existing = await aget_document_by_hash(content_hash, shard)
+        if existing:
+            os.remove(staged_path)
+            logging.info(f"File {file.filename} is identical to file_id {existing['id']}, skipped indexing [{log_time()}]")
+            return {"message": f"File {file.filename} is already indexed.", "file_id": existing['id'], "job_id": None, "status": "duplicate"}
+
+        # Queue the ingestion job, progress is available on /jobs/{job_id}
+        # a double-clicked upload of the same bytes gets the job already indexing them
+        queued_job_id = await run_in_threadpool(submit_ingestion_job, job_id, file.filename, staged_path, content_hash, shard)
+        if queued_job_id != job_id:
+            os.remove(staged_path)
+            return {"message": f"File {file.filename} is already being indexed.", "job_id": queued_job_id, "status": "coalesced"}
+
+        logging.info(f"File {file.filename} uploaded and queued for indexing. Job ID: {job_id} [{log_time()}]")
+        return {"message": f"File {file.filename} has been uploaded and queued for indexing.", "job_id": job_id, "status": "queued"}
         
     except Exception as e:
         logging.error(f"Error uploading document: {str(e)} [{log_time()}]")
+        if os.path.exists(staged_path):
+            os.remove(staged_path)
         raise HTTPException(status_code=500, detail="An error occurred during the upload.")   
-    
-    finally:
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+
+
+# Api endpoint for uploading many documents and zip/tar archives at once, the files are staged
+# and indexed by a bulk job, GET /jobs/{job_id} holds the result of every file once it completes
+@fapi.post("/upload/bulk")
+async def upload_documents_bulk(files: List[UploadFile] = File(...), shard: Optional[str] = Form(None)):
+    rejected = [file.filename for file in files if not (is_supported(file.filename) or is_archive(file.filename))]
+    if rejected:
+        raise HTTPException(status_code=400, detail=f"Unsupported file type: {', '.join(rejected)}")
+
+    job_id = str(uuid.uuid4())
+    staged_dir = staging_path(job_id, "bulk")
+    try:
+        os.makedirs(staged_dir)
+        for i, file in enumerate(files):
+            await run_in_threadpool(save_upload_file, file, os.path.join(staged_dir, f"{i}_{os.path.basename(file.filename)}"))
+
+        await run_in_threadpool(submit_bulk_job, job_id, staged_dir, shard)
+        return {"message": f"{len(files)} files are queued for indexing.", "job_id": job_id, "status": "queued"}
+
+    except Exception as e:
+        shutil.rmtree(staged_dir, ignore_errors=True)
+        logging.error(f"Error during bulk upload: {str(e)} [{log_time()}]")
+        raise HTTPException(status_code=500, detail="An error occurred during the bulk upload.")
+
+
+# Api endpoint for the progress of an ingestion job
+@fapi.get("/jobs/{job_id}", response_model=IngestionJob)
+async def get_job(job_id: str):
+    job = await aget_ingestion_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Ingestion job {job_id} not found.")
+    return job
          
             
 # Api endpoint for listing all documents that have been uploaded
 @fapi.get("/list", response_model=list[DocumentInfo])
-def list_documents():
+async def list_documents():
     try:
-        return get_all_documents()
+        return await aget_all_documents()
     
     except Exception as e:
         logging.error(f"Error fetching documents list: {str(e)} [{log_time()}]")
@@ -98,20 +580,49 @@ def list_documents():
 @fapi.post("/delete")
 async def delete_document(request: DeleteFileRequest):
     try:
-        # Delete document from Chroma first
-        chroma_delete_success = delete_doc_from_chroma(request.file_id)
+        # The document is tombstoned and hidden from retrieval, its chunks are removed in the background
+        deleted = await run_in_threadpool(delete_documents, [request.file_id])
 
-        # Once success, delete the document from our database
-        if chroma_delete_success:
-            db_delete_success = delete_document_record(request.file_id)
-            
-            if db_delete_success:
-                return {"message": f"Successfully deleted document with file_id {request.file_id}."}
-            else:
-                return {"error": f"Failed to delete document with file_id {request.file_id} from the database."}
+        if deleted:
+            return {"message": f"Successfully deleted document with file_id {request.file_id}."}
         else:
-            return {"error": f"Failed to delete document with file_id {request.file_id} from Chroma."}
+            return {"error": f"Failed to delete document with file_id {request.file_id}, it does not exist."}
     
     except Exception as e:
         logging.error(f"Error deleting document: {str(e)} [{log_time()}]")
-        raise HTTPException(status_code=500, detail="An error occurred during the document deletion.")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="An error occurred during the document deletion.")
+
+
+# Api endpoint for deleting many documents in one call
+@fapi.post("/delete/batch")
+async def delete_documents_batch(request: DeleteFilesRequest):
+    if not request.file_ids:
+        raise HTTPException(status_code=400, detail="No file_ids given.")
+    try:
+        deleted = await run_in_threadpool(delete_documents, request.file_ids)
+        not_found = sorted(set(request.file_ids) - set(deleted))
+        return {"message": f"Successfully deleted {len(deleted)} documents.", "deleted": deleted, "not_found": not_found}
+
+    except Exception as e:
+        logging.error(f"Error deleting documents: {str(e)} [{log_time()}]")
+        raise HTTPException(status_code=500, detail="An error occurred during the document deletion.")
+
+
+# Api endpoint for the hit and miss counts of our caches
+@fapi.get("/cache/stats")
+def cache_stats():
+    return {"embeddings": embedding_function.stats(), "query_embeddings": query_embeddings.stats(), "answers": answer_cache.stats()}
+
+
+# api endpoint for reading the chat history of a session page by page, oldest turns first,
+# turns of archived sessions are read from the log archive
+@fapi.get("/history/{session_id}", response_model=HistoryPage)
+async def get_history(session_id: str, after_id: int = Query(0, ge=0), limit: int = Query(50, ge=1, le=500)):
+    turns, next_after_id = await aget_history_page(session_id, after_id, limit)
+    return HistoryPage(session_id=session_id, turns=turns, next_after_id=next_after_id)
+
+
+# api endpoint for the admission control state of every model: slots in use, queued requests and shed requests
+@fapi.get("/admission/stats")
+def get_admission_stats():
+    return admission_stats()
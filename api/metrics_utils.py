@@ -0,0 +1,198 @@
+# in-process metrics for the hot paths: latency histograms per stage and token/chunk counters,
+# rendered in the Prometheus text format on /metrics
+from langchain_core.callbacks import BaseCallbackHandler
+from contextlib import contextmanager
+from bisect import bisect_left
+import functools
+import threading
+import inspect
+import time
+
+# Histogram buckets in seconds, from sqlite lookups up to slow ai model completions
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+registry = []
+
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.series = {}
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.series.items()):
+                lines.extend(self.render_series(key, value))
+        return lines
+
+
+# Monotonic counter, rendered with the _total suffix
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def render_series(self, key, value):
+        return [f"{self.name}_total{format_labels(self.labelnames, key)} {value}"]
+
+
+# Latency histogram with cumulative buckets, a sum and a count per label set
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render_series(self, key, value):
+        bucket_counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+            cumulative += bucket_count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {total}")
+        lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+stage_seconds = Histogram("chatbot_stage_seconds", "Time spent in each stage of the chat and ingestion paths.", ["stage"])
+http_request_seconds = Histogram("chatbot_http_request_seconds", "Time to answer an api request, up to the response headers for streams.", ["method", "route", "status"])
+llm_tokens = Counter("chatbot_llm_tokens", "Tokens sent to and generated by the ai models.", ["model", "kind"])
+chunks_processed = Counter("chatbot_chunks", "Document chunks indexed, reused unchanged or removed.", ["operation"])
+embedded_texts = Counter("chatbot_embedded_texts", "Texts sent to the embedding model, cache hits excluded.")
+coalesced_requests = Counter("chatbot_coalesced_requests", "Requests served by an identical computation already in flight.", ["kind"])
+admission_wait_seconds = Histogram("chatbot_admission_wait_seconds", "Time a chat request waited in the queue of its ai model.", ["model", "priority"])
+admission_shed = Counter("chatbot_admission_shed", "Chat requests rejected by the admission control of their ai model.", ["model", "reason"])
+admission_degraded = Counter("chatbot_admission_degraded", "Chat requests answered by the fallback of their overloaded ai model.", ["model", "fallback"])
+
+
+# Everything in the registry, in the Prometheus text exposition format
+def render_metrics():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Time the block as one observation of the stage
+@contextmanager
+def time_stage(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage=stage)
+
+
+# Decorator timing every call of a function or coroutine function as the stage
+def timed(stage):
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with time_stage(stage):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with time_stage(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Times consecutive stages of one request, each lap is recorded in stage_seconds
+# and the whole set can be sent back in a Server-Timing header
+class StageTimer:
+    def __init__(self):
+        self.timings = {}
+        self.start = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0.0) + now - self.start
+        stage_seconds.observe(now - self.start, stage=stage)
+        self.start = now
+
+    def header(self):
+        return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.timings.items())
+
+
+# Callback handler attached to every chat model: times each completion as the "llm" stage
+# and counts prompt and completion tokens, from the usage reported by the model or from the streamed tokens
+class LLMMetricsHandler(BaseCallbackHandler):
+    run_inline = True
+
+    def __init__(self, model):
+        self.model = model
+        self.runs = {} # run_id -> [start time, streamed tokens]
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self.runs[run_id] = [time.perf_counter(), 0]
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self.runs[run_id] = [time.perf_counter(), 0]
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        run = self.runs.get(run_id)
+        if run:
+            run[1] += 1
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        run = self.runs.pop(run_id, None)
+        if run is None:
+            return
+        stage_seconds.observe(time.perf_counter() - run[0], stage="llm")
+
+        prompt_tokens = completion_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                prompt_tokens += usage.get("input_tokens", 0)
+                completion_tokens += usage.get("output_tokens", 0)
+        if not prompt_tokens and not completion_tokens:
+            usage = (response.llm_output or {}).get("token_usage") or {}
+            prompt_tokens = usage.get("prompt_tokens", 0)
+            completion_tokens = usage.get("completion_tokens", 0) or run[1]
+        llm_tokens.inc(prompt_tokens, model=self.model, kind="prompt")
+        llm_tokens.inc(completion_tokens, model=self.model, kind="completion")
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        run = self.runs.pop(run_id, None)
+        if run:
+            stage_seconds.observe(time.perf_counter() - run[0], stage="llm_error")
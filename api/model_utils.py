@@ -0,0 +1,141 @@
+# chat and embedding models used by the app, selected by configuration:
+#   LLM_PROVIDER=openai|fake and EMBEDDINGS_PROVIDER=openai|fake
+# the fake models are deterministic, need no api key and have a configurable latency and error rate,
+# so the service can be benchmarked and load-tested offline
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from dotenv import load_dotenv
+from typing import List
+import numpy as np
+import asyncio
+import hashlib
+import random
+import time
+import os
+
+load_dotenv()
+
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "openai")
+EMBEDDINGS_PROVIDER = os.getenv("EMBEDDINGS_PROVIDER", "openai")
+
+# Latencies of the fake models in seconds
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0.5")) # before the first token
+FAKE_LLM_TOKEN_LATENCY = float(os.getenv("FAKE_LLM_TOKEN_LATENCY", "0.02")) # between tokens
+FAKE_EMBEDDING_LATENCY = float(os.getenv("FAKE_EMBEDDING_LATENCY", "0.05")) # per embedding request
+FAKE_EMBEDDING_SIZE = int(os.getenv("FAKE_EMBEDDING_SIZE", "1536"))
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0")) # share of the fake completions failing like a provider error
+
+
+# set api key enviroment
+def load_openai_api_key():
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY is missing from environment variables")
+    return api_key
+
+
+# Deterministic embeddings: every text maps to the same pseudo-random unit vector, seeded by its hash
+class FakeEmbeddings(Embeddings):
+    def __init__(self, size: int = FAKE_EMBEDDING_SIZE, latency: float = FAKE_EMBEDDING_LATENCY):
+        self.size = size
+        self.latency = latency
+        self.model = f"fake-embedding-{size}"
+
+    def embed_text(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.size)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        return [self.embed_text(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        time.sleep(self.latency)
+        return self.embed_text(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self.latency)
+        return [self.embed_text(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        await asyncio.sleep(self.latency)
+        return self.embed_text(text)
+
+
+# Deterministic chat model: answers with a fixed text built from the last message,
+# waits `latency` before the first token and `token_latency` between streamed tokens,
+# a share `error_rate` of the calls fails once the first latency has passed, before any token
+class FakeChatModel(BaseChatModel):
+    model_name: str = "fake"
+    latency: float = FAKE_LLM_LATENCY
+    token_latency: float = FAKE_LLM_TOKEN_LATENCY
+    error_rate: float = FAKE_LLM_ERROR_RATE
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def answer(self, messages) -> str:
+        question = messages[-1].content if messages else ""
+        return f"Fake answer from {self.model_name} to: {question[:200]}"
+
+    def maybe_fail(self):
+        if self.error_rate and random.random() < self.error_rate:
+            raise RuntimeError(f"Fake error from {self.model_name}")
+
+    def tokens(self, messages):
+        words = self.answer(messages).split(" ")
+        return [word if i == len(words) - 1 else word + " " for i, word in enumerate(words)]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self.latency + self.token_latency * len(self.tokens(messages)))
+        self.maybe_fail()
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.answer(messages)))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self.latency + self.token_latency * len(self.tokens(messages)))
+        self.maybe_fail()
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.answer(messages)))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        self.maybe_fail()
+        for token in self.tokens(messages):
+            time.sleep(self.token_latency)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.maybe_fail()
+        for token in self.tokens(messages):
+            await asyncio.sleep(self.token_latency)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+
+# Chat model for the configured provider, extra kwargs (e.g. the shared http clients) only go to OpenAI
+def create_chat_model(model: str, callbacks=None, **openai_kwargs):
+    if LLM_PROVIDER == "fake":
+        return FakeChatModel(model_name=model, callbacks=callbacks)
+
+    from langchain_openai import ChatOpenAI
+    load_openai_api_key()
+    return ChatOpenAI(model=model, callbacks=callbacks, **openai_kwargs)
+
+
+# Embedding model for the configured provider
+def create_embeddings():
+    if EMBEDDINGS_PROVIDER == "fake":
+        return FakeEmbeddings()
+
+    from langchain_openai import OpenAIEmbeddings
+    load_openai_api_key()
+    return OpenAIEmbeddings()
@@ -2,6 +2,7 @@
 from pydantic import BaseModel, Field
 from enum import Enum
 from datetime import datetime
+from typing import Optional, Dict, List, Literal, Any
 
 # schema model as Enum for our available ai model
 class ModelName(str, Enum):
@@ -14,12 +15,77 @@ class QueryInput(BaseModel):
     question: str # required
     session_id: str = Field(default=None) # optional, if not provided, a new session_id will be created
     model: ModelName = Field(default=ModelName.GPT3_5_TURBO) # optional ai model, default to GPT3_5_TURBO because i am using free tier
+    k: Optional[int] = Field(default=None, ge=1, le=20) # optional number of document chunks put in the prompt
+    fetch_k: Optional[int] = Field(default=None, ge=1, le=100) # optional number of candidates re-ranked to pick them
+    mmr_lambda: Optional[float] = Field(default=None, ge=0.0, le=1.0) # optional relevance/diversity trade-off, 1 is relevance only
+    shards: Optional[List[str]] = Field(default=None, max_length=50) # optional tenants or tags to search, all of them by default
+    priority: Literal["high", "normal", "low"] = "normal" # optional priority class in the queue of the ai model
+    max_wait: Optional[float] = Field(default=None, gt=0, le=300) # optional seconds to wait in the queue before giving up with a 429
+    allow_fallback: bool = False # optional, answer with the fallback model (e.g. gpt-4o-mini for gpt-4o) rather than a 429 when the model is overloaded
+
+# schema model for one question of a batch
+class BatchQueryItem(BaseModel):
+    question: str # required
+    session_id: Optional[str] = None # optional, continues the chat history of this session
+
+# schema model for answering many questions at once, the model and retrieval settings apply to every item
+class BatchQueryInput(BaseModel):
+    items: List[BatchQueryItem] = Field(min_length=1, max_length=1000)
+    model: ModelName = Field(default=ModelName.GPT3_5_TURBO)
+    k: Optional[int] = Field(default=None, ge=1, le=20)
+    fetch_k: Optional[int] = Field(default=None, ge=1, le=100)
+    mmr_lambda: Optional[float] = Field(default=None, ge=0.0, le=1.0)
+    shards: Optional[List[str]] = Field(default=None, max_length=50)
+    concurrency: Optional[int] = Field(default=None, ge=1, le=64) # optional number of questions answered at the same time
+    priority: Literal["high", "normal", "low"] = "low" # optional priority class of every item in the queue of the ai model
+    max_wait: Optional[float] = Field(default=None, gt=0, le=300) # optional seconds an item waits in the queue before failing
 
 # schema model for chat response
 class QueryResponse(BaseModel):
     answer: str # generated response
     session_id: str # for continuing chat history
     model: ModelName # ai model used to generate response
+    cached: bool = False # true when the answer came from the answer cache without calling the ai model
+    degraded: bool = False # true when the requested model was overloaded and its fallback answered
+
+# schema model for one turn of a chat session
+class ChatTurn(BaseModel):
+    id: int
+    user_query: str
+    gpt_response: str
+    model: Optional[str] = None
+    created_at: datetime
+    archived: bool = False # true when the turn was read from the log archive
+
+# schema model for a page of the chat history of a session, oldest turns first
+class HistoryPage(BaseModel):
+    session_id: str
+    turns: List[ChatTurn]
+    next_after_id: Optional[int] = None # after_id of the next page, none on the last page
+
+# schema model for a retrieval-only search, no ai model is called
+class SearchInput(BaseModel):
+    query: str # required
+    k: int = Field(default=10, ge=1, le=100) # number of chunks per page
+    offset: int = Field(default=0, ge=0, le=1000) # rank of the first chunk returned, for pagination
+    file_ids: Optional[List[int]] = Field(default=None, max_length=500) # optional documents to search, all of them by default
+    shards: Optional[List[str]] = Field(default=None, max_length=50) # optional tenants or tags to search, all of them by default
+
+# schema model for one ranked chunk of a search
+class SearchResult(BaseModel):
+    chunk_id: str
+    file_id: Optional[int] = None
+    filename: Optional[str] = None
+    page: Optional[int] = None
+    score: float # cosine similarity to the query
+    text: str
+
+# schema model for a page of search results
+class SearchResponse(BaseModel):
+    query: str
+    k: int
+    offset: int
+    results: List[SearchResult]
 
 # schema model for document's meta data
 class DocumentInfo(BaseModel):
@@ -28,4 +94,29 @@ class DocumentInfo(BaseModel):
     upload_timestamp: datetime
 
 class DeleteFileRequest(BaseModel):
-    file_id: int # id of the file to be deleted
\ No newline at end of file
+    file_id: int # id of the file to be deleted
+
+# schema model for deleting many files at once
+class DeleteFilesRequest(BaseModel):
+    file_ids: List[int] # ids of the files to be deleted
+
+# schema model for the progress of a background ingestion job
+class IngestionJob(BaseModel):
+    id: str
+    filename: str
+    status: str # queued, running, completed or failed
+    stage: str # current pipeline stage: queued, load, index (split, embed and write in batches) or done
+    file_id: Optional[int] = None
+    content_hash: Optional[str] = None
+    chunk_count: int = 0 # new or changed chunks to embed
+    chunks_indexed: int = 0
+    chunks_reused: int = 0 # unchanged chunks kept from the previous version
+    chunks_removed: int = 0 # stale chunks of the previous version
+    pages_loaded: int = 0
+    total_pages: Optional[int] = None # known for PDFs, progress is pages_loaded / total_pages
+    timings: Dict[str, float] = {} # seconds spent in each stage
+    kind: str = "document" # document, or bulk for a /upload/bulk request
+    result: Optional[Dict[str, Any]] = None # summary of a bulk job with the result of every file
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
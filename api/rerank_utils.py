@@ -0,0 +1,91 @@
+# re-ranking of retrieved candidates: maximal marginal relevance over their stored embeddings, vectorized with numpy,
+# then adjacent chunks of the same file whose texts overlap are merged so the prompt never repeats the splitter overlap
+from langchain_core.documents import Document
+from document_utils import CHUNK_OVERLAP
+from typing import List
+import numpy as np
+
+# Shortest shared text taken as a real overlap between two chunks rather than a coincidence
+MIN_OVERLAP_CHARS = 20
+
+
+# Order of the candidates by maximal marginal relevance, best first.
+# relevance is scaled to [0, 1], mmr_lambda = 1 ranks by relevance only, lower values favour diversity.
+def mmr_order(relevance, embeddings, mmr_lambda: float) -> List[int]:
+    relevance = np.asarray(relevance, dtype=np.float32)
+    count = len(relevance)
+    if count == 0:
+        return []
+    if embeddings is None or mmr_lambda >= 1.0:
+        return np.argsort(-relevance, kind="stable").tolist()
+
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    similarity = vectors @ vectors.T
+
+    order = [int(np.argmax(relevance))]
+    max_similarity = similarity[order[0]].copy()
+    remaining = np.ones(count, dtype=bool)
+    remaining[order[0]] = False
+    while len(order) < count:
+        scores = mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity
+        scores[~remaining] = -np.inf
+        best = int(np.argmax(scores))
+        order.append(best)
+        remaining[best] = False
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+    return order
+
+
+# Length of the longest end of first that is also the start of second, 0 if shorter than MIN_OVERLAP_CHARS
+def overlap_length(first: str, second: str, max_overlap: int = CHUNK_OVERLAP) -> int:
+    tail = first[-max_overlap:]
+    head = second[:MIN_OVERLAP_CHARS]
+    if len(head) < MIN_OVERLAP_CHARS:
+        return 0
+    start = tail.find(head)
+    while start != -1:
+        if second.startswith(tail[start:]):
+            return len(tail) - start
+        start = tail.find(head, start + 1)
+    return 0
+
+
+def same_source(first: Document, second: Document) -> bool:
+    return (first.metadata.get("file_id") == second.metadata.get("file_id")
+            and first.metadata.get("source") == second.metadata.get("source"))
+
+
+# Merge the document into one of the kept documents when they are overlapping neighbours, returns False otherwise
+def merge_into(kept: List[Document], document: Document) -> bool:
+    for index, other in enumerate(kept):
+        if not same_source(other, document):
+            continue
+        overlap = overlap_length(other.page_content, document.page_content)
+        if overlap:
+            text = other.page_content + document.page_content[overlap:]
+        elif overlap_length(document.page_content, other.page_content):
+            text = document.page_content + other.page_content[overlap_length(document.page_content, other.page_content):]
+        elif document.page_content in other.page_content:
+            text = other.page_content
+        else:
+            continue
+        kept[index] = Document(page_content=text, metadata=dict(other.metadata))
+        return True
+    return False
+
+
+# Pick k contexts from the candidates: MMR order first, then overlapping neighbours are merged,
+# a merged candidate does not count towards k so the next one in MMR order takes its place
+def rerank(documents: List[Document], relevance, embeddings, k: int, mmr_lambda: float) -> List[Document]:
+    relevance = np.asarray(relevance, dtype=np.float32)
+    if len(relevance) and relevance.max() > 0:
+        relevance = relevance / relevance.max()
+
+    kept = []
+    for index in mmr_order(relevance, embeddings, mmr_lambda):
+        if not merge_into(kept, documents[index]):
+            if len(kept) == k:
+                break
+            kept.append(documents[index])
+    return kept
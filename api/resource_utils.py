@@ -0,0 +1,37 @@
+# resources created on first use instead of at import time, so the api process starts fast
+# and the lifespan hooks decide when the expensive setup happens
+import threading
+
+
+# Stand-in for an object built by factory() on first use. Attribute access is forwarded to it,
+# so callers keep using the module-level name as if it were the object itself.
+class LazyResource:
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+
+    # Named so they do not hide attributes of the resource, e.g. the vector store has its own get()
+    @property
+    def is_initialized(self):
+        return self._instance is not None
+
+    # The underlying object, built by the first caller while the others wait for it
+    def resolve(self):
+        instance = self._instance
+        if instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+                instance = self._instance
+        return instance
+
+    # Special attributes looked up by copy, pickle or pydantic must not build the resource
+    def __getattr__(self, attribute):
+        if attribute.startswith("__"):
+            raise AttributeError(attribute)
+        return getattr(self.resolve(), attribute)
+
+    def __repr__(self):
+        return f"<LazyResource {self._name} ({'initialized' if self.is_initialized else 'not initialized'})>"
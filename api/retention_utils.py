@@ -0,0 +1,138 @@
+# retention of the chat logs: sessions idle for LOG_RETENTION_DAYS move out of application_logs into compressed,
+# date-partitioned archive files, so the live table stays small enough to remain in the page cache.
+#   log_archive/date=2024-05-01/logs-1714600000-3f2a9c1e.jsonl.gz
+# Every session is its own gzip member of the file, the whole file still reads with zcat or gzip.open,
+# and archived_sessions records the offset and length of each member so one session is read without the rest.
+from db_utils import get_expired_sessions, get_session_logs, archive_session_logs, vacuum_db, aget_chat_log_page, aget_archived_sessions
+from datetime import datetime, timedelta, timezone
+from itertools import groupby
+import functools
+import threading
+import asyncio
+import gzip
+import json
+import time
+import uuid
+import os
+import logging
+from logging_utils import log_time
+
+
+# Sessions whose last turn is older than this many days are archived, 0 keeps every session in the database
+LOG_RETENTION_DAYS = float(os.getenv("LOG_RETENTION_DAYS", "30"))
+
+# Directory of the archive files
+LOG_ARCHIVE_DIR = os.getenv("LOG_ARCHIVE_DIR", "log_archive")
+
+# Sessions archived per batch, one archive file per date and one sqlite transaction each
+LOG_ARCHIVE_BATCH_SIZE = int(os.getenv("LOG_ARCHIVE_BATCH_SIZE", "200"))
+
+# Seconds between two retention runs
+LOG_RETENTION_INTERVAL = float(os.getenv("LOG_RETENTION_INTERVAL", "3600"))
+
+# Share of free pages above which the database file is rebuilt after archiving
+LOG_VACUUM_FREE_RATIO = float(os.getenv("LOG_VACUUM_FREE_RATIO", "0.25"))
+
+retention_stop = threading.Event()
+retention_thread = None
+
+
+# Write the turns of a batch of sessions to the archive files of their last day, returns the archived_sessions entries
+def write_archives(rows):
+    run_id = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+    sessions = [list(turns) for _, turns in groupby(rows, key=lambda row: row['session_id'])]
+    last_day = lambda turns: turns[-1]['created_at'][:10]
+    entries = []
+    for day, day_sessions in groupby(sorted(sessions, key=last_day), key=last_day):
+        directory = os.path.join(LOG_ARCHIVE_DIR, f"date={day}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"logs-{run_id}.jsonl.gz")
+        with open(path, "wb") as archive:
+            for turns in day_sessions:
+                member = gzip.compress("".join(json.dumps(turn) + "\n" for turn in turns).encode("utf-8"))
+                entries.append({"session_id": turns[0]['session_id'], "path": path, "offset": archive.tell(), "length": len(member),
+                                "turns": len(turns), "first_id": turns[0]['id'], "last_id": turns[-1]['id'],
+                                "first_at": turns[0]['created_at'], "last_at": turns[-1]['created_at']})
+                archive.write(member)
+            archive.flush()
+            os.fsync(archive.fileno())
+    return entries
+
+
+# Archive every expired session batch by batch, then rebuild the database file when enough of it is free.
+# The archive files are written before the turns are removed, a file of a failed batch is removed again.
+def run_retention():
+    if LOG_RETENTION_DAYS <= 0:
+        return
+    start = time.perf_counter()
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=LOG_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    archived = 0
+    try:
+        while True:
+            session_ids = get_expired_sessions(cutoff, LOG_ARCHIVE_BATCH_SIZE)
+            rows = get_session_logs(session_ids) if session_ids else []
+            if not rows:
+                break
+            entries = write_archives(rows)
+            if not archive_session_logs(entries):
+                for path in {entry['path'] for entry in entries}:
+                    os.remove(path)
+                break
+            archived += len(entries)
+
+        if archived:
+            vacuumed = vacuum_db(LOG_VACUUM_FREE_RATIO)
+            logging.info(f"Archived {archived} chat sessions in {time.perf_counter() - start:.2f}s, vacuumed: {vacuumed} [{log_time()}]")
+
+    except Exception as e:
+        logging.error(f"Error archiving chat logs: {str(e)} [{log_time()}]")
+
+
+def retention_loop():
+    run_retention()
+    while not retention_stop.wait(LOG_RETENTION_INTERVAL):
+        run_retention()
+
+
+# Run the retention now and then every LOG_RETENTION_INTERVAL seconds in a background thread
+def start_retention():
+    global retention_thread
+    if LOG_RETENTION_DAYS <= 0 or retention_thread is not None:
+        return
+    retention_stop.clear()
+    retention_thread = threading.Thread(target=retention_loop, name="log-retention", daemon=True)
+    retention_thread.start()
+
+
+def stop_retention():
+    retention_stop.set()
+
+
+# Turns of one archived session, archive members never change so the recently read ones are kept decoded
+@functools.lru_cache(maxsize=64)
+def read_archive_member(path, offset, length):
+    with open(path, "rb") as archive:
+        archive.seek(offset)
+        data = gzip.decompress(archive.read(length))
+    return tuple(json.loads(line) for line in data.decode("utf-8").splitlines())
+
+
+# Up to `limit` turns of a session with id > after_id, oldest first, and the after_id of the next page (None on the last one).
+# Archived turns come first: a session is archived whole, so its archived turns are older than the ones still in the database.
+async def aget_history_page(session_id, after_id=0, limit=50):
+    turns = []
+    for entry in await aget_archived_sessions(session_id, after_id):
+        if len(turns) > limit:
+            break
+        try:
+            rows = await asyncio.to_thread(read_archive_member, entry['path'], entry['offset'], entry['length'])
+        except (OSError, ValueError) as e:
+            logging.error(f"Error reading chat archive {entry['path']}: {str(e)} [{log_time()}]")
+            continue
+        turns.extend(dict(row, archived=True) for row in rows if row['id'] > after_id)
+
+    if len(turns) <= limit:
+        turns.extend(dict(row, archived=False) for row in await aget_chat_log_page(session_id, after_id, limit + 1 - len(turns)))
+
+    page = turns[:limit]
+    return page, (page[-1]['id'] if len(turns) > limit else None)
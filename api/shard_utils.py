@@ -0,0 +1,53 @@
+# routing of documents to vector collections (shards), selected by configuration:
+#   SHARD_KEY=none     everything in the single default collection, as before
+#   SHARD_KEY=file_id  SHARD_COUNT collections, a document goes to the one given by the hash of its file_id
+#   SHARD_KEY=tenant   one collection per tenant (or tag with SHARD_KEY=tag) given at upload
+# Changing the configuration does not move the chunks already indexed, the documents have to be uploaded again.
+import zlib
+import re
+import os
+
+SHARD_KEY = os.getenv("SHARD_KEY", "none")
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "4"))
+
+# Name of the collection langchain_chroma creates by default, documents indexed before sharding live in it
+DEFAULT_COLLECTION = "langchain"
+
+# Shard used for the documents uploaded without a tenant or tag
+DEFAULT_SHARD = "default"
+
+INVALID_NAME_CHARACTERS = re.compile(r"[^a-zA-Z0-9_-]+")
+
+
+# Chroma collection names are 3 to 63 characters from [a-zA-Z0-9_-], starting and ending with a letter or digit
+def collection_name(prefix, value):
+    value = INVALID_NAME_CHARACTERS.sub("-", str(value)).strip("-_")[:40] or DEFAULT_SHARD
+    return f"{prefix}_{value}"
+
+
+# Collection of a document, from its file_id or the tenant/tag it was uploaded for
+def shard_name(file_id, shard=None):
+    if SHARD_KEY == "none":
+        return DEFAULT_COLLECTION
+    if SHARD_KEY == "file_id":
+        return collection_name("shard", zlib.crc32(str(file_id).encode()) % SHARD_COUNT)
+    return collection_name(SHARD_KEY, shard or DEFAULT_SHARD)
+
+
+# Collections a query restricted to the given shards has to search, None searches them all.
+# The values are tenants or tags, or with SHARD_KEY=file_id file ids; collection names are accepted as they are.
+def query_shards(values):
+    if not values or SHARD_KEY == "none":
+        return None
+    names = set()
+    for value in values:
+        if SHARD_KEY == "file_id":
+            names.add(value if str(value).startswith("shard_") else shard_name(value))
+        else:
+            names.add(value if str(value).startswith(SHARD_KEY + "_") else shard_name(None, value))
+    return sorted(names)
+
+
+# Shard of a chunk from its metadata, chunks indexed before sharding have none and live in the default collection
+def chunk_shard(metadata):
+    return (metadata or {}).get("shard") or DEFAULT_COLLECTION
@@ -0,0 +1,88 @@
+# single-flight request coalescing: concurrent callers asking for the same key share one in-flight computation
+# instead of each running their own. The computation runs in its own task, so a caller going away does not cancel it
+# for the others, and its result is only shared while it is in flight, nothing is cached afterwards.
+from metrics_utils import coalesced_requests
+import asyncio
+
+
+# Chunks of one async iterator replayed to every subscriber, from the first chunk, as they are produced
+class SharedStream:
+    def __init__(self, iterator):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self.pump(iterator))
+
+    async def pump(self, iterator):
+        try:
+            async for chunk in iterator:
+                self.chunks.append(chunk)
+                self.notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self.notify()
+
+    # Wake up the subscribers waiting for a new chunk
+    def notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    async def subscribe(self):
+        index = 0
+        while True:
+            changed = self.changed
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                if self.error:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+class SingleFlight:
+    def __init__(self, kind):
+        self.kind = kind
+        self.calls = {}
+        self.streams = {}
+
+    def forget(self, registry, key, entry):
+        if registry.get(key) is entry:
+            del registry[key]
+
+    # Await factory(), or the identical call already in flight
+    async def run(self, key, factory):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self.calls[key] = task
+
+            def finished(done):
+                self.forget(self.calls, key, done)
+                # Marks the exception as retrieved even when every caller went away
+                if not done.cancelled():
+                    done.exception()
+            task.add_done_callback(finished)
+        else:
+            coalesced_requests.inc(kind=self.kind)
+        return await asyncio.shield(task)
+
+    # Iterate factory(), an async iterator, or replay the identical stream already in flight
+    def stream(self, key, factory):
+        shared = self.streams.get(key)
+        if shared is None:
+            shared = SharedStream(factory())
+            self.streams[key] = shared
+            shared.task.add_done_callback(lambda _: self.forget(self.streams, key, shared))
+        else:
+            coalesced_requests.inc(kind=self.kind)
+        return shared.subscribe()
+
+
+# Key part of a question: case and whitespace do not change the answer
+def normalize_question(question: str) -> str:
+    return " ".join(question.lower().split())
@@ -1,5 +1,5 @@
 import streamlit as st
-from api_utils import get_api_response
+from client_utils import get_client
 
 
 def display_chat_history():
@@ -11,6 +11,12 @@ def display_chat_history():
                 st.markdown(message['content'])
                 
                 
+# Put the already received first token back in front of the rest of the stream
+def chain_tokens(first_token, tokens):
+    yield first_token
+    yield from tokens
+
+
 def display_chat_ui():
     # Initialize session state if it doesn't exist
     if "messages" not in st.session_state:
@@ -32,30 +38,52 @@ def display_chat_ui():
         with st.chat_message("user"):
             st.markdown(prompt)
 
-        # Get API response
-        with st.spinner("Generating response..."):
-            try:
-                response = get_api_response(prompt, st.session_state.session_id, st.session_state.model)
-
-                if response:
-                    st.session_state.session_id = response.get('session_id')
-                    st.session_state.messages.append({"role": "assistant", "content": response['answer']})
-
-                    with st.chat_message("assistant"):
-                        st.markdown(response['answer'])
-
-                    with st.expander("Details"):
-                        st.subheader("Generated Answer")
-                        st.code(response['answer'])
-                        st.subheader("Model Used")
-                        st.code(response['model'])
-                        st.subheader("Session ID")
-                        st.code(response['session_id'])
-                else:
-                    st.error("Failed to get a response from the API. Please try again.")
-            
-            except Exception as e:
-                st.error(f"An error occurred: {e}")
+        # Stream the API response, tokens are rendered as soon as they land
+        try:
+            response = {"answer": "", "session_id": None, "model": st.session_state.model, "sources": [], "cached": False}
+
+            def token_stream():
+                for event in get_client().chat_stream(prompt, st.session_state.session_id, st.session_state.model):
+                    if event["type"] == "sources":
+                        response["session_id"] = event["session_id"]
+                        response["sources"] = event["sources"]
+                    elif event["type"] == "token":
+                        response["answer"] += event["content"]
+                        yield event["content"]
+                    elif event["type"] == "done":
+                        response["session_id"] = event["session_id"]
+                        response["model"] = event["model"]
+                        response["cached"] = event.get("cached", False)
+                    elif event["type"] == "error":
+                        st.error(event["detail"])
+
+            with st.chat_message("assistant"):
+                tokens = token_stream()
+                # Keep the spinner only until the first token arrives
+                with st.spinner("Generating response..."):
+                    first_token = next(tokens, None)
+                if first_token is not None:
+                    st.write_stream(chain_tokens(first_token, tokens))
+
+            if response["answer"]:
+                st.session_state.session_id = response['session_id']
+                st.session_state.messages.append({"role": "assistant", "content": response['answer']})
+
+                with st.expander("Details"):
+                    st.subheader("Generated Answer")
+                    st.code(response['answer'])
+                    st.subheader("Model Used")
+                    st.code(response['model'] + (" (cached answer)" if response['cached'] else ""))
+                    st.subheader("Session ID")
+                    st.code(response['session_id'])
+                    st.subheader("Sources")
+                    for source in response['sources']:
+                        st.text(f"{source['source']} (ID: {source['file_id']}, page: {source['page']})")
+            else:
+                st.error("Failed to get a response from the API. Please try again.")
+
+        except Exception as e:
+            st.error(f"An error occurred: {e}")
                 
     # A button to clear the chat history if there are any
     if st.session_state.messages != []:
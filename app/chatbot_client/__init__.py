@@ -0,0 +1,11 @@
+# python client of the chatbot api, used by the Streamlit app
+#   with ChatbotClient("http://localhost:8000") as client:
+#       for event in client.chat_stream("What are the impacts of rising temperatures?"):
+#           ...
+# Both clients keep a pool of connections, retry with backoff when the api is unreachable or busy,
+# and cache the document list for list_ttl seconds, until an upload or delete.
+from .common import ApiError, TTLCache
+from .sync_client import ChatbotClient
+from .async_client import AsyncChatbotClient
+
+__all__ = ["ApiError", "TTLCache", "ChatbotClient", "AsyncChatbotClient"]
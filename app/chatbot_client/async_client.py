@@ -0,0 +1,136 @@
+# asyncio client over one pooled http session, same methods as ChatbotClient as coroutines and async generators
+from contextlib import asynccontextmanager
+import itertools
+import asyncio
+import json
+
+import httpx
+
+from .common import (DEFAULT_BASE_URL, DEFAULT_TIMEOUT, DEFAULT_CONNECT_TIMEOUT, DEFAULT_MAX_RETRIES, DEFAULT_BACKOFF, DEFAULT_MAX_CONNECTIONS,
+                     DEFAULT_LIST_TTL, TTLCache, build_timeout, build_limits, is_retryable_error, is_retryable_status, retry_delay, raise_for_status,
+                     rewind_files, chat_payload)
+
+
+class AsyncChatbotClient:
+    def __init__(self, base_url=DEFAULT_BASE_URL, timeout=DEFAULT_TIMEOUT, connect_timeout=DEFAULT_CONNECT_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff=DEFAULT_BACKOFF, max_connections=DEFAULT_MAX_CONNECTIONS, list_ttl=DEFAULT_LIST_TTL):
+        self.http = httpx.AsyncClient(base_url=base_url, timeout=build_timeout(timeout, connect_timeout), limits=build_limits(max_connections))
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.list_cache = TTLCache(list_ttl)
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    # Send a request, retrying with backoff on connection errors and on answers meaning it was not processed
+    async def request(self, method, path, **kwargs):
+        for attempt in itertools.count():
+            rewind_files(kwargs.get("files"))
+            try:
+                response = await self.http.request(method, path, **kwargs)
+            except httpx.TransportError as e:
+                if attempt >= self.max_retries or not is_retryable_error(method, e):
+                    raise
+                await asyncio.sleep(retry_delay(attempt, self.backoff))
+                continue
+
+            if is_retryable_status(method, response.status_code) and attempt < self.max_retries:
+                await asyncio.sleep(retry_delay(attempt, self.backoff, response))
+                continue
+            raise_for_status(response)
+            return response
+
+    # Open a streamed response, retried like request() until its first byte is handed to the caller
+    @asynccontextmanager
+    async def stream(self, method, path, **kwargs):
+        for attempt in itertools.count():
+            started = False
+            try:
+                async with self.http.stream(method, path, **kwargs) as response:
+                    if is_retryable_status(method, response.status_code) and attempt < self.max_retries:
+                        delay = retry_delay(attempt, self.backoff, response)
+                    else:
+                        if response.status_code >= 400:
+                            await response.aread()
+                            raise_for_status(response)
+                        started = True
+                        yield response
+                        return
+            except httpx.TransportError as e:
+                if started or attempt >= self.max_retries or not is_retryable_error(method, e):
+                    raise
+                delay = retry_delay(attempt, self.backoff)
+            await asyncio.sleep(delay)
+
+    # Newline-delimited json events of a streamed response
+    async def stream_events(self, method, path, **kwargs):
+        async with self.stream(method, path, **kwargs) as response:
+            async for line in response.aiter_lines():
+                if line:
+                    yield json.loads(line)
+
+    async def chat(self, question, session_id=None, model="gpt-3.5-turbo", **options):
+        return (await self.request("POST", "/chat", json=chat_payload(question, session_id, model, options))).json()
+
+    async def chat_stream(self, question, session_id=None, model="gpt-3.5-turbo", **options):
+        async for event in self.stream_events("POST", "/chat/stream", json=chat_payload(question, session_id, model, options)):
+            yield event
+
+    async def chat_batch(self, items, model="gpt-3.5-turbo", **options):
+        data = {"items": [{"question": item} if isinstance(item, str) else item for item in items], "model": model}
+        data.update({name: value for name, value in options.items() if value is not None})
+        async for event in self.stream_events("POST", "/chat/batch", json=data):
+            yield event
+
+    async def search(self, query, k=10, offset=0, **filters):
+        data = {"query": query, "k": k, "offset": offset}
+        data.update({name: value for name, value in filters.items() if value is not None})
+        return (await self.request("POST", "/search", json=data)).json()
+
+    # Upload one document from a file object (read synchronously by httpx), see ChatbotClient.upload_document
+    async def upload_document(self, file, filename=None, content_type=None, shard=None):
+        response = await self.request("POST", "/upload", files={"file": (filename or getattr(file, "name", "document"), file, content_type)},
+                                      data={"shard": shard} if shard else None)
+        self.list_cache.invalidate()
+        return response.json()
+
+    async def upload_documents(self, files, shard=None):
+        response = await self.request("POST", "/upload/bulk", files=[("files", (filename, file)) for filename, file in files],
+                                      data={"shard": shard} if shard else None)
+        self.list_cache.invalidate()
+        return response.json()
+
+    async def get_job(self, job_id):
+        job = (await self.request("GET", f"/jobs/{job_id}")).json()
+        if job["status"] == "completed":
+            self.list_cache.invalidate()
+        return job
+
+    async def list_documents(self, refresh=False):
+        documents = None if refresh else self.list_cache.get("documents")
+        if documents is None:
+            documents = (await self.request("GET", "/list")).json()
+            self.list_cache.set("documents", documents)
+        return documents
+
+    async def delete_document(self, file_id):
+        response = await self.request("POST", "/delete", json={"file_id": file_id})
+        self.list_cache.invalidate()
+        return response.json()
+
+    async def delete_documents(self, file_ids):
+        response = await self.request("POST", "/delete/batch", json={"file_ids": list(file_ids)})
+        self.list_cache.invalidate()
+        return response.json()
+
+    async def is_ready(self):
+        try:
+            return (await self.http.get("/health/ready")).status_code == 200
+        except httpx.TransportError:
+            return False
@@ -0,0 +1,114 @@
+# settings and helpers shared by the sync and async clients
+import threading
+import random
+import time
+import os
+
+import httpx
+
+# Defaults, overridable per client or with environment variables
+DEFAULT_BASE_URL = os.getenv("CHATBOT_API_URL", "http://localhost:8000")
+DEFAULT_TIMEOUT = float(os.getenv("CHATBOT_API_TIMEOUT", "120")) # seconds to wait for a response, chat answers can be slow
+DEFAULT_CONNECT_TIMEOUT = float(os.getenv("CHATBOT_API_CONNECT_TIMEOUT", "5"))
+DEFAULT_MAX_RETRIES = int(os.getenv("CHATBOT_API_MAX_RETRIES", "3"))
+DEFAULT_BACKOFF = float(os.getenv("CHATBOT_API_BACKOFF", "0.5")) # first retry delay in seconds, doubled on every attempt
+DEFAULT_MAX_CONNECTIONS = int(os.getenv("CHATBOT_API_MAX_CONNECTIONS", "10"))
+DEFAULT_LIST_TTL = float(os.getenv("CHATBOT_API_LIST_TTL", "30")) # seconds the document list is served from the client cache
+
+# Answers after which a GET can be sent again
+RETRY_STATUSES = {429, 502, 503, 504}
+
+# Answers meaning the api did not process the request, the only ones a POST or DELETE is sent again after:
+# a 502 or 504 from a proxy may come after the api ran the request
+UNPROCESSED_STATUSES = {429, 503}
+
+# Transport errors raised before the request reached the server, any method can be retried after them
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+# Error answer of the api, detail is the "detail" field of FastAPI errors or the raw body
+class ApiError(Exception):
+    def __init__(self, status_code, detail):
+        super().__init__(f"{status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+
+# Values cached for ttl seconds, used for the document list
+class TTLCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.monotonic() - entry[0] < self.ttl:
+                return entry[1]
+            return None
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def build_timeout(timeout, connect_timeout):
+    return httpx.Timeout(timeout, connect=connect_timeout)
+
+
+def build_limits(max_connections):
+    return httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+
+
+# Whether a failed attempt can be retried: the request never reached the server, or only a read was interrupted
+def is_retryable_error(method, error):
+    return isinstance(error, CONNECT_ERRORS) or (method == "GET" and isinstance(error, httpx.TransportError))
+
+
+# Whether an error answer can be retried, requests other than GET only when the api surely did not process them
+def is_retryable_status(method, status_code):
+    return status_code in (RETRY_STATUSES if method == "GET" else UNPROCESSED_STATUSES)
+
+
+# Exponential backoff with full jitter, a Retry-After header of the answer takes precedence
+def retry_delay(attempt, backoff, response=None):
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return random.uniform(0, backoff * 2 ** attempt)
+
+
+# Raise an ApiError for an error answer, its body must have been read
+def raise_for_status(response):
+    if response.status_code < 400:
+        return
+    try:
+        detail = response.json().get("detail", response.text)
+    except ValueError:
+        detail = response.text
+    raise ApiError(response.status_code, detail)
+
+
+# Put the uploaded files back at their start before sending them again
+def rewind_files(files):
+    for value in (files.values() if isinstance(files, dict) else [value for _, value in files or []]):
+        file = value[1] if isinstance(value, tuple) else value
+        if hasattr(file, "seek"):
+            file.seek(0)
+
+
+# Body of the chat endpoints, the options are the optional QueryInput fields (k, fetch_k, mmr_lambda, shards)
+def chat_payload(question, session_id, model, options):
+    data = {"question": question, "model": model}
+    if session_id:
+        data["session_id"] = session_id
+    data.update({name: value for name, value in options.items() if value is not None})
+    return data
@@ -0,0 +1,146 @@
+# blocking client over one pooled http session
+from contextlib import contextmanager
+import itertools
+import json
+import time
+
+import httpx
+
+from .common import (DEFAULT_BASE_URL, DEFAULT_TIMEOUT, DEFAULT_CONNECT_TIMEOUT, DEFAULT_MAX_RETRIES, DEFAULT_BACKOFF, DEFAULT_MAX_CONNECTIONS,
+                     DEFAULT_LIST_TTL, TTLCache, build_timeout, build_limits, is_retryable_error, is_retryable_status, retry_delay, raise_for_status,
+                     rewind_files, chat_payload)
+
+
+class ChatbotClient:
+    def __init__(self, base_url=DEFAULT_BASE_URL, timeout=DEFAULT_TIMEOUT, connect_timeout=DEFAULT_CONNECT_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff=DEFAULT_BACKOFF, max_connections=DEFAULT_MAX_CONNECTIONS, list_ttl=DEFAULT_LIST_TTL):
+        self.http = httpx.Client(base_url=base_url, timeout=build_timeout(timeout, connect_timeout), limits=build_limits(max_connections))
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.list_cache = TTLCache(list_ttl)
+
+    def close(self):
+        self.http.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Send a request, retrying with backoff on connection errors and on answers meaning it was not processed
+    def request(self, method, path, **kwargs):
+        for attempt in itertools.count():
+            rewind_files(kwargs.get("files"))
+            try:
+                response = self.http.request(method, path, **kwargs)
+            except httpx.TransportError as e:
+                if attempt >= self.max_retries or not is_retryable_error(method, e):
+                    raise
+                time.sleep(retry_delay(attempt, self.backoff))
+                continue
+
+            if is_retryable_status(method, response.status_code) and attempt < self.max_retries:
+                time.sleep(retry_delay(attempt, self.backoff, response))
+                continue
+            raise_for_status(response)
+            return response
+
+    # Open a streamed response, retried like request() until its first byte is handed to the caller
+    @contextmanager
+    def stream(self, method, path, **kwargs):
+        for attempt in itertools.count():
+            started = False
+            try:
+                with self.http.stream(method, path, **kwargs) as response:
+                    if is_retryable_status(method, response.status_code) and attempt < self.max_retries:
+                        delay = retry_delay(attempt, self.backoff, response)
+                    else:
+                        if response.status_code >= 400:
+                            response.read()
+                            raise_for_status(response)
+                        started = True
+                        yield response
+                        return
+            except httpx.TransportError as e:
+                if started or attempt >= self.max_retries or not is_retryable_error(method, e):
+                    raise
+                delay = retry_delay(attempt, self.backoff)
+            time.sleep(delay)
+
+    # Newline-delimited json events of a streamed response
+    def stream_events(self, method, path, **kwargs):
+        with self.stream(method, path, **kwargs) as response:
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+
+    # Answer of /chat as a dict (answer, session_id, model, cached)
+    def chat(self, question, session_id=None, model="gpt-3.5-turbo", **options):
+        return self.request("POST", "/chat", json=chat_payload(question, session_id, model, options)).json()
+
+    # Events of /chat/stream as they arrive: sources, then tokens, then done (or error)
+    def chat_stream(self, question, session_id=None, model="gpt-3.5-turbo", **options):
+        yield from self.stream_events("POST", "/chat/stream", json=chat_payload(question, session_id, model, options))
+
+    # Events of /chat/batch as the items complete, then the summary; items are questions or {"question", "session_id"} dicts
+    def chat_batch(self, items, model="gpt-3.5-turbo", **options):
+        data = {"items": [{"question": item} if isinstance(item, str) else item for item in items], "model": model}
+        data.update({name: value for name, value in options.items() if value is not None})
+        yield from self.stream_events("POST", "/chat/batch", json=data)
+
+    # Ranked chunks nearest to the query, filters are file_ids and shards
+    def search(self, query, k=10, offset=0, **filters):
+        data = {"query": query, "k": k, "offset": offset}
+        data.update({name: value for name, value in filters.items() if value is not None})
+        return self.request("POST", "/search", json=data).json()
+
+    # Upload one document (a path or a file object), returns the queued job or the duplicate it matches
+    def upload_document(self, file, filename=None, content_type=None, shard=None):
+        if isinstance(file, str):
+            with open(file, "rb") as opened:
+                return self.upload_document(opened, filename or file.rsplit("/", 1)[-1], content_type, shard)
+        response = self.request("POST", "/upload", files={"file": (filename or getattr(file, "name", "document"), file, content_type)},
+                                data={"shard": shard} if shard else None)
+        self.list_cache.invalidate()
+        return response.json()
+
+    # Upload many documents and archives at once, files are (filename, file object) pairs.
+    # Returns the queued bulk job, get_job(job_id)["result"] holds the result of every file once it completes
+    def upload_documents(self, files, shard=None):
+        response = self.request("POST", "/upload/bulk", files=[("files", (filename, file)) for filename, file in files],
+                                data={"shard": shard} if shard else None)
+        self.list_cache.invalidate()
+        return response.json()
+
+    # Progress of an ingestion job, the document list is refreshed once a job completes
+    def get_job(self, job_id):
+        job = self.request("GET", f"/jobs/{job_id}").json()
+        if job["status"] == "completed":
+            self.list_cache.invalidate()
+        return job
+
+    # Uploaded documents, served from the client cache for list_ttl seconds unless refresh is set
+    def list_documents(self, refresh=False):
+        documents = None if refresh else self.list_cache.get("documents")
+        if documents is None:
+            documents = self.request("GET", "/list").json()
+            self.list_cache.set("documents", documents)
+        return documents
+
+    def delete_document(self, file_id):
+        response = self.request("POST", "/delete", json={"file_id": file_id})
+        self.list_cache.invalidate()
+        return response.json()
+
+    def delete_documents(self, file_ids):
+        response = self.request("POST", "/delete/batch", json={"file_ids": list(file_ids)})
+        self.list_cache.invalidate()
+        return response.json()
+
+    # True once the api has warmed up and answers /health/ready
+    def is_ready(self):
+        try:
+            return self.http.get("/health/ready").status_code == 200
+        except httpx.TransportError:
+            return False
@@ -0,0 +1,9 @@
+import streamlit as st
+from chatbot_client import ChatbotClient
+
+
+# One pooled api client shared by every session and rerun of the app,
+# the api address and timeouts come from the CHATBOT_API_* environment variables
+@st.cache_resource
+def get_client():
+    return ChatbotClient()
@@ -1,17 +1,41 @@
 import streamlit as st
-from api_utils import upload_document, list_documents, delete_document
+from client_utils import get_client
 import time
 
-def get_documents():
-    return list_documents()
 
-def refresh_document_list():
+# The client caches the list for a while and drops it on upload or delete, so reruns do not call /list every time
+def refresh_document_list(refresh=False):
     try:
-        st.session_state.documents = get_documents()
+        st.session_state.documents = get_client().list_documents(refresh=refresh)
     except Exception as e:
         st.sidebar.error(f"Error fetching documents: {str(e)}")
 
 
+# Poll an ingestion job until it is finished, showing its progress in the sidebar
+def wait_for_job(job_id, poll_interval=0.5):
+    progress = st.sidebar.progress(0, text="Queued for indexing...")
+    while True:
+        try:
+            job = get_client().get_job(job_id)
+        except Exception as e:
+            progress.empty()
+            st.sidebar.error(f"Failed to fetch job status: {str(e)}")
+            return None
+
+        if job.get('total_pages'):
+            progress.progress(min(job['pages_loaded'] / job['total_pages'], 1.0),
+                              text=f"{job['stage'].capitalize()}: page {job['pages_loaded']}/{job['total_pages']}, {job['chunks_indexed']} chunks so far...")
+        elif job['chunks_indexed']:
+            progress.progress(0, text=f"{job['stage'].capitalize()}: {job['chunks_indexed']} chunks so far...")
+        else:
+            progress.progress(0, text=f"{job['stage'].capitalize()}...")
+
+        if job['status'] in ('completed', 'failed'):
+            progress.empty()
+            return job
+        time.sleep(poll_interval)
+
+
 def display_sidebar():
     refresh_document_list()
     
@@ -30,14 +54,26 @@ def display_sidebar():
         if st.sidebar.button("Upload"):
             with st.spinner("Uploading file..."):
                 try:
-                    upload_response = upload_document(uploaded_file)
-        
-                    if upload_response:
-                        st.sidebar.success(f"Uploaded with ID {upload_response['file_id']}.")
+                    upload_response = get_client().upload_document(uploaded_file, uploaded_file.name, uploaded_file.type)
+                except Exception as e:
+                    upload_response = None
+                    st.sidebar.error(f"Error during upload: {str(e)}")
+
+            if upload_response and upload_response['status'] == 'duplicate':
+                st.sidebar.info(f"Already uploaded with ID {upload_response['file_id']}.")
+
+            elif upload_response:
+                try:
+                    job = wait_for_job(upload_response['job_id'])
+
+                    if job and job['status'] == 'completed':
+                        st.sidebar.success(f"Uploaded with ID {job['file_id']} ({job['chunk_count']} new chunks, {job['chunks_reused']} unchanged).")
                         refresh_document_list()
+                    elif job:
+                        st.sidebar.error(f"Failed to index {job['filename']}: {job['error']}")
                 
                 except Exception as e:
-                    st.sidebar.error(f"Error during upload: {str(e)}")
+                    st.sidebar.error(f"Error during indexing: {str(e)}")
 
     # List all uploaded documents
     st.sidebar.header("Uploaded Documents")
@@ -52,7 +88,7 @@ def display_sidebar():
         # refresh button
         if st.sidebar.button("Refresh"):
             with st.spinner("Refreshing document..."):
-                refresh_document_list()
+                refresh_document_list(refresh=True)
             
         # Delete functionality
         # a dictionary mapping IDs to filenames
@@ -68,7 +104,7 @@ def display_sidebar():
             if selected_file_id:
                 with st.spinner("Deleting document..."):
                     try:
-                        delete_response = delete_document(selected_file_id)
+                        delete_response = get_client().delete_document(selected_file_id)
                             
                         if delete_response:
                             st.sidebar.success(delete_response['message'])
@@ -0,0 +1,89 @@
+# Benchmark of the admission control of the ai model calls under a burst larger than the provider can take.
+# The provider is the fake chat model behind a semaphore of --provider-capacity concurrent completions:
+# without admission every request queues at the provider and they all slow down together, with admission
+# the requests beyond the queue depth are shed at once with a Retry-After and the admitted ones stay fast.
+# No OpenAI call is made, --error-rate makes a share of the fake completions fail.
+#   python benchmarks/bench_admission.py --requests 200 --concurrency 8 --queue-depth 16
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+from model_utils import FakeChatModel
+from admission_utils import AdmissionRejected, ModelScheduler
+
+QUESTION = "What are the impacts of rising temperatures?"
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# Fire every request at once, each one through acquire() when a scheduler is given
+async def burst(model, provider, requests, scheduler=None):
+    outcomes = {"ok": [], "error": [], "shed": [], "retry_after": []}
+
+    async def one():
+        start = time.perf_counter()
+        ticket = None
+        try:
+            if scheduler:
+                ticket = await scheduler.acquire()
+            async with provider:
+                await model.ainvoke(QUESTION)
+            outcomes["ok"].append(time.perf_counter() - start)
+        except AdmissionRejected as e:
+            outcomes["shed"].append(time.perf_counter() - start)
+            outcomes["retry_after"].append(e.retry_after)
+        except Exception:
+            outcomes["error"].append(time.perf_counter() - start)
+        finally:
+            if ticket:
+                ticket.release()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    outcomes["seconds"] = time.perf_counter() - start
+    return outcomes
+
+
+def report(name, outcomes):
+    ok = outcomes["ok"]
+    print(f"{name}")
+    print(f"  answered: {len(ok):5d}   p50 {percentile(ok, 0.5) * 1000:8.1f} ms   p95 {percentile(ok, 0.95) * 1000:8.1f} ms")
+    print(f"  errors:   {len(outcomes['error']):5d}")
+    if outcomes["shed"]:
+        print(f"  shed:     {len(outcomes['shed']):5d}   p95 {percentile(outcomes['shed'], 0.95) * 1000:8.1f} ms   "
+              f"retry-after {min(outcomes['retry_after'])}-{max(outcomes['retry_after'])} s")
+    print(f"  burst drained in {outcomes['seconds']:.2f}s")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--provider-capacity", type=int, default=8, help="completions the fake provider runs at the same time")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--queue-depth", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--token-latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    args = parser.parse_args()
+
+    model = FakeChatModel(model_name="gpt-4o", latency=args.latency, token_latency=args.token_latency, error_rate=args.error_rate)
+    print(f"requests: {args.requests}, provider capacity: {args.provider_capacity}, fake latency: {args.latency}s, error rate: {args.error_rate}")
+
+    report("without admission control", await burst(model, asyncio.Semaphore(args.provider_capacity), args.requests))
+    scheduler = ModelScheduler("gpt-4o", args.concurrency, args.queue_depth)
+    report(f"with admission control (concurrency {args.concurrency}, queue depth {args.queue_depth})",
+           await burst(model, asyncio.Semaphore(args.provider_capacity), args.requests, scheduler))
+    print(f"  scheduler: {scheduler.stats()}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,58 @@
+# Micro-benchmark of the per-request overhead of getting a rag chain,
+# rebuilding it on every request (before) vs. reusing the registry (after).
+# Uses a local fake llm and retriever so no OpenAI call is made.
+#   python benchmarks/bench_chain_registry.py --requests 200
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+from langchain_core.documents import Document
+from langchain_core.language_models import FakeListChatModel
+from langchain_core.runnables import RunnableLambda
+import langchain_utils
+
+DOCUMENTS = [Document(page_content="Rising temperatures melt glaciers.", metadata={"file_id": 1})]
+
+
+def fake_llm(model):
+    return FakeListChatModel(responses=["A fake answer."])
+
+
+def fake_retriever():
+    return RunnableLambda(lambda question: DOCUMENTS)
+
+
+# Time get_chain() + invoke() for each request and return the mean in milliseconds
+def run(get_chain, requests):
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        get_chain("gpt-3.5-turbo").invoke({"input": "What are the impacts of rising temperatures?", "chat_history": []})
+        timings.append(time.perf_counter() - start)
+    return sum(timings) / len(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    langchain_utils.initialize_llm = fake_llm
+    langchain_utils.initialize_retriever = fake_retriever
+    langchain_utils.invalidate_rag_chains()
+
+    before = run(langchain_utils.build_rag_chain, args.requests)
+    after = run(langchain_utils.get_rag_chain, args.requests)
+
+    print(f"requests:                 {args.requests}")
+    print(f"rebuild every request:    {before:.3f} ms/request")
+    print(f"registry (built once):    {after:.3f} ms/request")
+    print(f"speedup:                  {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# Benchmark of the chat history lookup of /chat on a large application_logs table,
+# before (fresh connection per call, no index) vs. after (the path /chat awaits: aget_history_window on the
+# pooled async WAL connections and the (session_id, created_at) index), one lookup at a time and --concurrency at once.
+# The summary model is never called, the background summary updates are left out.
+#   python benchmarks/bench_chat_history.py --rows 1000000 --sessions 50000
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+
+# Fill application_logs with rows spread over the sessions, a few turns each
+def fill_logs(db_name, rows, sessions):
+    conn = sqlite3.connect(db_name)
+    with conn:
+        conn.executemany('INSERT INTO application_logs (session_id, user_query, gpt_response, model, created_at) VALUES (?, ?, ?, ?, ?)',
+                         ((f"session-{random.randrange(sessions)}", f"question {i}", f"answer {i} " * 20, "gpt-3.5-turbo",
+                           f"2024-01-01 00:{(i // 60) % 60:02d}:{i % 60:02d}") for i in range(rows)))
+    conn.close()
+
+
+# get_chat_history as it was: a new connection and a full scan of application_logs per call
+def baseline_get_chat_history(db_name, session_id):
+    conn = sqlite3.connect(db_name)
+    conn.row_factory = sqlite3.Row
+    messages = []
+    for row in conn.execute('SELECT user_query, gpt_response FROM application_logs WHERE session_id = ? ORDER BY created_at', (session_id,)):
+        messages.extend([{"role": "human", "content": row['user_query']}, {"role": "ai", "content": row['gpt_response']}])
+    conn.close()
+    return messages
+
+
+def measure(get_history, session_ids):
+    timings = []
+    for session_id in session_ids:
+        start = time.perf_counter()
+        get_history(session_id)
+        timings.append((time.perf_counter() - start) * 1000)
+    return summarize(timings)
+
+
+def summarize(timings):
+    timings.sort()
+    return statistics.mean(timings), timings[len(timings) // 2], timings[int(len(timings) * 0.95)]
+
+
+# Time each awaited lookup, `concurrency` of them in flight at once on one event loop
+async def ameasure(aget_history, session_ids, concurrency=1):
+    timings = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(session_id):
+        async with semaphore:
+            start = time.perf_counter()
+            await aget_history(session_id)
+            timings.append((time.perf_counter() - start) * 1000)
+
+    await asyncio.gather(*(one(session_id) for session_id in session_ids))
+    return summarize(timings)
+
+
+async def measure_async_path(session_ids, concurrency):
+    import db_utils
+    import history_utils
+    history_utils.schedule_summary_update = lambda session_id, before_id: None
+    try:
+        await history_utils.aget_history_window(session_ids[0]) # opens the first pooled connection
+        return (await ameasure(history_utils.aget_history_window, session_ids),
+                await ameasure(history_utils.aget_history_window, session_ids, concurrency))
+    finally:
+        await db_utils.close_async_db_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--sessions", type=int, default=50_000)
+    parser.add_argument("--lookups", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    db_name = os.path.join(tempfile.mkdtemp(prefix="bench_history_"), "bench.db")
+    os.environ["DB_NAME"] = db_name
+    import db_utils
+    db_utils.init_db()
+
+    print(f"filling {args.rows} rows over {args.sessions} sessions into {db_name}")
+    fill_logs(db_name, args.rows, args.sessions)
+    session_ids = [f"session-{random.randrange(args.sessions)}" for _ in range(args.lookups)]
+
+    conn = sqlite3.connect(db_name)
+    conn.execute('DROP INDEX idx_application_logs_session_created')
+    conn.execute('PRAGMA user_version = 0')
+    conn.close()
+    before = measure(lambda session_id: baseline_get_chat_history(db_name, session_id), session_ids)
+
+    db_utils.run_migrations()
+    after, after_concurrent = asyncio.run(measure_async_path(session_ids, args.concurrency))
+
+    print(f"{'':34}{'mean':>10}{'p50':>10}{'p95':>10}")
+    print(f"{'before (scan, new conn)':34}" + "".join(f"{value:>8.3f}ms" for value in before))
+    print(f"{'after (index, async pool, WAL)':34}" + "".join(f"{value:>8.3f}ms" for value in after))
+    print(f"{f'after, {args.concurrency} concurrent':34}" + "".join(f"{value:>8.3f}ms" for value in after_concurrent))
+    print(f"mean speedup: {before[0] / after[0]:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# Cold start benchmark of the api process: time to import main, and with --server the time until
+# uvicorn answers the liveness check and until the readiness check passes.
+# --compare REV measures another revision the same way from a temporary git worktree, e.g. the commit
+# before the lazy initialization. Runs with the fake models unless --openai is given, revisions
+# older than the fake models still need OPENAI_API_KEY.
+#   python benchmarks/bench_cold_start.py --repeat 5 --server --compare HEAD~1
+import argparse
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def environment(api_dir, args):
+    env = dict(os.environ, PYTHONPATH=api_dir)
+    if not args.openai:
+        env.setdefault("LLM_PROVIDER", "fake")
+        env.setdefault("EMBEDDINGS_PROVIDER", "fake")
+        env.setdefault("OPENAI_API_KEY", "unused")
+    return env
+
+
+# Seconds to import main in a fresh interpreter, run in an empty directory so no database or index is reused
+def import_time(api_dir, args):
+    workdir = tempfile.mkdtemp(prefix="bench_cold_start_")
+    try:
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import main"], cwd=workdir, env=environment(api_dir, args), check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return time.perf_counter() - start
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def status_code(url):
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None
+
+
+# Seconds from launching uvicorn until /health/live answers and until /health/ready returns 200.
+# Revisions without the health endpoints are live once /docs answers and ready at the same time.
+def server_times(api_dir, args):
+    workdir = tempfile.mkdtemp(prefix="bench_cold_start_")
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:fapi", "--port", str(port)], cwd=workdir,
+                               env=environment(api_dir, args), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    start = time.perf_counter()
+    live = ready = None
+    try:
+        while time.perf_counter() - start < args.timeout and process.poll() is None:
+            if live is None:
+                if status_code(base + "/health/live") == 200:
+                    live = time.perf_counter() - start
+                elif status_code(base + "/docs") == 200:
+                    live = ready = time.perf_counter() - start
+                    break
+            elif status_code(base + "/health/ready") == 200:
+                ready = time.perf_counter() - start
+                break
+            time.sleep(0.02)
+        return live, ready
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def summarize(label, values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return f"{label:<24}{'n/a':>10}"
+    return f"{label:<24}{statistics.mean(values):>10.3f}{min(values):>10.3f}{max(values):>10.3f}"
+
+
+def measure(name, api_dir, args):
+    print(f"\n{name}")
+    print(f"{'':<24}{'mean s':>10}{'min s':>10}{'max s':>10}")
+    print(summarize("import main", [import_time(api_dir, args) for _ in range(args.repeat)]))
+    if args.server:
+        times = [server_times(api_dir, args) for _ in range(args.repeat)]
+        print(summarize("uvicorn to live", [live for live, _ in times]))
+        print(summarize("uvicorn to ready", [ready for _, ready in times]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--server", action="store_true", help="also time uvicorn until the liveness and readiness checks pass")
+    parser.add_argument("--compare", help="git revision to measure as well, e.g. HEAD~1")
+    parser.add_argument("--openai", action="store_true", help="use the configured providers instead of the fake models")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+
+    measure("working tree", os.path.join(ROOT, "api"), args)
+
+    if args.compare:
+        worktree = tempfile.mkdtemp(prefix="bench_cold_start_rev_")
+        subprocess.run(["git", "-C", ROOT, "worktree", "add", "--detach", worktree, args.compare], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            measure(args.compare, os.path.join(worktree, "api"), args)
+        finally:
+            subprocess.run(["git", "-C", ROOT, "worktree", "remove", "--force", worktree], check=False)
+
+
+if __name__ == "__main__":
+    main()
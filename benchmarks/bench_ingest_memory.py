@@ -0,0 +1,130 @@
+# Peak memory of document ingestion on a large synthetic PDF, whole-document loading vs. the streaming pipeline.
+# Every mode runs in its own process and reports its peak resident memory (ru_maxrss):
+#   load     loader.load() then split everything at once, as ingestion used to do
+#   stream   iter_document_chunks, pages loaded and split one at a time
+#   index    the whole ingestion job (stream, embed with the fake embeddings, write to Chroma) into a temporary store
+# Peak memory of load grows with the file, stream stays flat: the run fails when its peak is above --max-stream-mb.
+# index is not bounded: the in-memory BM25 index keeps the terms and text of every chunk, so it grows with
+# the indexed text, but it never holds the whole document or its embeddings at once.
+#   python benchmarks/bench_ingest_memory.py --size-mb 300 --modes load stream
+import argparse
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+API_DIR = os.path.join(ROOT, "api")
+
+WORDS = ("climate energy development policy model data learning water growth health education "
+         "market carbon network system research goal partnership impact risk").split()
+
+
+# Writes a text-only PDF of about size_mb megabytes, page_kb of text per page, one object at a time
+def write_synthetic_pdf(path, size_mb, page_kb):
+    pages = max(1, size_mb * 1024 // page_kb)
+    lines_per_page = page_kb * 1024 // 80
+    rng = random.Random(0)
+    offsets = {}
+    with open(path, "wb") as pdf:
+        pdf.write(b"%PDF-1.4\n")
+
+        def write_object(number, body):
+            offsets[number] = pdf.tell()
+            pdf.write(f"{number} 0 obj\n".encode() + body + b"\nendobj\n")
+
+        write_object(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+        for page in range(pages):
+            lines = [" ".join(rng.choice(WORDS) for _ in range(11)) for _ in range(lines_per_page)]
+            content = ("BT /F1 8 Tf 9 TL 20 820 Td " + " ".join(f"({line}) Tj T*" for line in lines) + " ET").encode()
+            page_number = 4 + 2 * page
+            write_object(page_number, f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents {page_number + 1} 0 R >>".encode())
+            write_object(page_number + 1, f"<< /Length {len(content)} >>\nstream\n".encode() + content + b"\nendstream")
+        kids = " ".join(f"{4 + 2 * page} 0 R" for page in range(pages))
+        write_object(2, f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode())
+        write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+
+        xref = pdf.tell()
+        count = max(offsets) + 1
+        pdf.write(f"xref\n0 {count}\n0000000000 65535 f \n".encode())
+        for number in range(1, count):
+            pdf.write(f"{offsets[number]:010d} 00000 n \n".encode())
+        pdf.write(f"trailer\n<< /Size {count} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return pages
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Runs one mode in this process, prints "<chunks> <seconds> <peak MB>"
+def run_child(mode, pdf_path):
+    sys.path.insert(0, API_DIR)
+    start = time.perf_counter()
+    if mode == "load":
+        from document_utils import load_document, split_documents
+        chunks = len(split_documents(load_document(pdf_path)))
+    elif mode == "stream":
+        from document_utils import iter_document_chunks
+        chunks = sum(1 for _ in iter_document_chunks(pdf_path))
+    else:
+        import uuid
+        from db_utils import insert_ingestion_job, get_ingestion_job
+        from job_utils import run_ingestion_job, staging_path
+        job_id = str(uuid.uuid4())
+        staged_path = staging_path(job_id, os.path.basename(pdf_path))
+        os.link(pdf_path, staged_path)
+        insert_ingestion_job(job_id, os.path.basename(pdf_path), staged_path)
+        run_ingestion_job(job_id, os.path.basename(pdf_path), staged_path)
+        job = get_ingestion_job(job_id)
+        if job['status'] != 'completed':
+            raise RuntimeError(job['error'])
+        chunks = job['chunks_indexed']
+    print(chunks, time.perf_counter() - start, peak_rss_mb())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=300)
+    parser.add_argument("--page-kb", type=int, default=32)
+    parser.add_argument("--modes", nargs="+", default=["load", "stream"], choices=["load", "stream", "index"])
+    parser.add_argument("--max-stream-mb", type=float, default=200, help="highest peak memory of the stream mode, whatever the file size")
+    parser.add_argument("--child", nargs=2, metavar=("MODE", "PDF"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(*args.child)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="bench_ingest_memory_")
+    try:
+        pdf_path = os.path.join(workdir, "synthetic.pdf")
+        pages = write_synthetic_pdf(pdf_path, args.size_mb, args.page_kb)
+        print(f"synthetic PDF: {os.path.getsize(pdf_path) / 1024 / 1024:.0f} MB, {pages} pages")
+
+        # The index mode writes its database, Chroma store and logs into the temporary directory
+        env = dict(os.environ, LLM_PROVIDER="fake", EMBEDDINGS_PROVIDER="fake", FAKE_EMBEDDING_LATENCY="0",
+                   FAKE_EMBEDDING_SIZE=os.getenv("FAKE_EMBEDDING_SIZE", "64"), DB_NAME=os.path.join(workdir, "bench.db"))
+        print(f"{'mode':8}{'chunks':>10}{'seconds':>10}{'peak MB':>10}")
+        peaks = {}
+        for mode in args.modes:
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", mode, pdf_path], cwd=workdir, env=env,
+                                    check=True, capture_output=True, text=True).stdout.split()
+            chunks, seconds, peak = output[-3:]
+            peaks[mode] = float(peak)
+            print(f"{mode:8}{int(chunks):>10}{float(seconds):>10.1f}{float(peak):>10.0f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if peaks.get("stream", 0) > args.max_stream_mb:
+        sys.exit(f"FAIL: stream peaked at {peaks['stream']:.0f} MB, above --max-stream-mb {args.max_stream_mb:.0f}")
+    if "stream" in peaks:
+        print(f"stream stayed under {args.max_stream_mb:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# Retrieval benchmark on the bundled documents/ corpus and documents/testquestions/question.txt.
+# Reports document-level recall@k, mean latency and mean context size (characters put in the prompt)
+# of vector, lexical and hybrid retrieval, plus how often the hybrid retriever took the lexical fast path.
+# --mmr-lambda 1 turns the diversity re-ranking off, overlapping neighbours are merged either way.
+# Vector and hybrid modes embed with the configured embeddings (OpenAI needs OPENAI_API_KEY,
+# EMBEDDINGS_PROVIDER=fake runs offline but its recall is meaningless), the lexical mode always runs offline.
+#   python benchmarks/bench_retrieval.py --modes vector lexical hybrid --k 2
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "api"))
+
+from langchain_core.runnables import RunnableConfig
+from document_utils import load_and_split_document
+from bm25_utils import BM25Index, HybridRetriever
+
+DOCUMENTS_DIR = os.path.join(ROOT, "documents")
+QUESTIONS_FILE = os.path.join(DOCUMENTS_DIR, "testquestions", "question.txt")
+
+# Which file answers each section of question.txt
+SECTION_FILES = {
+    "Climate Change": "climate_change.docx",
+    "Artificial Intelligence": "ai_applications.pdf",
+    "Sustainable Development": "sustainable_development.pdf",
+}
+
+
+# (question, expected filename) pairs from question.txt
+def load_questions():
+    questions = []
+    expected = None
+    with open(QUESTIONS_FILE, encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("Questions for Document"):
+                expected = next(filename for title, filename in SECTION_FILES.items() if title in line)
+            else:
+                questions.append((line, expected))
+    return questions
+
+
+# In-memory Chroma collection with the corpus, only built when a mode needs embeddings
+def build_vectorstore(chunks, ids):
+    from langchain_chroma import Chroma
+    from model_utils import create_embeddings
+    from cache_utils import CachedEmbeddings
+
+    embeddings = create_embeddings()
+    cache_db = os.path.join(tempfile.mkdtemp(prefix="bench_retrieval_"), "embedding_cache.db")
+    vectorstore = Chroma(collection_name="bench_retrieval", embedding_function=CachedEmbeddings(embeddings, embeddings.model, db_name=cache_db))
+    vectorstore.add_documents(chunks, ids=ids)
+    return vectorstore
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", nargs="+", default=["vector", "lexical", "hybrid"])
+    parser.add_argument("--k", type=int, default=2)
+    parser.add_argument("--fetch-k", type=int, default=10)
+    parser.add_argument("--mmr-lambda", type=float, default=0.7)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    chunks = []
+    for filename in SECTION_FILES.values():
+        for chunk in load_and_split_document(os.path.join(DOCUMENTS_DIR, filename)):
+            chunk.metadata["file_id"] = filename
+            chunks.append(chunk)
+    ids = [str(i) for i in range(len(chunks))]
+    questions = load_questions()
+    print(f"{len(chunks)} chunks, {len(questions)} questions, k={args.k}")
+
+    lexical_index = BM25Index()
+    lexical_index.add(ids, [chunk.page_content for chunk in chunks], [chunk.metadata for chunk in chunks])
+    lexical_index.built = True
+    vectorstore = build_vectorstore(chunks, ids) if set(args.modes) - {"lexical"} else None
+
+    print(f"{'mode':10}{'recall@k':>10}{'mean ms':>10}{'p95 ms':>10}{'ctx chars':>11}{'fast path':>11}")
+    for mode in args.modes:
+        retriever = HybridRetriever(vectorstore=vectorstore, lexical_index=lexical_index, k=args.k, fetch_k=args.fetch_k,
+                                    mode=mode, mmr_lambda=args.mmr_lambda)
+        hits = 0
+        fast_paths = 0
+        timings = []
+        context_chars = []
+        for question, expected in questions:
+            fast_paths += mode == "hybrid" and retriever.is_confident(lexical_index.search(question, args.fetch_k))
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                documents = retriever.invoke(question, RunnableConfig())
+                timings.append((time.perf_counter() - start) * 1000)
+            hits += any(document.metadata["file_id"] == expected for document in documents)
+            context_chars.append(sum(len(document.page_content) for document in documents))
+        timings.sort()
+        print(f"{mode:10}{hits / len(questions):>10.2f}{statistics.mean(timings):>10.3f}{timings[int(len(timings) * 0.95)]:>10.3f}"
+              f"{statistics.mean(context_chars):>11.0f}{fast_paths if mode == 'hybrid' else '-':>11}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# Benchmark of the vector store backends on synthetic unit-length embeddings: Chroma vs the flat memory-mapped
+# index (float32 and float16). Each backend is built, then opened again in a fresh process that reports its
+# load time, the latency of the first (cold) and following queries, its resident memory and, for Chroma,
+# its recall@k against the exact flat results (Chroma's HNSW index is approximate).
+# Only the collection api the app calls (add, query) is used, so no embedding model is needed.
+#   python benchmarks/bench_vector_backend.py --chunks 100000 --dim 1536 --backends flat flat16 chroma
+import argparse
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+import numpy as np
+
+BUILD_BATCH = 5000
+COLLECTION = "langchain"
+RECALL_QUERIES = 20
+
+
+# Batches of (ids, embeddings, metadatas, documents), the same for every backend
+def synthetic_batches(chunks, dim, seed=0):
+    rng = np.random.default_rng(seed)
+    for start in range(0, chunks, BUILD_BATCH):
+        count = min(BUILD_BATCH, chunks - start)
+        embeddings = rng.standard_normal((count, dim)).astype(np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        ids = [f"chunk-{start + i}" for i in range(count)]
+        metadatas = [{"file_id": (start + i) % 500, "page": (start + i) % 40} for i in range(count)]
+        documents = [f"Synthetic chunk {start + i} " + "lorem ipsum " * 60 for i in range(count)]
+        yield ids, embeddings, metadatas, documents
+
+
+def query_embeddings(queries, dim, seed=1):
+    embeddings = np.random.default_rng(seed).standard_normal((queries, dim)).astype(np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+# Open the collection of a backend stored in path, created when create is set
+def open_collection(backend, path, create=False):
+    if backend == "chroma":
+        import chromadb
+        client = chromadb.PersistentClient(path=path)
+        if create:
+            return client.get_or_create_collection(COLLECTION, embedding_function=None)
+        return client.get_collection(COLLECTION, embedding_function=None)
+
+    from flat_index_utils import FlatCollection
+    return FlatCollection(path, COLLECTION, "float16" if backend == "flat16" else "float32")
+
+
+def current_rss_mb():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def build(args):
+    start = time.perf_counter()
+    collection = open_collection(args.backend, args.path, create=True)
+    for ids, embeddings, metadatas, documents in synthetic_batches(args.chunks, args.dim):
+        collection.add(ids=ids, embeddings=embeddings.tolist() if args.backend == "chroma" else embeddings,
+                       metadatas=metadatas, documents=documents)
+    return {"build_seconds": time.perf_counter() - start}
+
+
+def query(args):
+    queries = query_embeddings(args.queries, args.dim)
+    start = time.perf_counter()
+    collection = open_collection(args.backend, args.path)
+    load_seconds = time.perf_counter() - start
+
+    timings = []
+    first_ids = []
+    for index, embedding in enumerate(queries):
+        start = time.perf_counter()
+        result = collection.query(query_embeddings=[embedding.tolist()], n_results=args.k, include=["documents", "metadatas", "distances"])
+        timings.append(time.perf_counter() - start)
+        if index < RECALL_QUERIES:
+            first_ids.append(result["ids"][0])
+    return {"load_seconds": load_seconds, "cold_ms": timings[0] * 1000,
+            "p50_ms": statistics.median(timings[1:] or timings) * 1000,
+            "p95_ms": sorted(timings[1:] or timings)[int(0.95 * len(timings[1:] or timings))] * 1000,
+            "rss_mb": current_rss_mb(), "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, "ids": first_ids}
+
+
+def run_child(phase, backend, path, args):
+    command = [sys.executable, os.path.abspath(__file__), "--child", phase, "--backend", backend, "--path", path,
+               "--chunks", str(args.chunks), "--dim", str(args.dim), "--queries", str(args.queries), "--k", str(args.k)]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else f"{phase} failed")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def disk_mb(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names) / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--backends", nargs="+", default=["flat", "flat16", "chroma"], choices=["flat", "flat16", "chroma"])
+    parser.add_argument("--child", choices=["build", "query"], help=argparse.SUPPRESS)
+    parser.add_argument("--backend", help=argparse.SUPPRESS)
+    parser.add_argument("--path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps((build if args.child == "build" else query)(args)))
+        return
+
+    print(f"chunks: {args.chunks}, dim: {args.dim}, queries: {args.queries}, k: {args.k}")
+    print(f"{'backend':8s} {'build s':>8s} {'disk MB':>8s} {'load s':>8s} {'cold ms':>8s} {'p50 ms':>8s} {'p95 ms':>8s} {'rss MB':>8s} {'recall':>7s}")
+    root = tempfile.mkdtemp(prefix="bench_vectors_")
+    exact = None
+    try:
+        for backend in args.backends:
+            path = os.path.join(root, backend)
+            try:
+                built = run_child("build", backend, path, args)
+                measured = run_child("query", backend, path, args)
+            except RuntimeError as e:
+                print(f"{backend:8s} skipped: {e}")
+                continue
+            if backend == "flat":
+                exact = measured["ids"]
+            recall = (f"{statistics.mean(len(set(ids) & set(truth)) / len(truth) for ids, truth in zip(measured['ids'], exact)):.3f}"
+                      if exact and backend != "flat" else "-")
+            print(f"{backend:8s} {built['build_seconds']:8.2f} {disk_mb(path):8.1f} {measured['load_seconds']:8.3f} {measured['cold_ms']:8.2f} "
+                  f"{measured['p50_ms']:8.2f} {measured['p95_ms']:8.2f} {measured['rss_mb']:8.1f} {recall:>7s}")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
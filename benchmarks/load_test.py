@@ -0,0 +1,183 @@
+# Load test driver replaying a JSONL workload against a running api server.
+# Every line of the workload is one operation:
+#   {"op": "chat", "question": "...", "model": "gpt-3.5-turbo", "session": "s1"}
+#   {"op": "upload", "path": "documents/climate_change.docx"}
+#   {"op": "list"}
+#   {"op": "search", "query": "...", "k": 5}
+#   {"op": "delete", "filename": "climate_change.docx"}
+# Chat turns with the same "session" label share a server session, paths are relative to the repository.
+# Reports throughput, p50/p95/p99 latency per operation, the /chat and /search stages from their Server-Timing header
+# and the ingestion stages recorded by the upload jobs.
+# To measure the service itself without OpenAI, start the server with the fake models:
+#   cd api && LLM_PROVIDER=fake EMBEDDINGS_PROVIDER=fake uvicorn main:fapi
+#   python benchmarks/load_test.py --concurrency 16 --repeat 5
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import defaultdict
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DEFAULT_WORKLOAD = os.path.join(ROOT, "benchmarks", "workloads", "default.jsonl")
+
+
+def load_workload(path):
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+# {"history": 1.2, ...} in seconds from a "history;dur=1200.0, ..." Server-Timing header
+def parse_server_timing(header):
+    timings = {}
+    for entry in header.split(","):
+        name, _, duration = entry.strip().partition(";dur=")
+        if name and duration:
+            timings[name] = float(duration) / 1000
+    return timings
+
+
+class LoadTest:
+    def __init__(self, client, poll_jobs):
+        self.client = client
+        self.poll_jobs = poll_jobs
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.stages = defaultdict(list)
+        self.ingestion_stages = defaultdict(list)
+        self.sessions = {}
+        self.jobs = []
+
+    async def chat(self, operation):
+        data = {"question": operation["question"], "model": operation.get("model", "gpt-3.5-turbo")}
+        label = operation.get("session")
+        if label in self.sessions:
+            data["session_id"] = self.sessions[label]
+        response = await self.client.post("/chat", json=data)
+        response.raise_for_status()
+        if label:
+            self.sessions.setdefault(label, response.json()["session_id"])
+        for stage, seconds in parse_server_timing(response.headers.get("server-timing", "")).items():
+            self.stages[stage].append(seconds)
+
+    async def upload(self, operation):
+        path = os.path.join(ROOT, operation["path"])
+        with open(path, "rb") as file:
+            response = await self.client.post("/upload", files={"file": (os.path.basename(path), file)})
+        response.raise_for_status()
+        job_id = response.json().get("job_id")
+        if job_id:
+            self.jobs.append(job_id)
+
+    async def search(self, operation):
+        response = await self.client.post("/search", json={"query": operation["query"], "k": operation.get("k", 10)})
+        response.raise_for_status()
+        for stage, seconds in parse_server_timing(response.headers.get("server-timing", "")).items():
+            self.stages[stage].append(seconds)
+
+    async def list_documents(self, operation):
+        response = await self.client.get("/list")
+        response.raise_for_status()
+
+    async def delete(self, operation):
+        response = await self.client.get("/list")
+        response.raise_for_status()
+        documents = [document for document in response.json() if document["filename"] == operation["filename"]]
+        for document in documents:
+            response = await self.client.post("/delete", json={"file_id": document["id"]})
+            response.raise_for_status()
+
+    async def run_operation(self, operation):
+        handler = {"chat": self.chat, "search": self.search, "upload": self.upload, "list": self.list_documents, "delete": self.delete}[operation["op"]]
+        start = time.perf_counter()
+        try:
+            await handler(operation)
+            self.latencies[operation["op"]].append(time.perf_counter() - start)
+        except Exception as e:
+            self.errors[operation["op"]] += 1
+            print(f"{operation['op']} failed: {str(e)}")
+
+    # Workers take the operations in workload order, at most `concurrency` of them in flight
+    async def run(self, operations, concurrency):
+        queue = asyncio.Queue()
+        for operation in operations:
+            queue.put_nowait(operation)
+
+        async def worker():
+            while not queue.empty():
+                await self.run_operation(queue.get_nowait())
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        seconds = time.perf_counter() - start
+        if self.poll_jobs:
+            await self.wait_for_jobs()
+        return seconds
+
+    # Wait for the upload jobs to finish and collect their per-stage timings
+    async def wait_for_jobs(self):
+        for job_id in self.jobs:
+            while True:
+                response = await self.client.get(f"/jobs/{job_id}")
+                if response.status_code != 200:
+                    break
+                job = response.json()
+                if job["status"] in ("completed", "failed"):
+                    for stage, seconds in job["timings"].items():
+                        self.ingestion_stages[stage].append(seconds)
+                    break
+                await asyncio.sleep(0.5)
+
+
+def print_stage_table(title, stages):
+    if not stages:
+        return
+    print(f"\n{title}")
+    print(f"{'stage':<12}{'count':>8}{'mean ms':>10}{'p95 ms':>10}")
+    for stage, values in stages.items():
+        print(f"{stage:<12}{len(values):>8}{sum(values) / len(values) * 1000:>10.1f}{percentile(values, 0.95) * 1000:>10.1f}")
+
+
+def print_report(test, seconds):
+    total = sum(len(values) for values in test.latencies.values())
+    print(f"{total} operations in {seconds:.2f}s, {total / seconds:.1f} ops/s, {sum(test.errors.values())} errors")
+    print(f"\n{'op':<10}{'count':>8}{'errors':>8}{'ops/s':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for op in sorted(set(test.latencies) | set(test.errors)):
+        values = test.latencies[op]
+        if values:
+            p50, p95, p99 = (percentile(values, fraction) * 1000 for fraction in (0.50, 0.95, 0.99))
+        else:
+            p50 = p95 = p99 = float("nan")
+        print(f"{op:<10}{len(values):>8}{test.errors[op]:>8}{len(values) / seconds:>8.1f}{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}")
+    print_stage_table("/chat and /search stages (Server-Timing)", test.stages)
+    print_stage_table("ingestion stages (/jobs timings)", test.ingestion_stages)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--workload", default=DEFAULT_WORKLOAD)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=1, help="times the workload is replayed")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--no-poll-jobs", action="store_true", help="do not wait for the upload jobs to collect their stage timings")
+    args = parser.parse_args()
+
+    operations = load_workload(args.workload) * args.repeat
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        test = LoadTest(client, poll_jobs=not args.no_poll_jobs)
+        seconds = await test.run(operations, args.concurrency)
+    print(f"workload {os.path.basename(args.workload)} x{args.repeat}, concurrency {args.concurrency}")
+    print_report(test, seconds)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())